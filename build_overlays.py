@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+build_overlays.py — rebuild the per-arch apkovl overlays from the client tree.
+
+Notes:
+- Does what create_overlays.sh used to do with rm/cp/chmod/tar: the overlay
+  made on the Alpine VM (client/overlays/<arch>.apkovl.tar.gz) is kept,
+  except etc/local.d/, home/ssh/ and the two files in /root, which are
+  replaced from client/startup and client/packages/<arch>.
+- Nothing is extracted to disk. The member list (name, type, mode, owner,
+  content hash) is compared with client/overlays/<arch>.manifest.json from
+  the last build, and an arch is only repacked when a member changed.
+  Source hashes are cached by (size, mtime), so unchanged files are not
+  even read (build_client_packages.sh copies with cp -p to keep mtimes;
+  only files written anew, such as freshly built binaries, are hashed again).
+- Tarballs are reproducible: sorted members, mtimes clamped to
+  SOURCE_DATE_EPOCH, owners taken from the base overlay, and gzip without
+  a name or timestamp. pigz (all cores) is used when installed, otherwise zlib.
+- Three tarballs per arch: localhost.apkovl.tar.gz (everything, as before),
+  base.apkovl.tar.gz (APK cache, binaries, system config; rarely changes)
+  and delta.tar.gz (local.d, python, scripts). The base carries the
+  gtpxe-delta OpenRC service, which fetches the delta given by the
+  gtpxe_delta= kernel parameter before local.d runs. Each tarball is only
+  repacked when one of its own members changed.
+- Both arches are built in parallel. Outputs are copied into
+  server/package/srv/http/alpine/boot/<arch>/ only if their content changed,
+  so a later rsync/scp to the server only moves what is new.
+
+Usage:
+  ./build_overlays.py [--arch x86_64] [--base-dir] [--force] [--json]
+"""
+
+import os
+import io
+import pwd
+import sys
+import grp
+import gzip
+import json
+import stat
+import time
+import shutil
+import hashlib
+import tarfile
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(REPO, "client")
+OVERLAYS = os.path.join(CLIENT, "overlays")
+SERVER_BOOT = os.path.join(REPO, "server", "package", "srv", "http", "alpine", "boot")
+ARCHES = ("x86_64", "x86")
+
+# Default mtime of every member (1980-01-01; some tar implementations warn about 1970)
+EPOCH = int(os.environ.get("SOURCE_DATE_EPOCH", "315532800"))
+
+# Replaced on every build; everything else comes from the base overlay.
+MANAGED_DIRS = ("etc/local.d/", "home/ssh/")
+MANAGED_FILES = ("root/restart_test.sh", "root/instructions.txt",
+                 "etc/init.d/gtpxe-delta", "etc/runlevels/default/gtpxe-delta")
+
+# What changes with every client script edit. The delta overlay holds only
+# these; the base overlay (APK cache, binaries, system config) holds the rest.
+DELTA_DIRS = ("etc/local.d/", "home/ssh/python/", "home/ssh/scripts/")
+DELTA_FILES = ("root/restart_test.sh", "root/instructions.txt")
+
+FULL = "localhost.apkovl.tar.gz"
+# (file name, members): all, everything but the delta, the delta
+OUTPUTS = ((FULL, None), ("base.apkovl.tar.gz", False), ("delta.tar.gz", True))
+
+
+class Member:
+    __slots__ = ("name", "kind", "mode", "uid", "gid", "uname", "gname", "link", "sha",
+                 "src", "data")
+
+    def __init__(self, name: str, kind: str, mode: int, uid: int = 0, gid: int = 0,
+                 uname: str = "root", gname: str = "root", link: str = "", sha: str = "",
+                 src: Optional[str] = None, data: Optional[bytes] = None):
+        self.name = name
+        self.kind = kind        # "file", "dir" or "symlink"
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.uname = uname
+        self.gname = gname
+        self.link = link
+        self.sha = sha
+        self.src = src          # file on disk, read when packing
+        self.data = data        # or content taken from the base tarball
+
+    def key(self) -> List:
+        return [self.kind, self.mode, self.uid, self.gid, self.uname, self.gname,
+                self.link, self.sha]
+
+    def owned_like(self, other: Optional["Member"]) -> "Member":
+        if other is not None:
+            self.uid, self.gid, self.uname, self.gname = (
+                other.uid, other.gid, other.uname, other.gname)
+        return self
+
+
+def is_managed(name: str) -> bool:
+    return name in MANAGED_FILES or name.startswith(MANAGED_DIRS)
+
+
+def is_delta(name: str) -> bool:
+    return name in DELTA_FILES or name.startswith(DELTA_DIRS)
+
+
+def file_sha(path: str, st: os.stat_result, cache: Dict[str, List]) -> str:
+    hit = cache.get(path)
+    if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+        return hit[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    cache[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return cache[path][2]
+
+
+def walk(root: str, prefix: str, cache: Dict[str, List], skip=()) -> Dict[str, Member]:
+    """Members for everything below root, named prefix + relative path."""
+    out: Dict[str, Member] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        dirnames[:] = [d for d in dirnames if rel_dir + d not in skip]
+        for d in dirnames:
+            path = os.path.join(dirpath, d)
+            if os.path.islink(path):
+                out[prefix + rel_dir + d] = Member(prefix + rel_dir + d, "symlink", 0o777,
+                                                   link=os.readlink(path))
+            else:
+                out[prefix + rel_dir + d] = Member(prefix + rel_dir + d, "dir", 0o755)
+        for fn in filenames:
+            if rel_dir + fn in skip:
+                continue
+            path = os.path.join(dirpath, fn)
+            name = prefix + rel_dir + fn
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                out[name] = Member(name, "symlink", 0o777, link=os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                out[name] = Member(name, "file", stat.S_IMODE(st.st_mode),
+                                   sha=file_sha(path, st, cache), src=path)
+    return out
+
+
+def managed_members(arch: str, base: Dict[str, Member], cache: Dict[str, List]) -> Dict[str, Member]:
+    """etc/local.d, home/ssh and /root files, as create_overlays.sh laid them out."""
+    package = os.path.join(CLIENT, "packages", arch)
+    if not os.path.isdir(package):
+        raise SystemExit(f"{package} missing, run ./build_client_packages.sh first")
+    out: Dict[str, Member] = {}
+
+    local_d = walk(os.path.join(CLIENT, "startup"), "etc/local.d/", cache)
+    for m in local_d.values():
+        if m.kind == "file" and m.name.endswith(".start"):
+            m.mode |= 0o755
+        out[m.name] = m.owned_like(base.get("etc/local.d"))
+
+    home = walk(package, "home/ssh/", cache,
+                skip=("startup", "setup_client.sh", "scripts/restart_test.sh", "instructions.txt"))
+    for m in home.values():
+        if m.kind == "file" and m.name.startswith(("home/ssh/binaries/", "home/ssh/scripts/")):
+            m.mode |= 0o755
+        out[m.name] = m.owned_like(base.get("home/ssh"))
+
+    for src, name, mode in ((os.path.join(package, "scripts", "restart_test.sh"),
+                             "root/restart_test.sh", 0o755),
+                            (os.path.join(package, "instructions.txt"),
+                             "root/instructions.txt", None)):
+        if os.path.exists(src):
+            st = os.stat(src)
+            out[name] = Member(name, "file", mode or stat.S_IMODE(st.st_mode),
+                               sha=file_sha(src, st, cache), src=src).owned_like(base.get("root"))
+
+    # Service in the base overlay that applies the delta before local.d runs.
+    src = os.path.join(CLIENT, "openrc", "gtpxe-delta")
+    st = os.stat(src)
+    out["etc/init.d/gtpxe-delta"] = Member("etc/init.d/gtpxe-delta", "file", 0o755,
+                                           sha=file_sha(src, st, cache), src=src)
+    out["etc/runlevels/default/gtpxe-delta"] = Member(
+        "etc/runlevels/default/gtpxe-delta", "symlink", 0o777, link="/etc/init.d/gtpxe-delta")
+    return out
+
+# ------------------------- base overlay -------------------------
+
+
+def _strip(name: str) -> str:
+    return (name[2:] if name.startswith("./") else name).rstrip("/")
+
+
+def read_tarball(path: str) -> Tuple[Dict[str, Member], str]:
+    """All members of an overlay tarball, with their content, and its name prefix."""
+    members: Dict[str, Member] = {}
+    prefix = ""
+    with tarfile.open(path, "r:gz") as tar:
+        for ti in tar:
+            if ti.name.startswith("./"):
+                prefix = "./"
+            name = _strip(ti.name)
+            if not name or name == ".":
+                continue
+            common = dict(uid=ti.uid, gid=ti.gid, uname=ti.uname or "", gname=ti.gname or "")
+            if ti.isdir():
+                members[name] = Member(name, "dir", ti.mode, **common)
+            elif ti.issym():
+                members[name] = Member(name, "symlink", ti.mode, link=ti.linkname, **common)
+            elif ti.isfile():
+                data = tar.extractfile(ti).read()
+                members[name] = Member(name, "file", ti.mode,
+                                       sha=hashlib.sha256(data).hexdigest(), data=data, **common)
+            elif ti.islnk():
+                # Hard links: store the content again; the overlay has no use for link counts.
+                target = members.get(_strip(ti.linkname))
+                if target is not None and target.kind == "file":
+                    members[name] = Member(name, "file", ti.mode, sha=target.sha,
+                                           data=target.data, **common)
+    return members, prefix
+
+
+def _user(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+def _group(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def read_dir(path: str) -> Dict[str, Member]:
+    """Base taken from an extracted overlay (client/overlays/<arch>/), owners from disk."""
+    members = walk(path, "", {})
+    for name, m in members.items():
+        st = os.lstat(os.path.join(path, name))
+        m.uid, m.gid, m.uname, m.gname = st.st_uid, st.st_gid, _user(st.st_uid), _group(st.st_gid)
+        if m.kind != "symlink":
+            m.mode = stat.S_IMODE(st.st_mode)
+    return members
+
+
+def sha256_file(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    return file_sha(path, os.stat(path), {})
+
+# ------------------------- packing -------------------------
+
+
+def tarinfo(m: Member, prefix: str) -> tarfile.TarInfo:
+    ti = tarfile.TarInfo(prefix + m.name)
+    ti.mode = m.mode
+    ti.uid, ti.gid, ti.uname, ti.gname = m.uid, m.gid, m.uname, m.gname
+    ti.mtime = EPOCH
+    if m.kind == "dir":
+        ti.type = tarfile.DIRTYPE
+    elif m.kind == "symlink":
+        ti.type = tarfile.SYMTYPE
+        ti.linkname = m.link
+    return ti
+
+
+def add_parents(members: Dict[str, Member]) -> None:
+    """Directory entries for every parent, so extraction never invents modes."""
+    for name in list(members):
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            parent = "/".join(parts[:i])
+            if parent not in members:
+                members[parent] = Member(parent, "dir", 0o755)
+
+
+def compressor(level: int):
+    """pigz command line (all cores, no name/timestamp), or None to use zlib."""
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        return None
+    return [pigz, "-n", f"-{level}", "-p", str(os.cpu_count() or 1), "-c"]
+
+
+def pack(members: Dict[str, Member], prefix: str, out_path: str, level: int) -> None:
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as out:
+        argv = compressor(level)
+        if argv is not None:
+            proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=out)
+            sink = proc.stdin
+        else:
+            proc = None
+            sink = gzip.GzipFile(filename="", mode="wb", compresslevel=level, fileobj=out, mtime=0)
+        try:
+            with tarfile.open(fileobj=sink, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                if prefix:
+                    tar.addfile(tarinfo(Member("", "dir", 0o755), "."))
+                for name in sorted(members):
+                    m = members[name]
+                    ti = tarinfo(m, prefix)
+                    if m.kind != "file":
+                        tar.addfile(ti)
+                        continue
+                    if m.data is not None:
+                        ti.size = len(m.data)
+                        tar.addfile(ti, io.BytesIO(m.data))
+                    else:
+                        with open(m.src, "rb") as f:
+                            ti.size = os.fstat(f.fileno()).st_size
+                            tar.addfile(ti, f)
+        finally:
+            sink.close()
+            if proc is not None and proc.wait() != 0:
+                raise RuntimeError(f"{argv[0]} exited with {proc.returncode}")
+    os.replace(tmp, out_path)
+
+
+def deploy(src: str, dest: str) -> bool:
+    """Copy src to dest unless dest already has the same content."""
+    if sha256_file(src) == sha256_file(dest):
+        return False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copyfile(src, dest + ".tmp")
+    os.replace(dest + ".tmp", dest)
+    return True
+
+
+def subset(members: Dict[str, Member], in_delta: Optional[bool]) -> Dict[str, Member]:
+    """Members of one output (None: all), with their parent directories."""
+    if in_delta is None:
+        return members
+    out = {n: m for n, m in members.items() if is_delta(n) == in_delta}
+    for name in list(out):
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            parent = "/".join(parts[:i])
+            out.setdefault(parent, members[parent])
+    return out
+
+# ------------------------- per arch -------------------------
+
+
+def build(arch: str, use_dir: bool, force: bool, level: int) -> Dict:
+    t0 = time.monotonic()
+    tarball = os.path.join(OVERLAYS, f"{arch}.apkovl.tar.gz")
+    manifest_path = os.path.join(OVERLAYS, f"{arch}.manifest.json")
+    try:
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = {}
+    cache: Dict[str, List] = previous.get("source_cache", {})
+    before: Dict[str, List] = previous.get("members", {})
+    built: Dict[str, str] = previous.get("outputs", {})
+    tar_sha = sha256_file(tarball)
+
+    # The input tarball (the VM's overlay) is our own last full output: its unmanaged
+    # members are in the manifest and it is only decompressed if something is repacked.
+    base: Optional[Dict[str, Member]] = None
+    prefix = previous.get("prefix", "./")
+    if use_dir:
+        base = read_dir(os.path.join(OVERLAYS, arch))
+    elif tar_sha is None:
+        raise SystemExit(f"{tarball} missing (the overlay made on the Alpine VM)")
+    elif tar_sha != built.get(FULL) or force:
+        base, prefix = read_tarball(tarball)
+
+    if base is not None:
+        kept = {n: m for n, m in base.items() if not is_managed(n)}
+    else:
+        kept = {n: Member(n, *v[:7], sha=v[7]) for n, v in before.items() if not is_managed(n)}
+    managed = managed_members(arch, kept, cache)
+    members = dict(kept)
+    members.update(managed)
+    add_parents(members)
+    after = {n: m.key() for n, m in members.items()}
+
+    changes = {
+        "added": sorted(set(after) - set(before)),
+        "removed": sorted(set(before) - set(after)),
+        "changed": sorted(n for n in set(after) & set(before) if after[n] != before[n]),
+    }
+    touched = set().union(*changes.values())
+
+    repacked = []
+    outputs = {}
+    for name, in_delta in OUTPUTS:
+        path = tarball if name == FULL else os.path.join(OVERLAYS, f"{arch}.{name}")
+        sha = sha256_file(path)
+        if not (force or not before or sha is None or sha != built.get(name)
+                or any(in_delta is None or is_delta(n) == in_delta for n in touched)):
+            outputs[name] = sha
+            continue
+        if base is None:
+            # Content of the kept members comes from the previous full tarball.
+            base, prefix = read_tarball(tarball)
+            for n, m in members.items():
+                if n in base and not is_managed(n):
+                    m.data = base[n].data
+        pack(subset(members, in_delta), prefix, path, level)
+        outputs[name] = sha256_file(path)
+        repacked.append(name)
+
+    if repacked:
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"arch": arch, "prefix": prefix, "outputs": outputs,
+                       "members": after, "source_cache": cache}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    deployed = []
+    for name, _ in OUTPUTS:
+        path = tarball if name == FULL else os.path.join(OVERLAYS, f"{arch}.{name}")
+        if deploy(path, os.path.join(SERVER_BOOT, arch, name)):
+            deployed.append(name)
+    return {
+        "arch": arch,
+        "repacked": repacked,
+        "deployed": deployed,
+        "outputs": {name: {"sha256": sha, "bytes": os.path.getsize(
+            tarball if name == FULL else os.path.join(OVERLAYS, f"{arch}.{name}"))}
+            for name, sha in outputs.items()},
+        "members": len(members),
+        "seconds": round(time.monotonic() - t0, 2),
+        **changes,
+    }
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Build the apkovl overlays (incremental, reproducible)")
+    ap.add_argument("--arch", action="append", choices=ARCHES,
+                    help="only this arch (repeatable; default: all)")
+    ap.add_argument("--base-dir", action="store_true",
+                    help="take the base from client/overlays/<arch>/ instead of the tarball")
+    ap.add_argument("--force", action="store_true", help="repack even if nothing changed")
+    ap.add_argument("--level", type=int, default=9, choices=range(1, 10), metavar="1-9",
+                    help="gzip level (default 9)")
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args()
+
+    arches = args.arch or list(ARCHES)
+    with ThreadPoolExecutor(max_workers=len(arches)) as pool:
+        reports = list(pool.map(lambda a: build(a, args.base_dir, args.force, args.level), arches))
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return 0
+    for r in reports:
+        print(f"{r['arch']}: {r['members']} members, {r['seconds']} s")
+        for name, out in r["outputs"].items():
+            state = "repacked" if name in r["repacked"] else "unchanged"
+            print(f"  {name:24} {out['bytes'] / 1e6:6.1f} MB  {state}"
+                  f"{', deployed' if name in r['deployed'] else ''}")
+        for kind in ("added", "changed", "removed"):
+            for name in r[kind]:
+                print(f"  {kind:8} {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
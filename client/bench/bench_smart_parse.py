@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+bench_smart_parse.py — parse time and memory of the SMART/NVMe parsers over a recorded corpus.
+
+Notes:
+- The corpus (smart_corpus/) holds smartctl and nvme smart-log output, as
+  text and as JSON, one file per device: <name>.smartctl.{txt,json} and
+  <name>.smart-log.{txt,json}. expected.json lists what each file must parse
+  to; a mismatch fails the run before anything is timed.
+- The verdict disk_health.py derives from each file (PASS/WARN/FAIL, ERROR
+  when smartctl printed nothing) must also equal the verdict of the legacy
+  parser and thresholds on the text output of the same device; a JSON file is
+  judged against its .txt twin.
+- Per file it reports the median parse time over --repeat runs, the peak
+  memory traced while parsing and the number of memory blocks the result
+  keeps alive (tracemalloc). With --legacy it also times, on the text files,
+  the line-splitting parser disk_health.py used before smart_parse.py.
+- With --baseline it compares against an earlier --out report and exits
+  non-zero when a file got slower than --tolerance.
+- --record DEV captures a real drive into the corpus (run on a diagnostics
+  client as root); serial numbers are masked. Add the new file's values to
+  expected.json after checking them by hand.
+
+Example:
+  python3 bench_smart_parse.py --repeat 2000 --legacy --out parse.json
+  python3 bench_smart_parse.py --baseline parse.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "python"))
+
+import smart_parse  # noqa: E402
+import disk_health  # noqa: E402
+
+CORPUS = os.path.join(HERE, "smart_corpus")
+ATA_IDS = (smart_parse.REALLOCATED, smart_parse.REPORTED_UNCORRECT, smart_parse.PENDING,
+           smart_parse.OFFLINE_UNCORRECTABLE, smart_parse.CRC_ERRORS)
+
+# ------------------------- legacy parser -------------------------
+# disk_health.py before smart_parse.py, kept only as the comparison point.
+
+
+def _legacy_to_int(s: str, default: int = 0) -> int:
+    try:
+        return int(s, 0)
+    except Exception:
+        return default
+
+
+def legacy_parse_smart_attrs(text: str) -> Dict[str, int]:
+    attrs: Dict[str, int] = {}
+    in_section = False
+    for line in text.splitlines():
+        if re.search(r"Vendor Specific SMART Attributes", line, re.I):
+            in_section = True
+            continue
+        if in_section and re.search(r"^SMART|^General SMART Values|^SMART overall-health", line, re.I):
+            in_section = False
+        if not in_section:
+            continue
+        parts = line.split()
+        if len(parts) < 10:
+            continue
+        raw = " ".join(parts[9:]).strip()
+        val = 0
+        if re.search(r"[0-9]+h\+[0-9]+m\+[0-9]+s", raw):
+            a = re.sub(r"(h\+|m\+|s)", " ", raw).split()
+            if len(a) >= 3:
+                val = _legacy_to_int(a[0]) * 3600 + _legacy_to_int(a[1]) * 60 + _legacy_to_int(a[2])
+        else:
+            m = re.search(r"(\d+)", raw)
+            if m:
+                val = _legacy_to_int(m.group(1), 0)
+        attrs[parts[1]] = val
+        attrs[parts[0]] = val
+    return attrs
+
+
+def legacy_get_attr(attrs: Dict[str, int], key_regex: str) -> int:
+    rx = re.compile(key_regex)
+    for k, v in attrs.items():
+        if rx.match(str(k)):
+            return int(v)
+    return 0
+
+
+def legacy_ata(text: str) -> List[object]:
+    """The parsing disk_health.py did per SATA drive (it parsed the table twice)."""
+    attrs = legacy_parse_smart_attrs(text)
+    poh = legacy_get_attr(attrs, r"^(Power_On_Hours|Power_On_Seconds)$")
+    m = re.search(r"overall-health.*:\s*(.+)", text, re.I)
+    failed = bool(m) and "failed" in m.group(1).lower()
+    attrs = legacy_parse_smart_attrs(text)
+    m = re.search(r"ATA Error Count\s*:\s*(\d+)", text, re.I)
+    errors = [ln for ln in text.splitlines() if re.match(r"^(Error \d+ occurred|Error: )", ln)]
+    selftest = [ln for ln in text.splitlines() if re.search(r"Self-test execution status|#\s*1\s+", ln)]
+    return [failed, poh, _legacy_to_int(m.group(1)) if m else 0, errors, selftest,
+            legacy_get_attr(attrs, r"^(5|Reallocated_Sector_Ct)$"),
+            legacy_get_attr(attrs, r"^(187|Reported_Uncorrect)$"),
+            legacy_get_attr(attrs, r"^(197|Current_Pending_Sector)$"),
+            legacy_get_attr(attrs, r"^(198|Offline_Uncorrectable)$"),
+            legacy_get_attr(attrs, r"^(199|UDMA_CRC_Error_Count)$")]
+
+
+def legacy_nvme(text: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for line in text.splitlines():
+        if ":" in line:
+            k, v = line.split(":", 1)
+            out[k.strip().lower().replace(" ", "_")] = _legacy_to_int(re.sub(r"[^\dxa-fA-F]", "", v.strip()), 0)
+    return out
+
+
+def legacy_verdict(name: str, text: str) -> str:
+    """PASS/WARN/FAIL/ERROR as disk_health.py decided it with the legacy parser."""
+    if ".smartctl." in name:
+        if not text.strip():
+            return "ERROR"
+        failed, _, ata_err, _, _, ralloc, repunc, pend, offunc, crc = legacy_ata(text)
+        sev = "FAIL" if failed or pend > 0 or offunc > 0 else "PASS"
+        if repunc > 0 and sev == "PASS":
+            sev = "WARN"
+        if ralloc >= 50:
+            sev = "FAIL"
+        elif ralloc >= 10 and sev == "PASS":
+            sev = "WARN"
+        if crc >= 100 and sev == "PASS":
+            sev = "FAIL"
+        elif crc >= 10 and sev == "PASS":
+            sev = "WARN"
+        if ata_err >= 5 and sev == "PASS":
+            sev = "WARN"
+        return sev
+    if not text.strip():
+        return "ERROR"
+    kv = legacy_nvme(text)
+    sev = "FAIL" if kv.get("critical_warning", 0) != 0 or kv.get("media_errors", 0) > 0 else "PASS"
+    if kv.get("percentage_used", 0) >= 100 and sev == "PASS":
+        sev = "FAIL"
+    elif kv.get("percentage_used", 0) >= 90 and sev == "PASS":
+        sev = "WARN"
+    if kv.get("num_err_log_entries", 0) >= 10 and sev == "PASS":
+        sev = "WARN"
+    return sev
+
+# ---------------------------- corpus -----------------------------
+
+
+def summarize(name: str, text: str) -> Dict:
+    """What a corpus file parses to, in the shape of expected.json."""
+    if ".smartctl." in name:
+        r = smart_parse.parse_ata(text)
+        return {"answered": r.answered, "has_data": r.has_data, "health_failed": r.health_failed,
+                "needs_device_type": r.needs_device_type, "ata_errors": r.ata_errors,
+                "power_on_hours": r.power_on_hours(),
+                "attrs": {str(i): r.raw(i) for i in ATA_IDS}}
+    return smart_parse.parse_nvme(text).as_dict()
+
+
+def verdict(name: str, text: str) -> str:
+    """PASS/WARN/FAIL/ERROR as disk_health.py decides it from this output."""
+    if ".smartctl." in name:
+        r = smart_parse.parse_ata(text)
+        return disk_health.ata_verdict(r)[0] if r.answered else "ERROR"
+    return disk_health.nvme_severity(smart_parse.parse_nvme(text))[0] if text.strip() else "ERROR"
+
+
+def parser_for(name: str) -> Tuple[Callable[[str], object], Callable[[str], object]]:
+    if ".smartctl." in name:
+        return smart_parse.parse_ata, legacy_ata
+    return smart_parse.parse_nvme, legacy_nvme
+
+
+def load_corpus(corpus: str) -> Dict[str, str]:
+    files = {}
+    for name in sorted(os.listdir(corpus)):
+        if name != "expected.json" and (".smartctl." in name or ".smart-log." in name):
+            with open(os.path.join(corpus, name), encoding="utf-8") as f:
+                files[name] = f.read()
+    return files
+
+
+def check(files: Dict[str, str], expected: Dict[str, Dict]) -> List[str]:
+    problems = []
+    for name, text in files.items():
+        if name not in expected:
+            problems.append(f"{name}: no entry in expected.json")
+            continue
+        got = summarize(name, text)
+        if got != expected[name]:
+            problems.append(f"{name}: expected {expected[name]}, got {got}")
+        twin = name[:-len(".json")] + ".txt" if name.endswith(".json") else name
+        if twin in files:
+            old, new = legacy_verdict(twin, files[twin]), verdict(name, text)
+            if new != old:
+                problems.append(f"{name}: verdict {new}, legacy parser said {old}")
+    return problems
+
+# ---------------------------- timing -----------------------------
+
+
+def time_parse(fn: Callable[[str], object], text: str, repeat: int) -> float:
+    """Median microseconds per call, over `repeat` batches of calls."""
+    batch = 10
+    samples = []
+    for _ in range(max(1, repeat // batch)):
+        t0 = time.perf_counter()
+        for _ in range(batch):
+            fn(text)
+        samples.append((time.perf_counter() - t0) / batch * 1e6)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def memory_of(fn: Callable[[str], object], text: str) -> Tuple[float, int]:
+    """(peak KiB traced while parsing, memory blocks held by the result)."""
+    fn(text)  # warm caches (compiled patterns, interned strings)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = fn(text)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(s.count_diff for s in after.compare_to(before, "lineno") if s.count_diff > 0)
+    del result
+    return peak / 1024.0, blocks
+
+
+def run(files: Dict[str, str], repeat: int, legacy: bool) -> Dict:
+    report: Dict = {"python": sys.version.split()[0], "repeat": repeat, "files": {}}
+    for name, text in files.items():
+        new, old = parser_for(name)
+        peak, blocks = memory_of(new, text)
+        entry = {"bytes": len(text), "us": round(time_parse(new, text, repeat), 2),
+                 "peak_kib": round(peak, 1), "blocks": blocks}
+        if legacy and name.endswith(".txt"):  # the legacy parser only read text
+            peak, blocks = memory_of(old, text)
+            entry["legacy"] = {"us": round(time_parse(old, text, repeat), 2),
+                               "peak_kib": round(peak, 1), "blocks": blocks}
+        report["files"][name] = entry
+    return report
+
+
+def render(report: Dict) -> str:
+    legacy = any("legacy" in e for e in report["files"].values())
+    head = f"{'file':34} {'bytes':>6} {'us':>9} {'peak KiB':>9} {'blocks':>7}"
+    if legacy:
+        head += f" {'legacy us':>10} {'peak KiB':>9} {'blocks':>7} {'speedup':>8}"
+    rows = [head]
+    for name, e in report["files"].items():
+        row = f"{name:34} {e['bytes']:6d} {e['us']:9.2f} {e['peak_kib']:9.1f} {e['blocks']:7d}"
+        if "legacy" in e:
+            lg = e["legacy"]
+            row += (f" {lg['us']:10.2f} {lg['peak_kib']:9.1f} {lg['blocks']:7d}"
+                    f" {lg['us'] / e['us'] if e['us'] else 0:7.1f}x")
+        rows.append(row)
+    return "\n".join(rows)
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Lines describing parse time changes; entries starting with 'REGRESSION' fail the run."""
+    out = []
+    for name, cur in report["files"].items():
+        base = baseline.get("files", {}).get(name)
+        if not base or not base["us"]:
+            continue
+        change = (cur["us"] - base["us"]) / base["us"]
+        tag = "REGRESSION" if change > tolerance else "ok"
+        out.append(f"{tag:10} {name:34} {base['us']:9.2f} -> {cur['us']:9.2f} us ({change * 100:+.1f}%)")
+    return out
+
+# ---------------------------- record -----------------------------
+
+
+def record(dev: str, name: str, corpus: str) -> List[str]:
+    """Save the outputs disk_health.py reads for dev into the corpus; returns the files written."""
+    written = []
+    if os.path.basename(dev).startswith("nvme"):
+        ctrl = "/dev/" + re.split(r"n\d+$", os.path.basename(dev))[0]
+        cmds = {"smart-log.json": ["nvme", "smart-log", "-o", "json", ctrl],
+                "smart-log.txt": ["nvme", "smart-log", ctrl]}
+    else:
+        args = ["-H", "-A", "-l", "error", "-l", "selftest", dev]
+        cmds = {"smartctl.json": ["smartctl", "--json"] + args,
+                "smartctl.txt": ["smartctl"] + args}
+    for suffix, cmd in cmds.items():
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=False)
+        if not p.stdout.strip():
+            continue
+        # Serial numbers identify the machine; the parsers never need them.
+        out = re.sub(r'("serial_number"\s*:\s*"|Serial Number:\s*)([^"\n]+)',
+                     lambda m: m.group(1) + "X" * len(m.group(2).strip()), p.stdout)
+        path = os.path.join(corpus, f"{name}.{suffix}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(out)
+        written.append(path)
+    return written
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the SMART/NVMe output parsers")
+    ap.add_argument("--corpus", default=CORPUS, help="directory of recorded outputs")
+    ap.add_argument("--repeat", type=int, default=1000, help="parses per file")
+    ap.add_argument("--legacy", action="store_true", help="also time the previous parser")
+    ap.add_argument("--json", action="store_true", help="print the JSON report instead of a table")
+    ap.add_argument("--out", help="also write the JSON report to this file")
+    ap.add_argument("--baseline", help="earlier report to compare with")
+    ap.add_argument("--tolerance", type=float, default=0.25,
+                    help="allowed slowdown against the baseline (0.25 = 25%%)")
+    ap.add_argument("--record", metavar="DEV", help="capture DEV's outputs into the corpus and exit")
+    ap.add_argument("--name", help="corpus name for --record (default: the device name)")
+    args = ap.parse_args()
+
+    if args.record:
+        written = record(args.record, args.name or os.path.basename(args.record), args.corpus)
+        for path in written:
+            print(path)
+        return 0 if written else 1
+
+    files = load_corpus(args.corpus)
+    try:
+        with open(os.path.join(args.corpus, "expected.json"), encoding="utf-8") as f:
+            expected = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read expected.json: {e}", file=sys.stderr)
+        return 2
+    problems = check(files, expected)
+    if problems:
+        for p in problems:
+            print(f"MISMATCH {p}", file=sys.stderr)
+        return 1
+
+    report = run(files, args.repeat, args.legacy)
+    print(json.dumps(report, indent=2) if args.json else render(report))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            lines = compare(report, json.load(f), args.tolerance)
+        print("\n".join(lines))
+        if any(line.startswith("REGRESSION") for line in lines):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
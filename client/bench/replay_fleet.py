@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+replay_fleet.py — run disk_health.py against many recorded machines at once.
+
+Notes:
+- Every capture (written on a client by `disk_health.py --record FILE`) is
+  replayed by its own `disk_health.py --replay FILE` process, --jobs of them
+  at a time, so module state (inventory cache, backend) never mixes.
+- A replay must come to the verdicts recorded on the real machine; any
+  difference, or a replay that fails, makes the run exit non-zero. Commands
+  the current code runs but the capture lacks are listed: they mean the code
+  now asks the drive something the recording cannot answer.
+- Reports per-machine replay wall time (p50/p95/max), total wall time and
+  machines per second. --speed 0 (default) skips all recorded waits and
+  measures the code itself; --speed 60 replays a 20 minute run in 20 s.
+- --repeat N replays every capture N times, to load a dev box with hundreds
+  of machines from a handful of recordings.
+
+Example:
+  python3 replay_fleet.py captures/ --jobs 32 --repeat 10 --out fleet.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DISK_HEALTH = os.path.join(HERE, "..", "python", "disk_health.py")
+
+
+def find_captures(paths: List[str]) -> List[str]:
+    found = []
+    for p in paths:
+        if os.path.isdir(p):
+            found.extend(os.path.join(p, n) for n in sorted(os.listdir(p)) if n.endswith(".json"))
+        else:
+            found.append(p)
+    return found
+
+
+def replay_one(capture: str, speed: float, timeout: float) -> Dict:
+    cmd = [sys.executable, DISK_HEALTH, "--replay", capture, "--speed", str(speed)]
+    start = time.monotonic()
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                           timeout=timeout, check=False)
+    except subprocess.TimeoutExpired:
+        return {"capture": capture, "ok": False, "error": f"timed out after {timeout:.0f} s"}
+    elapsed = time.monotonic() - start
+    summary = None
+    for line in p.stderr.splitlines():
+        if line.startswith("REPLAY "):
+            summary = json.loads(line[len("REPLAY "):])
+    if summary is None:
+        return {"capture": capture, "ok": False, "process_s": round(elapsed, 3),
+                "error": "\n".join(p.stderr.splitlines()[-5:]) or f"exit {p.returncode}"}
+    summary.update(ok=summary["verdicts_match"], process_s=round(elapsed, 3))
+    return summary
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Replay recorded disk_health runs in parallel")
+    ap.add_argument("captures", nargs="+", help="capture files or directories of them")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 4, help="replays at the same time")
+    ap.add_argument("--speed", type=float, default=0.0,
+                    help="replay N times faster than recorded (0: no waiting)")
+    ap.add_argument("--repeat", type=int, default=1, help="replay every capture N times")
+    ap.add_argument("--timeout", type=float, default=3600.0, help="per replay (s)")
+    ap.add_argument("--out", help="also write the JSON report to this file")
+    args = ap.parse_args()
+
+    captures = find_captures(args.captures) * max(1, args.repeat)
+    if not captures:
+        print("No captures found.", file=sys.stderr)
+        return 2
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = list(pool.map(lambda c: replay_one(c, args.speed, args.timeout), captures))
+    total = time.monotonic() - start
+
+    failed = [r for r in results if not r["ok"]]
+    walls = [r["wall_s"] for r in results if "wall_s" in r]
+    report = {
+        "machines": len(results), "failed": len(failed), "jobs": args.jobs, "speed": args.speed,
+        "total_s": round(total, 3), "machines_per_s": round(len(results) / total, 2) if total else 0,
+        "wall_s": {"p50": percentile(walls, 0.5), "p95": percentile(walls, 0.95),
+                   "max": max(walls, default=0.0)},
+        "recorded_wall_s": {"max": max((r.get("recorded_wall_s") or 0 for r in results), default=0)},
+        "missing_commands": sorted({m for r in results for m in r.get("missing", ())}),
+        "failures": failed[:20],
+    }
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(dict(report, results=results), f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+cmd_backend.py — where disk_health.py gets its commands, files and clock from.
+
+Notes:
+- LiveBackend runs the real commands (subprocess), reads sysfs and sleeps.
+- RecordingBackend does the same and keeps every command with its output,
+  exit code, start time and duration, every file read and tool lookup; save()
+  writes them as one JSON capture per machine (disk_health.py --record).
+- ReplayBackend answers from such a capture (disk_health.py --replay): each
+  command gets the recorded answers in recorded order (the last one repeats
+  if the code asks more often), so self-test polling sees the same
+  progression. Time is virtual and per thread: a command advances it by its
+  recorded duration and sleep() by the requested time, and real waiting is
+  that divided by `speed` (0 = no waiting at all). Commands missing from the
+  capture answer rc 127 and are counted, so changed code that runs something
+  new is noticed instead of silently passing.
+- measure(key, fn) wraps work done in-process (the read benchmark): live it
+  calls fn, recording keeps its (JSON) result and duration, replay returns
+  the recorded result after the recorded time.
+- Captures contain serial numbers and models of the recorded machine.
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import subprocess
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+CAPTURE_VERSION = 1
+
+
+class LiveBackend:
+    def run(self, cmd: List[str], input_text: Optional[str] = None,
+            timeout: Optional[int] = None) -> Tuple[int, str, str]:
+        try:
+            p = subprocess.run(cmd, input=input_text, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               timeout=timeout, check=False, text=True)
+            return p.returncode, p.stdout or "", p.stderr or ""
+        except Exception as e:
+            return 127, "", str(e)
+
+    def read_file(self, path: str) -> Optional[str]:
+        try:
+            with open(path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def which(self, name: str) -> Optional[str]:
+        return shutil.which(name)
+
+    def measure(self, key: str, fn: Callable[[], Any]) -> Any:
+        return fn()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+
+class RecordingBackend(LiveBackend):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self.events: List[Dict] = []
+
+    def _add(self, event: Dict) -> None:
+        with self._lock:
+            self.events.append(event)
+
+    def run(self, cmd, input_text=None, timeout=None):
+        start = time.monotonic()
+        rc, out, err = super().run(cmd, input_text, timeout)
+        self._add({"kind": "cmd", "args": list(cmd), "rc": rc, "out": out, "err": err,
+                   "t": round(start - self._t0, 4), "dur": round(time.monotonic() - start, 4)})
+        return rc, out, err
+
+    def read_file(self, path):
+        data = super().read_file(path)
+        self._add({"kind": "file", "path": path, "data": data})
+        return data
+
+    def which(self, name):
+        found = super().which(name)
+        self._add({"kind": "which", "name": name, "path": found})
+        return found
+
+    def measure(self, key, fn):
+        start = time.monotonic()
+        result = fn()
+        self._add({"kind": "measure", "key": key, "result": result,
+                   "t": round(start - self._t0, 4), "dur": round(time.monotonic() - start, 4)})
+        return result
+
+    def save(self, path: str, verdicts: List[Dict], argv: List[str]) -> None:
+        capture = {"version": CAPTURE_VERSION, "host": socket.gethostname(),
+                   "recorded": time.time(), "argv": argv,
+                   "wall_s": round(time.monotonic() - self._t0, 3),
+                   "verdicts": verdicts, "events": self.events}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(capture, f)
+        os.replace(tmp, path)
+
+
+class ReplayBackend:
+    def __init__(self, capture: Dict, speed: float = 1.0):
+        if capture.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"unsupported capture version {capture.get('version')}")
+        self.capture = capture
+        self.speed = speed
+        self.missing: List[str] = []
+        self._lock = threading.Lock()
+        self._clock = threading.local()
+        self._cmds: Dict[Tuple[str, ...], Deque[Dict]] = defaultdict(deque)
+        self._last: Dict[Tuple[str, ...], Dict] = {}
+        self._files: Dict[str, Optional[str]] = {}
+        self._which: Dict[str, Optional[str]] = {}
+        self._measures: Dict[str, Deque[Dict]] = defaultdict(deque)
+        for e in capture.get("events", ()):
+            if e["kind"] == "cmd":
+                self._cmds[tuple(e["args"])].append(e)
+            elif e["kind"] == "file":
+                self._files[e["path"]] = e["data"]
+            elif e["kind"] == "which":
+                self._which[e["name"]] = e["path"]
+            elif e["kind"] == "measure":
+                self._measures[e["key"]].append(e)
+
+    @classmethod
+    def load(cls, path: str, speed: float = 1.0) -> "ReplayBackend":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), speed)
+
+    def _advance(self, seconds: float) -> None:
+        self._clock.now = self.monotonic() + seconds
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def run(self, cmd, input_text=None, timeout=None):
+        key = tuple(cmd)
+        with self._lock:
+            queue = self._cmds.get(key)
+            if queue:
+                event = queue.popleft()
+                self._last[key] = event
+            else:
+                event = self._last.get(key)
+                if event is None:
+                    self.missing.append(" ".join(cmd))
+        if event is None:
+            return 127, "", f"{cmd[0]}: not in capture"
+        self._advance(event["dur"])
+        return event["rc"], event["out"], event["err"]
+
+    def read_file(self, path):
+        return self._files.get(path)
+
+    def which(self, name):
+        return self._which.get(name)
+
+    def measure(self, key, fn):
+        with self._lock:
+            queue = self._measures.get(key)
+            event = queue.popleft() if queue else None
+            if event is None:
+                self.missing.append(key)
+        if event is None:
+            return None
+        self._advance(event["dur"])
+        return event["result"]
+
+    def monotonic(self) -> float:
+        return getattr(self._clock, "now", 0.0)
+
+    def sleep(self, seconds: float) -> None:
+        self._advance(seconds)
@@ -6,17 +6,46 @@ disk_health.py — offline drive inventory + health + self-test (Alpine/BusyBox
 
 Notes:
 - Safe against smartctl/nvme non-zero exit codes: we capture output and continue.
+- Self-tests of all drives run at the same time (--jobs / --sequential to
+  limit); reports are still printed one drive at a time, in lsblk order.
+- Waiting for a self-test uses the duration the drive advertises and its
+  progress: polls are rare while the test surely runs and frequent near the
+  end, and NVMe tests are awaited through the self-test log.
+- SMART data is read as JSON (smartctl --json, nvme -o json) when the tools
+  support it and as text otherwise; parsing lives in smart_parse.py.
+- Commands, sysfs reads and the clock go through a backend (cmd_backend.py):
+  --record FILE saves a run as a capture, --replay FILE runs the same checks
+  from one without hardware (--speed to compress its waits), for testing
+  threshold and timing changes against recorded machines.
+- --read-bench adds a read-only surface benchmark per drive (read_bench.py:
+  O_DIRECT sequential zone map, random 4K latency, SATA link speed), run
+  after the self-test, in parallel like it; its findings join the verdict.
+- SMART counters are compared with the drive's previous check: the latest
+  snapshot per serial is fetched from the PXE server in one request at
+  startup (smart_history.py), and counters that grow fast make the verdict
+  worse even below the absolute thresholds (--no-history to skip).
+- --json-out FILE / --json-fd N stream the results as NDJSON (inventory,
+  one record per drive as soon as it is done, summary) next to the text.
 - Requires: lsblk, dmesg, smartctl (smartmontools), nvme-cli (for NVMe).
 """
 
 import os
 import re
 import sys
+import json
 import time
 import math
-import shutil
-import subprocess
-from typing import Tuple, Dict, Optional, List
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Tuple, Dict, Optional, List
+
+import read_bench
+import smart_parse
+import smart_history
+from cmd_backend import LiveBackend, RecordingBackend, ReplayBackend
+from report_upload import read_cmdline, server_from_cmdline
+from smart_parse import AtaReport, NvmeHealth
 
 # --------------------------- helpers ---------------------------
 
@@ -38,18 +67,17 @@ def print_line():
     print(Colors.GRAY + "-" * 80 + Colors.RESET)
 
 
-def run_cmd(cmd: List[str], input_text: Optional[bytes] = None, timeout: Optional[int] = None) -> Tuple[int, str, str]:
+# Live by default; main() swaps in a recording or replaying backend.
+backend = LiveBackend()
+
+
+def run_cmd(cmd: List[str], input_text: Optional[str] = None, timeout: Optional[int] = None) -> Tuple[int, str, str]:
     """Run a command, returning (rc, stdout, stderr). Never raises."""
-    try:
-        p = subprocess.run(cmd, input=input_text, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                           timeout=timeout, check=False, text=True)
-        return p.returncode, p.stdout or "", p.stderr or ""
-    except Exception as e:
-        return 127, "", str(e)
+    return backend.run(cmd, input_text, timeout)
 
 
 def which_or(name: str) -> Optional[str]:
-    return shutil.which(name)
+    return backend.which(name)
 
 
 def indent(text: str, spaces: int = 6) -> str:
@@ -67,90 +95,27 @@ def to_int(s: str, default: int = 0) -> int:
 def years_from_hours(poh: int) -> float:
     return poh / 24.0 / 365.0 if poh else 0.0
 
-# ------------------- SMART (ATA/SATA) parsing -------------------
-
-
-SMART_SECTION_START = re.compile(r"Vendor Specific SMART Attributes", re.I)
-SMART_SECTION_END = re.compile(
-    r"^SMART|^General SMART Values|^SMART overall-health", re.I)
-
-
-def parse_smart_attrs(table_text: str) -> Dict[str, int]:
-    """
-    Parse SMART attribute table to a dict mapping attribute NAME -> raw numeric value.
-    Compatible with formats like:
-      ID# ATTRIBUTE_NAME FLAG VALUE WORST THRESH TYPE UPDATED WHEN_FAILED RAW_VALUE
-    Also copes with RAW like '497h+18m+30s' or '44 (Min/Max ...)' by extracting first number or converting h+m+s.
-    """
-    attrs: Dict[str, int] = {}
-    in_section = False
-    for line in table_text.splitlines():
-        if SMART_SECTION_START.search(line):
-            in_section = True
-            continue
-        if in_section and SMART_SECTION_END.search(line):
-            in_section = False
-        if not in_section:
-            continue
-
-        # Tokenize carefully; columns are space-separated but RAW_VALUE may contain spaces.
-        parts = line.split()
-        if len(parts) < 10:
-            continue
-        # Cols (common smartctl output):
-        # 0:ID, 1:NAME, 9+: RAW_VALUE (10th col onwards)
-        attr_id = parts[0]
-        name = parts[1]
-        raw = " ".join(parts[9:]).strip()
-
-        # Normalize raw to int
-        val = 0
-        # h+m+s format e.g. 497h+18m+30s
-        if re.search(r"[0-9]+h\+[0-9]+m\+[0-9]+s", raw):
-            tmp = re.sub(r"(h\+|m\+|s)", " ", raw)
-            a = tmp.split()
-            if len(a) >= 3:
-                val = to_int(a[0]) * 3600 + to_int(a[1]) * 60 + to_int(a[2])
-        else:
-            # First integer substring (handles '44 (Min/Max 10/65)' or '0 (2000 0)')
-            m = re.search(r"(\d+)", raw)
-            if m:
-                val = to_int(m.group(1), 0)
-
-        attrs[name] = val
-        attrs[attr_id] = val  # allow lookup by ID string too
-    return attrs
-
-
-def get_attr(attrs: Dict[str, int], key_regex: str) -> int:
-    """Return numeric attribute value by ID or NAME regex (like bash function get_attr)."""
-    rx = re.compile(key_regex)
-    for k, v in attrs.items():
-        if rx.match(str(k)):
-            return int(v)
-    return 0
+# ------------------- SMART (ATA/SATA) health -------------------
 
 
-def smart_severity(smart_o_text: str) -> Tuple[str, str, Dict[str, int]]:
+def smart_severity(report: AtaReport) -> Tuple[str, str, Dict[str, int]]:
     """
-    Compute severity from key ATA attributes and overall health lines inside smartctl output.
+    Compute severity from key ATA attributes and the overall health of a parsed smartctl report.
     Returns (sev: PASS/WARN/FAIL, why, extras dict).
     """
     sev = "PASS"
     why_parts: List[str] = []
 
     # overall-health
-    m = re.search(r"overall-health.*:\s*(.+)", smart_o_text, re.I)
-    if m and "failed" in m.group(1).lower():
+    if report.health_failed:
         sev = "FAIL"
         why_parts.append("overall-health-failed")
 
-    attrs = parse_smart_attrs(smart_o_text)
-    ralloc = get_attr(attrs, r"^(5|Reallocated_Sector_Ct)$")
-    repunc = get_attr(attrs, r"^(187|Reported_Uncorrect)$")
-    pend = get_attr(attrs, r"^(197|Current_Pending_Sector)$")
-    offunc = get_attr(attrs, r"^(198|Offline_Uncorrectable)$")
-    crc = get_attr(attrs, r"^(199|UDMA_CRC_Error_Count)$")
+    ralloc = report.raw(smart_parse.REALLOCATED)
+    repunc = report.raw(smart_parse.REPORTED_UNCORRECT)
+    pend = report.raw(smart_parse.PENDING)
+    offunc = report.raw(smart_parse.OFFLINE_UNCORRECTABLE)
+    crc = report.raw(smart_parse.CRC_ERRORS)
 
     # Thresholds (balanced for practical use - filter out noise, catch real problems)
     RALLOC_FAIL = 50    # 50+ reallocated sectors indicates drive degradation
@@ -198,23 +163,86 @@ def smart_severity(smart_o_text: str) -> Tuple[str, str, Dict[str, int]]:
     }
     return sev, " ".join(why_parts), extras
 
-# ------------------------ NVMe parsing --------------------------
 
+def ata_verdict(report: AtaReport) -> Tuple[str, str, Dict[str, int]]:
+    """smart_severity() plus the ATA error log; the verdict of a drive smartctl answered for."""
+    sev, why, extras = smart_severity(report)
+    # ATA error count - only warn if significant
+    extras["ata_errors"] = report.ata_errors
+    if report.ata_errors >= 5 and sev == "PASS":
+        sev = "WARN"
+        why = (why + " " if why else "") + f"ata_error_log(≥5)"
+    return sev, why, extras
+
+
+def nvme_severity(health: NvmeHealth) -> Tuple[str, str]:
+    """NVMe health thresholds: (PASS/WARN/FAIL, why)."""
+    sev = "PASS"
+    reasons = []
+
+    # Critical warning - always fail (indicates hardware problem)
+    if health.critical_warning != 0:
+        sev = "FAIL"
+        reasons.append("critical_warning")
+
+    # Media errors - always fail (indicates bad NAND cells)
+    if health.media_errors > 0 and sev == "PASS":
+        sev = "FAIL"
+        reasons.append("media_errors")
+
+    # Wear level thresholds
+    if health.percentage_used >= 100 and sev == "PASS":
+        sev = "FAIL"
+        reasons.append("worn_out")
+    elif health.percentage_used >= 90 and sev == "PASS":
+        sev = "WARN"
+        reasons.append("high_wear(≥90%)")
+
+    # Error log entries - only warn if significant
+    if health.num_err_log_entries >= 10 and sev == "PASS":
+        sev = "WARN"
+        reasons.append(f"controller_errors(≥10)")
+    return sev, " ".join(reasons)
+
+
+SMART_READ_ARGS = ["-H", "-A", "-l", "error", "-l", "selftest"]
 
-def parse_kv(text: str) -> Dict[str, int]:
+# Cleared at the first smartctl that does not know --json (< 7.0), for the rest of the run.
+_smartctl_json = True
+
+
+def smartctl_report(dev: str, dtype: List[str]) -> Tuple[AtaReport, str]:
     """
-    Parse lines like 'critical_warning : 0' from nvme smart-log into dict of ints (missing -> 0).
+    Health, attributes and logs of dev as (report, smartctl's error text).
+    report.answered is whether smartctl printed anything on stdout: as before
+    the JSON parser, a drive is judged on whatever it reported (SMART
+    disabled, no attribute table behind a bridge: PASS), and only silence is
+    an ERROR.
     """
-    out: Dict[str, int] = {}
-    for line in text.splitlines():
-        if ":" in line:
-            k, v = line.split(":", 1)
-            k = k.strip().lower().replace(" ", "_")
-            v = v.strip()
-            # strip trailing percentage signs etc
-            v = re.sub(r"[^\dxa-fA-F]", "", v)
-            out[k] = to_int(v, 0)
-    return out
+    global _smartctl_json
+    if _smartctl_json:
+        _, out, err = run_cmd(["smartctl", "--json"] + dtype + SMART_READ_ARGS + [dev])
+        report = smart_parse.parse_ata(out)
+        if report.source == "json":
+            return report, "\n".join(report.messages) or err
+        _smartctl_json = False
+    _, out, err = run_cmd(["smartctl"] + dtype + SMART_READ_ARGS + [dev])
+    report = smart_parse.parse_ata_text(out + "\n" + err)
+    report.answered = bool(out.strip())
+    return report, err or out
+
+
+def nvme_health(ctrl: str) -> Tuple[Optional[NvmeHealth], str]:
+    """`nvme smart-log` of ctrl as (fields or None, error text); JSON when nvme-cli has it."""
+    rc, out, err = run_cmd(["nvme", "smart-log", "-o", "json", ctrl])
+    if rc == 0 and out.strip():
+        return smart_parse.parse_nvme(out), ""
+    rc, out, err = run_cmd(["nvme", "smart-log", ctrl])
+    if rc == 0 and out.strip():
+        return smart_parse.parse_nvme_text(out), ""
+    return None, err
+
+# ------------------------ NVMe parsing --------------------------
 
 
 def nvme_decode_selftest_result_block(text: str) -> List[str]:
@@ -263,309 +291,728 @@ def nvme_decode_selftest_result_block(text: str) -> List[str]:
             out.append(f"      Power-on hours   : {poh} (~{yrs:.2f} years)")
     return out
 
-# ------------------------ inventory helpers ---------------------
+# ------------------------ device inventory ----------------------
 
+INVENTORY_COLUMNS = ("NAME", "TYPE", "TRAN", "SIZE", "MODEL", "SERIAL", "MOUNTPOINT", "ROTA")
 
-def lsblk_filtered():
-    # name type tran size model serial mountpoint
-    rc, out, _ = run_cmd(
-        ["lsblk", "-o", "NAME,TYPE,TRAN,SIZE,MODEL,SERIAL,MOUNTPOINT", "-e", "7"])
-    if rc != 0:
-        return ""
-    lines = []
+
+class DeviceInfo:
+    """One block device from the inventory (disk or partition)."""
+
+    __slots__ = ("name", "type", "tran", "size", "model", "serial", "mountpoint",
+                 "rotational", "children")
+
+    def __init__(self, fields: Dict[str, object]):
+        def text(key: str) -> str:
+            v = fields.get(key)
+            return "" if v is None else str(v).strip()
+
+        self.name = text("name")
+        self.type = text("type")
+        self.tran = text("tran")
+        self.size = text("size")
+        self.model = text("model")
+        self.serial = text("serial")
+        self.mountpoint = text("mountpoint")
+        rota = fields.get("rota")
+        # util-linux < 2.33 gives "0"/"1", newer true/false
+        self.rotational: Optional[bool] = None if rota in (None, "") else rota in (True, "1")
+        self.children: List["DeviceInfo"] = [
+            DeviceInfo(c) for c in fields.get("children") or () if isinstance(c, dict)]
+
+    @property
+    def dev(self) -> str:
+        return f"/dev/{self.name}"
+
+    @property
+    def is_testable_disk(self) -> bool:
+        return (self.type == "disk" and not self.name.startswith(("ram", "loop", "zram"))
+                and self.name != "fd0" and self.size not in ("", "0B"))
+
+    @property
+    def kind(self) -> str:
+        if self.rotational is None:
+            return "Unknown"
+        return "HDD" if self.rotational else "SSD/NVMe"
+
+
+def _parse_lsblk_pairs(out: str) -> List[Dict[str, object]]:
+    """`lsblk -P` (KEY="value" per line) for lsblk versions without -J; flat, no children."""
+    devices = []
     for line in out.splitlines():
-        if not line.strip():
-            continue
-        if re.match(r"^NAME\s+TYPE", line):
-            lines.append(line)
-            continue
-        first = line.split()[0]
-        # Exclude ram*, loop*, fd0, size==0B lines (size is col 4 typically; safer to keep everything but filter by first col)
-        if first.startswith(("ram", "loop")) or first == "fd0":
+        fields = {k.lower(): v for k, v in re.findall(r'([A-Z:-]+)="([^"]*)"', line)}
+        if fields:
+            devices.append(fields)
+    return devices
+
+
+def _read_rotational(devices: List[DeviceInfo]) -> None:
+    """Fill in rotational from sysfs for disks lsblk did not report it for."""
+    for d in devices:
+        if d.rotational is not None or d.type != "disk":
             continue
-        # We already asked lsblk to exclude 7 (rom), but keep a simple filter
-        lines.append(line)
-    return "\n".join(lines)
+        flag = backend.read_file(f"/sys/block/{d.name}/queue/rotational")
+        if flag is not None:
+            d.rotational = flag.strip() == "1"
 
 
-def list_disks() -> List[str]:
-    rc, out, _ = run_cmd(["lsblk", "-ndo", "NAME,TYPE,SIZE"])
-    disks = []
+_inventory: Optional[List[DeviceInfo]] = None
+
+
+def inventory() -> List[DeviceInfo]:
+    """
+    All block devices (except ROMs), from a single lsblk call. Cached for the
+    whole run: the set of drives does not change while we test them.
+    """
+    global _inventory
+    if _inventory is not None:
+        return _inventory
+    cols = ",".join(INVENTORY_COLUMNS)
+    raw: List[Dict[str, object]] = []
+    rc, out, _ = run_cmd(["lsblk", "-J", "-o", cols, "-e", "7"])
     if rc == 0:
-        for line in out.splitlines():
-            parts = line.split()
-            if len(parts) >= 3:
-                name, typ, size = parts[0], parts[1], parts[2]
-                if typ == "disk" and not name.startswith(("ram", "loop")) and name != "fd0" and size != "0B":
-                    disks.append(name)
-    return disks
-
-
-def block_rotational_flag(devname: str) -> str:
-    # Reads /sys/block/<base>/queue/rotational
-    base = re.sub(r"\d+$", "", devname)  # strip trailing digits (partitions)
-    path = f"/sys/block/{base}/queue/rotational"
-    try:
-        with open(path, "r") as f:
-            s = f.read().strip()
-            if s == "1":
-                return "HDD"
-            elif s == "0":
-                return "SSD/NVMe"
-            else:
-                return "Unknown"
-    except Exception:
-        return "Unknown"
+        try:
+            raw = json.loads(out).get("blockdevices") or []
+        except ValueError:
+            raw = []
+    else:
+        rc, out, _ = run_cmd(["lsblk", "-P", "-o", cols, "-e", "7"])
+        raw = _parse_lsblk_pairs(out) if rc == 0 else []
+    devices = [DeviceInfo(d) for d in raw if isinstance(d, dict)]
+    _read_rotational(devices)
+    _inventory = devices
+    return devices
+
+
+def render_inventory(devices: List[DeviceInfo]) -> str:
+    """Inventory table (disks and their partitions), like the lsblk listing."""
+    rows = [["NAME", "TYPE", "TRAN", "SIZE", "MODEL", "SERIAL", "MOUNTPOINT"]]
+
+    def add(d: DeviceInfo, prefix: str) -> None:
+        if d.name.startswith(("ram", "loop")) or d.name == "fd0":
+            return
+        rows.append([prefix + d.name, d.type, d.tran, d.size, d.model, d.serial, d.mountpoint])
+        for i, c in enumerate(d.children):
+            add(c, "└─" if i == len(d.children) - 1 else "├─")
+
+    for d in devices:
+        add(d, "")
+    if len(rows) == 1:
+        return ""
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in rows)
 
 
-def lsblk_one(dev: str, field: str) -> str:
-    rc, out, _ = run_cmd(["lsblk", "-ndo", field, dev])
-    return out.strip() if rc == 0 else ""
+def list_disks() -> List[DeviceInfo]:
+    return [d for d in inventory() if d.is_testable_disk]
 
-# ---------------------------- main ------------------------------
+# ------------------------- self-tests ---------------------------
 
+DEFAULT_SHORT_TEST_S = 120  # when the drive does not say (NVMe short tests are <= 2 min by spec)
+MIN_POLL_S = 2
+MAX_POLL_S = 30
 
-def main() -> int:
-    print()
-    print_line()
-    print(f"{Colors.BOLD}{Colors.CYAN}Disk Inventory:{Colors.RESET}")
-    inv = lsblk_filtered()
-    if inv:
-        print(inv)
-    print_line()
-
-    disks = list_disks()
-    if not disks:
-        print(f"{Colors.YELLOW}No disks detected.{Colors.RESET}")
-        return 0
+# Serializes progress lines of drives polled in parallel.
+_progress_lock = threading.Lock()
 
-    overall_rc = 0
 
-    for n in disks:
-        dev = f"/dev/{n}"
-        print(f"\n{Colors.BOLD}{Colors.CYAN}Device: {dev}{Colors.RESET}")
-        model = lsblk_one(dev, "MODEL")
-        serial = lsblk_one(dev, "SERIAL")
-        size = lsblk_one(dev, "SIZE")
-        tran = lsblk_one(dev, "TRAN")
-        dtype = block_rotational_flag(n)
-        print(
-            f"  Model: {model} | Serial: {serial or 'N/A'} | Size: {size} | Bus: {tran or 'N/A'} | Type: {dtype}")
-
-        is_nvme = n.startswith("nvme")
-        if is_nvme and which_or("nvme"):
-            ctrl = f"/dev/{re.split(r'n\d+', n)[0]}"
-            print(f"    → Running short self-test on {ctrl}...")
-            # Kick short self-test (code 1)
-            run_cmd(["nvme", "device-self-test", "-s", "1", ctrl])
-            rcH, nvme_h, nvme_e = run_cmd(["nvme", "smart-log", "-H", ctrl])
-
-            if nvme_h.strip():
-                # parse key fields
-                rcJ, nvme_json, _ = run_cmd(["nvme", "smart-log", ctrl])
-                kv = parse_kv(nvme_json)
-
-                cw = kv.get("critical_warning", 0)
-                me = kv.get("media_errors", 0)
-                ne = kv.get("num_err_log_entries", 0)
-                pu = kv.get("percentage_used", 0)
-                poh = kv.get("power_on_hours", 0)
-
-                # NVMe health thresholds
-                sev = "PASS"
-                why = []
-
-                # Critical warning - always fail (indicates hardware problem)
-                if cw != 0:
-                    sev = "FAIL"
-                    why.append("critical_warning")
-
-                # Media errors - always fail (indicates bad NAND cells)
-                if me > 0 and sev == "PASS":
-                    sev = "FAIL"
-                    why.append("media_errors")
-
-                # Wear level thresholds
-                if pu >= 100 and sev == "PASS":
-                    sev = "FAIL"
-                    why.append("worn_out")
-                elif pu >= 90 and sev == "PASS":
-                    sev = "WARN"
-                    why.append("high_wear(≥90%)")
-
-                # Error log entries - only warn if significant
-                if ne >= 10 and sev == "PASS":
-                    sev = "WARN"
-                    why.append(f"controller_errors(≥10)")
-
-                # Colorize health status
-                if sev == "PASS":
-                    health_str = f"{Colors.GREEN}{Colors.BOLD}PASS{Colors.RESET}"
-                elif sev == "WARN":
-                    health_str = f"{Colors.YELLOW}{Colors.BOLD}WARN{Colors.RESET}"
-                else:
-                    health_str = f"{Colors.RED}{Colors.BOLD}FAIL{Colors.RESET}"
-
-                print(f"  Health: {health_str}")
-                if sev == "FAIL":
-                    overall_rc = 1
-                print(
-                    f"    Power-on hours: {poh or 0}  (~{years_from_hours(poh):.2f} years)")
-                print(f"    Wear level: {pu or 0}%")
-
-                # Only show concerning attributes
-                nvme_concerns = []
-                if cw != 0:
-                    nvme_concerns.append(f"Critical_Warning={cw} (FAIL if >0)")
-                if me > 0:
-                    nvme_concerns.append(f"Media_Errors={me} (FAIL if >0)")
-                if pu >= 90:
-                    nvme_concerns.append(
-                        f"Percentage_Used={pu}% (WARN≥90%, FAIL≥100%)")
-                if ne >= 10:
-                    nvme_concerns.append(f"Error_Log_Entries={ne} (WARN≥10)")
-
-                if nvme_concerns:
-                    print(
-                        f"    {Colors.YELLOW}{Colors.BOLD}CONCERNS:{Colors.RESET}")
-                    for concern in nvme_concerns:
-                        print(
-                            f"      {Colors.YELLOW}•{Colors.RESET} {concern}")
-
-                # Self-test log (optional)
-                rcS, stlog, _ = run_cmd(["nvme", "self-test-log", ctrl])
-                if rcS == 0 and stlog.strip():
-                    decoded = nvme_decode_selftest_result_block(stlog)
-                    # Only show if there's useful info
-                    if decoded and not all("No test recorded" in line for line in decoded):
-                        print(
-                            f"    {Colors.CYAN}Self-test result (most recent):{Colors.RESET}")
-                        for l in decoded:
-                            print(f"    {l}")
-            else:
-                print(
-                    f"  Health: {Colors.RED}{Colors.BOLD}ERROR{Colors.RESET}")
-                overall_rc = 1
-                if nvme_e.strip():
-                    print(
-                        f"    {Colors.RED}" + indent("\n".join(nvme_e.splitlines()[:6]), 4) + Colors.RESET)
+def progress(label: str, text: str) -> None:
+    with _progress_lock:
+        print(f"    {Colors.DIM}{label}: {text}{Colors.RESET}", flush=True)
+
 
+def ata_selftest_status(text: str) -> Tuple[bool, Optional[int], Optional[int]]:
+    """
+    From `smartctl -c`: (running, percent done, short test minutes).
+    '... Self-test routine in progress... 30% of test remaining.' and
+    'Short self-test routine recommended polling time: ( 2) minutes.'
+    The minutes also come from `smartctl -t short`: 'Please wait 2 minutes ...'.
+    """
+    running = bool(re.search(r"Self-test routine in progress", text, re.I))
+    done = None
+    m = re.search(r"(\d+)% of test remaining", text, re.I)
+    if running and m:
+        done = 100 - to_int(m.group(1), 0)
+    minutes = None
+    m = re.search(r"Short self-test routine\s*recommended polling time:\s*\(\s*(\d+)\)"
+                  r"|Please wait (\d+) minutes", text, re.I)
+    if m:
+        minutes = to_int(m.group(1) or m.group(2), 0)
+    return running, done, minutes
+
+
+def nvme_selftest_status(text: str) -> Tuple[bool, Optional[int]]:
+    """From `nvme self-test-log`: (running, percent done)."""
+    m = re.search(r"Current operation\s*:\s*(\S+)", text, re.I)
+    running = bool(m) and to_int(m.group(1), 0) != 0
+    m = re.search(r"Current Completion\s*:\s*(\d+)\s*%", text, re.I)
+    done = to_int(m.group(1), 0) if running and m else None
+    return running, done
+
+
+def wait_selftest(probe, expected_s: Optional[float], label: str) -> Tuple[bool, float, int]:
+    """
+    Poll probe() -> (running, percent done or None, advertised seconds or None)
+    until the test ends.
+
+    Instead of a fixed interval, sleep a third of the estimated time left: from
+    the progress rate once the drive reports one, else from the duration the
+    drive advertises (expected_s; None: what the first poll reports, else
+    DEFAULT_SHORT_TEST_S). Few polls while the test surely runs, quick ones
+    near its end. Gives up after twice the expected time plus a minute.
+    Returns (finished, seconds waited, polls).
+    """
+    start = backend.monotonic()
+    polls = 0
+    while True:
+        running, done, advertised = probe()
+        polls += 1
+        if polls == 1:
+            expected_s = expected_s or advertised or DEFAULT_SHORT_TEST_S
+            deadline = start + expected_s * 2 + 60
+        now = backend.monotonic()
+        elapsed = now - start
+        if not running:
+            return True, elapsed, polls
+        if now >= deadline:
+            return False, elapsed, polls
+        if done:
+            left = elapsed * (100 - done) / done
         else:
-            # SATA/USB/SAS via smartctl
-            print(f"    → Running short self-test on {dev}...")
-            rcT, _, ste = run_cmd(["smartctl", "-t", "short", dev])
-            if rcT != 0 and re.search(r"(Unknown USB bridge|please specify device type)", ste or "", re.I):
-                # Retry with SAT bridge
-                run_cmd(["smartctl", "-d", "sat", "-t", "short", dev])
-
-            # Poll up to ~130s until not in-progress
-            end = time.time() + 130
-            while time.time() < end:
-                rcC, cap, _ = run_cmd(["smartctl", "-c", dev])
-                if rcC == 0 and re.search(r"Self-test routine in progress", cap or "", re.I):
-                    time.sleep(5)
-                    continue
-                break
-
-            # Fetch SMART data (H/A/error/selftest)
-            rcO, smart_o, smart_e = run_cmd(
-                ["smartctl", "-H", "-A", "-l", "error", "-l", "selftest", dev])
-            if (not smart_o.strip()) or re.search(r"(Unknown USB bridge|please specify device type)", smart_e or "", re.I):
-                rcO, smart_o, smart_e = run_cmd(
-                    ["smartctl", "-d", "sat", "-H", "-A", "-l", "error", "-l", "selftest", dev])
-
-            if smart_o.strip():
-                attrs = parse_smart_attrs(smart_o)
-
-                # Power on hours / seconds heuristic
-                poh = get_attr(attrs, r"^(Power_On_Hours|Power_On_Seconds)$")
-                if poh > 100000:   # looks like seconds
-                    poh = poh // 3600
-
-                sev, why, extras = smart_severity(smart_o)
-
-                # ATA error count - only warn if significant
-                m = re.search(r"ATA Error Count\s*:\s*(\d+)", smart_o, re.I)
-                ata_err = to_int(m.group(1), 0) if m else 0
-                if ata_err >= 5 and sev == "PASS":
-                    sev = "WARN"
-                    why = (why + " " if why else "") + f"ata_error_log(≥5)"
-
-                # Colorize health status
-                if sev == "PASS":
-                    health_str = f"{Colors.GREEN}{Colors.BOLD}PASS{Colors.RESET}"
-                elif sev == "WARN":
-                    health_str = f"{Colors.YELLOW}{Colors.BOLD}WARN{Colors.RESET}"
-                else:
-                    health_str = f"{Colors.RED}{Colors.BOLD}FAIL{Colors.RESET}"
-
-                print(f"  Health: {health_str}")
-                if sev == "FAIL":
-                    overall_rc = 1
-                print(
-                    f"    Power-on hours: {poh or 0}  (~{years_from_hours(poh):.2f} years)")
-
-                # Only show concerning attributes
-                concerns = []
-                if extras['repunc'] > 0:
-                    concerns.append(
-                        f"Reported_Uncorrect={extras['repunc']} (WARN if >0)")
-                if extras['pend'] > 0:
-                    concerns.append(
-                        f"Pending_Sectors={extras['pend']} (FAIL if >0)")
-                if extras['offunc'] > 0:
-                    concerns.append(
-                        f"Offline_Uncorrectable={extras['offunc']} (FAIL if >0)")
-                if extras['ralloc'] >= 10:
-                    concerns.append(
-                        f"Reallocated_Sectors={extras['ralloc']} (WARN≥10, FAIL≥50)")
-                if extras['crc'] >= 10:
-                    concerns.append(
-                        f"CRC_Errors={extras['crc']} (WARN≥10, FAIL≥100) {Colors.YELLOW}- CHECK CABLE{Colors.RESET}")
-
-                if concerns:
-                    print(
-                        f"    {Colors.YELLOW}{Colors.BOLD}CONCERNS:{Colors.RESET}")
-                    for concern in concerns:
-                        print(
-                            f"      {Colors.YELLOW}•{Colors.RESET} {concern}")
-
-                if ata_err >= 5:
-                    print(
-                        f"    {Colors.YELLOW}ATA Error Log: {ata_err} errors found (WARN≥5){Colors.RESET}")
-                    # Show recent errors (first ~20 lines that match key markers)
-                    print(f"    {Colors.RED}Recent ATA errors:{Colors.RESET}")
-                    shown = 0
-                    for ln in smart_o.splitlines():
-                        if re.match(r"^(Error \d+ occurred|Error: )", ln):
-                            print(f"      {ln}")
-                            shown += 1
-                            if shown >= 20:
-                                break
-
-                # Show self-test results only if there's something interesting
-                selftest_lines = [ln for ln in smart_o.splitlines()
-                                  if re.search(r"Self-test execution status|#\s*1\s+", ln)]
-                if selftest_lines and not all("Completed without error" in ln or "of test" in ln for ln in selftest_lines):
-                    print(f"    {Colors.CYAN}Self-test results:{Colors.RESET}")
-                    for ln in selftest_lines[:3]:  # Only show first 3 lines
-                        print(f"      {ln}")
+            left = expected_s - elapsed
+        if done is not None:
+            progress(label, f"self-test {done}% done, about {max(left, 0):.0f} s left")
+        backend.sleep(max(MIN_POLL_S, min(left / 3, MAX_POLL_S, deadline - now)))
 
+
+def ata_selftest(dev: str, dtype: List[str], started: str) -> Tuple[bool, float, int]:
+    """
+    Wait for the short self-test started on dev (dtype: extra smartctl -d args).
+    started is the output of `smartctl -t short`; its 'Please wait N minutes'
+    is the expected duration, else the polling time of the first poll.
+    """
+    _, _, minutes = ata_selftest_status(started)
+
+    def probe() -> Tuple[bool, Optional[int], Optional[float]]:
+        _, out, _ = run_cmd(["smartctl"] + dtype + ["-c", dev])
+        running, done, minutes = ata_selftest_status(out)
+        return running, done, minutes * 60 if minutes else None
+
+    return wait_selftest(probe, minutes * 60 if minutes else None, dev)
+
+
+def nvme_selftest(ctrl: str) -> Tuple[bool, float, int]:
+    """Wait for the short device self-test started on ctrl, via the self-test log."""
+    def probe() -> Tuple[bool, Optional[int], Optional[float]]:
+        rc, out, _ = run_cmd(["nvme", "self-test-log", ctrl])
+        running, done = nvme_selftest_status(out) if rc == 0 else (False, None)
+        return running, done, None
+
+    return wait_selftest(probe, DEFAULT_SHORT_TEST_S, ctrl)
+
+
+def selftest_summary(finished: bool, waited: float, polls: int) -> str:
+    if finished:
+        return f"    Self-test finished after {waited:.0f} s ({polls} checks)"
+    return f"    {Colors.YELLOW}Self-test still running after {waited:.0f} s, reading results anyway{Colors.RESET}"
+
+# ------------------------ read benchmark ------------------------
+
+# Seconds of read benchmark per drive; 0 = off (set by main from --read-bench).
+bench_seconds = 0.0
+
+SEVERITY_RANK = {"PASS": 0, "WARN": 1, "FAIL": 2}
+
+
+def surface_bench(info: DeviceInfo, dtype: Optional[List[str]]) -> Optional[Dict[str, Any]]:
+    """Read benchmark of the drive, plus its SATA link speed (dtype given: smartctl drive)."""
+    if not bench_seconds:
+        return None
+    result = backend.measure(f"read_bench {info.dev} {bench_seconds:g}",
+                             lambda: read_bench.run(info.dev, bench_seconds))
+    if result is not None and dtype is not None and "error" not in result:
+        _, out, _ = run_cmd(["smartctl"] + dtype + ["-i", info.dev])
+        link = read_bench.sata_link(out)
+        if link:
+            result["link"] = link
+    return result
+
+
+def merge_bench(sev: str, why: str, bench: Optional[Dict[str, Any]],
+                rotational: Optional[bool]) -> Tuple[str, str]:
+    """SMART verdict made worse (never better) by the findings of the read benchmark."""
+    if not bench:
+        return sev, why
+    bsev, reasons = read_bench.bench_severity(bench, rotational)
+    if SEVERITY_RANK[bsev] > SEVERITY_RANK[sev]:
+        sev = bsev
+    return sev, " ".join([why] + reasons).strip()
+
+
+def bench_lines(bench: Dict[str, Any], rotational: Optional[bool]) -> List[str]:
+    if "error" in bench:
+        return [f"    {Colors.YELLOW}Read benchmark skipped: {bench['error']}{Colors.RESET}"]
+    seq, rnd = bench["seq"], bench["random"]
+    out = [f"    {Colors.CYAN}Read benchmark ({bench['seconds']:g} s{'' if bench['direct'] else ', cached'}):{Colors.RESET}",
+           f"      Sequential: {seq['mb_s']:.0f} MB/s (zones {seq['min_mb_s']:.0f}-{seq['max_mb_s']:.0f})",
+           f"      Random 4K: {rnd['iops']:.0f} IOPS, p50 {rnd['p50_ms']:.2f} ms, "
+           f"p99 {rnd['p99_ms']:.2f} ms, max {rnd['max_ms']:.0f} ms"]
+    link = bench.get("link")
+    if link:
+        out.append(f"      SATA link: {link['current']:g} Gb/s (max {link['max']:g})")
+    for reason in read_bench.bench_severity(bench, rotational)[1]:
+        out.append(f"      {Colors.YELLOW}•{Colors.RESET} {reason}")
+    return out
+
+# ------------------------ SMART history -------------------------
+
+# smart_history.fetch() result for the drives of this run; empty = no growth check.
+history: Dict[str, Any] = {}
+
+
+def fetch_history(disks: List[DeviceInfo], server: Optional[str]) -> Dict[str, Any]:
+    """
+    Previous snapshots of the drives' serials, in one request. The server is
+    looked up inside the measured call, so a replay only needs the capture.
+    """
+    serials = sorted({d.serial for d in disks if d.serial})
+    if not serials:
+        return {}
+
+    def fetch() -> Dict[str, Any]:
+        url = server or server_from_cmdline(read_cmdline())
+        return smart_history.fetch(url, serials) if url else {}
+    return backend.measure(f"smart_history {','.join(serials)}", fetch) or {}
+
+
+def merge_growth(sev: str, why: str, serial: str, extras: Dict[str, int],
+                 poh: Optional[int]) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    """Verdict made worse (never better) by counters that grew fast since an earlier check."""
+    snaps = history.get("snapshots", {}).get(serial) if serial else None
+    if not snaps:
+        return sev, why, None
+    grown = smart_history.growth(snaps, extras, poh, history["now"])
+    gsev, reasons = smart_history.growth_severity(grown)
+    if SEVERITY_RANK[gsev] > SEVERITY_RANK[sev]:
+        sev = gsev
+    return sev, " ".join([why] + reasons).strip(), grown
+
+
+def growth_lines(grown: Dict[str, Any]) -> List[str]:
+    hours = f", {grown['poh_hours']} h powered on" if grown["poh_hours"] is not None else ""
+    head = f"    {Colors.CYAN}Since the check {grown['since_days']:g} days ago{hours}:{Colors.RESET}"
+    if not grown["deltas"]:
+        return [head + " no counter grew"]
+    out = [head]
+    for key, delta in grown["deltas"].items():
+        out.append(f"      {key} +{delta} ({grown['per_30d'][key]:g} per 30 days)")
+    for reason in smart_history.growth_severity(grown)[1]:
+        out.append(f"      {Colors.YELLOW}•{Colors.RESET} {reason}")
+    return out
+
+# ------------------------ per-device check ----------------------
+
+
+def check_device(info: DeviceInfo) -> Tuple[int, str, Dict[str, Any]]:
+    """
+    Self-test and health report of one drive. Returns (rc, report text,
+    device record for --json-out); the text is printed by the caller so
+    parallel checks never interleave.
+    """
+    lines: List[str] = []
+    say = lines.append
+    rc = 0
+    started = backend.monotonic()
+    sev = "ERROR"
+    why = ""
+    error = ""
+    source = None
+    poh: Optional[int] = None
+    wear: Optional[int] = None
+    extras: Dict[str, int] = {}
+    selftest: Dict[str, Any] = {}
+    grown: Optional[Dict[str, Any]] = None
+
+    n = info.name
+    dev = info.dev
+    say(f"\n{Colors.BOLD}{Colors.CYAN}Device: {dev}{Colors.RESET}")
+    say(
+        f"  Model: {info.model} | Serial: {info.serial or 'N/A'} | Size: {info.size} | Bus: {info.tran or 'N/A'} | Type: {info.kind}")
+
+    is_nvme = n.startswith("nvme")
+    if is_nvme and which_or("nvme"):
+        ctrl = "/dev/" + re.split(r"n\d+", n)[0]
+        say(f"    → Running short self-test on {ctrl}...")
+        # Kick short self-test (code 1)
+        run_cmd(["nvme", "device-self-test", "-s", "1", ctrl])
+        st = nvme_selftest(ctrl)
+        say(selftest_summary(*st))
+        selftest = {"finished": st[0], "waited_s": round(st[1], 1), "polls": st[2]}
+        bench = surface_bench(info, None)
+        health, nvme_e = nvme_health(ctrl)
+
+        if health is not None:
+            cw = health.critical_warning
+            me = health.media_errors
+            ne = health.num_err_log_entries
+            pu = health.percentage_used
+            poh = health.power_on_hours
+            wear = pu
+            source = health.source
+            extras = {"critical_warning": cw, "media_errors": me,
+                      "num_err_log_entries": ne, "percentage_used": pu}
+            sev, why = nvme_severity(health)
+            sev, why, grown = merge_growth(sev, why, info.serial, extras, poh)
+            sev, why = merge_bench(sev, why, bench, info.rotational)
+
+            # Colorize health status
+            if sev == "PASS":
+                health_str = f"{Colors.GREEN}{Colors.BOLD}PASS{Colors.RESET}"
+            elif sev == "WARN":
+                health_str = f"{Colors.YELLOW}{Colors.BOLD}WARN{Colors.RESET}"
             else:
-                print(
-                    f"  Health: {Colors.RED}{Colors.BOLD}ERROR{Colors.RESET}")
-                overall_rc = 1
-                err_head = "\n".join(smart_e.splitlines()[
-                                     :8]) if smart_e else ""
-                if err_head:
-                    print(f"    {Colors.RED}" +
-                          indent(err_head, 4) + Colors.RESET)
+                health_str = f"{Colors.RED}{Colors.BOLD}FAIL{Colors.RESET}"
+
+            say(f"  Health: {health_str}")
+            if sev == "FAIL":
+                rc = 1
+            say(
+                f"    Power-on hours: {poh or 0}  (~{years_from_hours(poh):.2f} years)")
+            say(f"    Wear level: {pu or 0}%")
+
+            # Only show concerning attributes
+            nvme_concerns = []
+            if cw != 0:
+                nvme_concerns.append(f"Critical_Warning={cw} (FAIL if >0)")
+            if me > 0:
+                nvme_concerns.append(f"Media_Errors={me} (FAIL if >0)")
+            if pu >= 90:
+                nvme_concerns.append(
+                    f"Percentage_Used={pu}% (WARN≥90%, FAIL≥100%)")
+            if ne >= 10:
+                nvme_concerns.append(f"Error_Log_Entries={ne} (WARN≥10)")
+
+            if nvme_concerns:
+                say(
+                    f"    {Colors.YELLOW}{Colors.BOLD}CONCERNS:{Colors.RESET}")
+                for concern in nvme_concerns:
+                    say(
+                        f"      {Colors.YELLOW}•{Colors.RESET} {concern}")
+
+            # Self-test log (optional)
+            rcS, stlog, _ = run_cmd(["nvme", "self-test-log", ctrl])
+            if rcS == 0 and stlog.strip():
+                decoded = nvme_decode_selftest_result_block(stlog)
+                for l in decoded:
+                    if "Operation Result" in l:
+                        selftest["result"] = l.split(":", 1)[1].strip()
+                # Only show if there's useful info
+                if decoded and not all("No test recorded" in line for line in decoded):
+                    say(
+                        f"    {Colors.CYAN}Self-test result (most recent):{Colors.RESET}")
+                    for l in decoded:
+                        say(f"    {l}")
+        else:
+            say(
+                f"  Health: {Colors.RED}{Colors.BOLD}ERROR{Colors.RESET}")
+            rc = 1
+            error = nvme_e.strip().split("\n")[0]
+            if nvme_e.strip():
+                say(
+                    f"    {Colors.RED}" + indent("\n".join(nvme_e.splitlines()[:6]), 4) + Colors.RESET)
+
+    else:
+        # SATA/USB/SAS via smartctl
+        say(f"    → Running short self-test on {dev}...")
+        dtype: List[str] = []
+        rcT, sto, ste = run_cmd(["smartctl", "-t", "short", dev])
+        if rcT != 0 and smart_parse.NEEDS_DEVICE_TYPE.search(sto + ste):
+            # Retry with SAT bridge
+            dtype = ["-d", "sat"]
+            rcT, sto, ste = run_cmd(["smartctl"] + dtype + ["-t", "short", dev])
+
+        st = ata_selftest(dev, dtype, sto)
+        say(selftest_summary(*st))
+        selftest = {"finished": st[0], "waited_s": round(st[1], 1), "polls": st[2]}
+        bench = surface_bench(info, dtype)
+
+        # Fetch SMART data (H/A/error/selftest)
+        report, smart_e = smartctl_report(dev, dtype)
+        if not dtype and (not report.has_data or report.needs_device_type):
+            # Only keep the SAT answer when it is better: a drive that answered
+            # (SMART disabled, say) must not turn into an ERROR because -d sat failed.
+            retry, retry_e = smartctl_report(dev, ["-d", "sat"])
+            if retry.has_data or not report.answered:
+                report, smart_e = retry, retry_e
+
+        if report.answered:
+            poh = report.power_on_hours()
+            source = report.source
+            sev, why, extras = ata_verdict(report)
+            ata_err = report.ata_errors
+            latest = next((ln for ln in report.selftest_lines if ln.lstrip().startswith("#")), None)
+            if latest:
+                selftest["result"] = " ".join(latest.split()[2:])  # without "# 1"
+            sev, why, grown = merge_growth(sev, why, info.serial, extras, poh)
+            sev, why = merge_bench(sev, why, bench, info.rotational)
+
+            # Colorize health status
+            if sev == "PASS":
+                health_str = f"{Colors.GREEN}{Colors.BOLD}PASS{Colors.RESET}"
+            elif sev == "WARN":
+                health_str = f"{Colors.YELLOW}{Colors.BOLD}WARN{Colors.RESET}"
+            else:
+                health_str = f"{Colors.RED}{Colors.BOLD}FAIL{Colors.RESET}"
+
+            say(f"  Health: {health_str}")
+            if sev == "FAIL":
+                rc = 1
+            say(
+                f"    Power-on hours: {poh or 0}  (~{years_from_hours(poh):.2f} years)")
+
+            # Only show concerning attributes
+            concerns = []
+            if extras['repunc'] > 0:
+                concerns.append(
+                    f"Reported_Uncorrect={extras['repunc']} (WARN if >0)")
+            if extras['pend'] > 0:
+                concerns.append(
+                    f"Pending_Sectors={extras['pend']} (FAIL if >0)")
+            if extras['offunc'] > 0:
+                concerns.append(
+                    f"Offline_Uncorrectable={extras['offunc']} (FAIL if >0)")
+            if extras['ralloc'] >= 10:
+                concerns.append(
+                    f"Reallocated_Sectors={extras['ralloc']} (WARN≥10, FAIL≥50)")
+            if extras['crc'] >= 10:
+                concerns.append(
+                    f"CRC_Errors={extras['crc']} (WARN≥10, FAIL≥100) {Colors.YELLOW}- CHECK CABLE{Colors.RESET}")
+
+            if concerns:
+                say(
+                    f"    {Colors.YELLOW}{Colors.BOLD}CONCERNS:{Colors.RESET}")
+                for concern in concerns:
+                    say(
+                        f"      {Colors.YELLOW}•{Colors.RESET} {concern}")
+
+            if ata_err >= 5:
+                say(
+                    f"    {Colors.YELLOW}ATA Error Log: {ata_err} errors found (WARN≥5){Colors.RESET}")
+                # Show recent errors (first ~20 lines that match key markers)
+                say(f"    {Colors.RED}Recent ATA errors:{Colors.RESET}")
+                for ln in report.error_lines[:20]:
+                    say(f"      {ln}")
+
+            # Show self-test results only if there's something interesting
+            selftest_lines = report.selftest_lines
+            if selftest_lines and not all("completed without error" in ln.lower() or "of test" in ln
+                                          for ln in selftest_lines):
+                say(f"    {Colors.CYAN}Self-test results:{Colors.RESET}")
+                for ln in selftest_lines[:3]:  # Only show first 3 lines
+                    say(f"      {ln}")
+
+        else:
+            say(
+                f"  Health: {Colors.RED}{Colors.BOLD}ERROR{Colors.RESET}")
+            rc = 1
+            error = smart_e.strip().split("\n")[0]
+            err_head = "\n".join(smart_e.splitlines()[
+                                 :8]) if smart_e else ""
+            if err_head:
+                say(f"    {Colors.RED}" +
+                      indent(err_head, 4) + Colors.RESET)
+
+    if grown:
+        for l in growth_lines(grown):
+            say(l)
+    if bench:
+        for l in bench_lines(bench, info.rotational):
+            say(l)
+
+    record = {"dev": dev, "model": info.model, "serial": info.serial, "size": info.size,
+              "bus": info.tran, "kind": info.kind, "health": sev, "reasons": why.split(),
+              "extras": extras, "power_on_hours": poh, "wear_percent": wear, "selftest": selftest,
+              "source": source, "rc": rc, "duration_s": round(backend.monotonic() - started, 1)}
+    if error:
+        record["error"] = error
+    if grown:
+        record["growth"] = grown
+    if bench:
+        record["read_bench"] = bench
+    return rc, "\n".join(lines), record
+
+
+def verdict_of(record: Dict[str, Any]) -> Dict[str, str]:
+    """The part of a device record a replay must reproduce exactly."""
+    return {"dev": record["dev"], "model": record["model"], "serial": record["serial"],
+            "health": record["health"], "why": " ".join(record["reasons"])}
+
+# ------------------------- JSON report --------------------------
+
+
+class JsonStream:
+    """
+    NDJSON report: an inventory record, one device record per drive as soon as
+    its check ends (completion order, from the worker threads) and a summary.
+    Every line is flushed, so readers can follow the file while drives still test.
+    """
 
+    def __init__(self, f):
+        self._f = f
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: Optional[str], fd: Optional[int]) -> Optional["JsonStream"]:
+        if fd is not None:
+            return cls(os.fdopen(fd, "w", encoding="utf-8"))
+        if path:
+            return cls(open(path, "w", encoding="utf-8"))
+        return None
+
+    def emit(self, record_type: str, fields: Dict[str, Any]) -> None:
+        line = json.dumps(dict({"type": record_type, "ts": round(time.time(), 3)}, **fields),
+                          ensure_ascii=False)
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def inventory_record(devices: List[DeviceInfo]) -> List[Dict[str, Any]]:
+    def one(d: DeviceInfo) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"name": d.name, "type": d.type, "tran": d.tran, "size": d.size,
+                               "model": d.model, "serial": d.serial, "mountpoint": d.mountpoint,
+                               "rotational": d.rotational}
+        if d.children:
+            out["children"] = [one(c) for c in d.children]
+        return out
+    return [one(d) for d in devices if not d.name.startswith(("ram", "loop")) and d.name != "fd0"]
+
+# ---------------------------- main ------------------------------
+
+
+def main() -> int:
+    global backend, bench_seconds, history
+    ap = argparse.ArgumentParser(description="Drive inventory, health and short self-tests")
+    ap.add_argument("--jobs", type=int, default=0,
+                    help="drives tested at the same time (default: all)")
+    ap.add_argument("--sequential", action="store_true",
+                    help="test one drive after the other (same as --jobs 1)")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--record", metavar="FILE",
+                      help="also save every command, output and timing of this run to FILE")
+    mode.add_argument("--replay", metavar="FILE",
+                      help="run from a --record capture instead of the hardware")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="replay N times faster than recorded (0: do not wait at all)")
+    ap.add_argument("--read-bench", action="store_true",
+                    help="also run a read-only surface benchmark on every drive")
+    ap.add_argument("--bench-seconds", type=float, default=60.0,
+                    help="time budget of the read benchmark per drive (default: 60)")
+    ap.add_argument("--history-server", metavar="URL",
+                    help="server with the SMART history (default: from the kernel command line)")
+    ap.add_argument("--no-history", action="store_true",
+                    help="do not compare SMART counters with the previous check")
+    ap.add_argument("--json-out", metavar="FILE",
+                    help="also write the results as NDJSON (one record per drive as it finishes)")
+    ap.add_argument("--json-fd", type=int, metavar="N",
+                    help="like --json-out, to an open file descriptor")
+    args = ap.parse_args()
+
+    if args.read_bench:
+        bench_seconds = max(1.0, args.bench_seconds)
+    if args.record:
+        backend = RecordingBackend()
+    elif args.replay:
+        backend = ReplayBackend.load(args.replay, args.speed)
+    started = time.monotonic()
+    stream = JsonStream.open(args.json_out, args.json_fd)
+
+    overall_rc = 0
+    records: List[Dict[str, Any]] = []
+    error = None
+    try:
+        print()
+        print_line()
+        print(f"{Colors.BOLD}{Colors.CYAN}Disk Inventory:{Colors.RESET}")
+        inv = render_inventory(inventory())
+        if inv:
+            print(inv)
         print_line()
 
+        disks = list_disks()
+        if stream:
+            stream.emit("inventory", {"devices": inventory_record(inventory()),
+                                      "testable": [d.dev for d in disks]})
+        if disks and not args.no_history:
+            history = fetch_history(disks, args.history_server)
+            if "error" in history:
+                print(f"{Colors.DIM}SMART history unavailable: {history['error']}{Colors.RESET}")
+            elif history:
+                print(f"{Colors.DIM}SMART history: {len(history['snapshots'])} of {len(disks)} "
+                      f"drives checked before{Colors.RESET}")
+        if not disks:
+            print(f"{Colors.YELLOW}No disks detected.{Colors.RESET}")
+        else:
+            jobs = 1 if args.sequential else (args.jobs or len(disks))
+            jobs = max(1, min(jobs, len(disks)))
+            if jobs > 1:
+                # The firmware of every drive runs its own test: waiting for them together
+                # takes as long as the slowest drive instead of the sum of all of them.
+                print(f"  Running short self-tests on {len(disks)} drives in parallel...")
+
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(check_device, d) for d in disks]
+                if stream:
+                    for fut in futures:
+                        fut.add_done_callback(
+                            lambda f: f.exception() is None and stream.emit("device", f.result()[2]))
+                # Text reports in disk order, each as soon as it and those before it are done.
+                for fut in futures:
+                    rc, report, record = fut.result()
+                    print(report)
+                    overall_rc = overall_rc or rc
+                    records.append(record)
+                    print_line()
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        # Readers of the stream rely on the summary record, also when a check crashed.
+        if stream:
+            counts = {h: sum(1 for r in records if r["health"] == h) for h in ("PASS", "WARN", "FAIL", "ERROR")}
+            summary = {"drives": len(records), "health": counts, "rc": 1 if error else overall_rc,
+                       "wall_s": round(time.monotonic() - started, 1)}
+            if error:
+                summary["error"] = error
+            stream.emit("summary", summary)
+            stream.close()
+
+    verdicts = [verdict_of(r) for r in records]
+    if isinstance(backend, RecordingBackend):
+        backend.save(args.record, verdicts, sys.argv[1:])
+    elif isinstance(backend, ReplayBackend):
+        return replay_summary(backend, args.replay, verdicts, time.monotonic() - started) or overall_rc
     return overall_rc
 
 
+def replay_summary(replay: ReplayBackend, path: str, verdicts: List[Dict[str, str]], wall_s: float) -> int:
+    """Compare a replay with its recording; prints a REPLAY line (JSON) to stderr, 3 on other verdicts."""
+    recorded = replay.capture.get("verdicts", [])
+    match = verdicts == recorded
+    summary = {"capture": path, "host": replay.capture.get("host"), "drives": len(verdicts),
+               "verdicts_match": match, "missing_commands": len(replay.missing),
+               "wall_s": round(wall_s, 3), "recorded_wall_s": replay.capture.get("wall_s")}
+    if not match:
+        summary.update(recorded_verdicts=recorded, verdicts=verdicts)
+    if replay.missing:
+        summary["missing"] = sorted(set(replay.missing))[:20]
+    print("REPLAY " + json.dumps(summary), file=sys.stderr)
+    return 0 if match else 3
+
+
 if __name__ == "__main__":
     rc = main()
     sys.exit(rc)
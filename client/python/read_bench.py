@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+read_bench.py — read-only surface benchmark of one block device (disk_health.py --read-bench).
+
+Notes:
+- Never writes: the device is opened O_RDONLY, with O_DIRECT so the page
+  cache neither serves nor hides slow reads (plain reads if the device
+  refuses O_DIRECT; the result says so).
+- Buffers are anonymous mmaps (page aligned, as O_DIRECT requires), allocated
+  once per run and filled with os.preadv, so the loop itself allocates nothing.
+- Sequential: the disk is cut into ZONES equal zones; each gets the same
+  share of the time budget, read from its start in 1 MiB requests. The
+  per-zone MB/s is the slow-zone map; HDDs naturally slow down towards the
+  inner zones (about half of the outer speed), so only zones far below the
+  median are flagged.
+- Random: aligned 4 KiB reads at queue depth 1 over the whole disk, for the
+  rest of the budget. IOPS, p50/p99/max and a log-scale latency histogram;
+  reads of a second or more are what firmware retries look like.
+- bench_severity() turns a result into PASS/WARN/FAIL with reasons, merged
+  into the SMART verdict by disk_health.py.
+"""
+
+import os
+import re
+import mmap
+import time
+import random
+from statistics import median
+from typing import Any, Dict, List, Optional, Tuple
+
+ZONES = 16
+SEQ_CHUNK = 1 << 20
+RAND_CHUNK = 4096
+SEQ_SHARE = 0.6          # of the time budget; the rest goes to random reads
+
+# Upper bounds (ms) of the latency histogram buckets; the last one is open.
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Verdict thresholds
+SLOW_READ_MS = 1000          # a single read this slow is a retry, not a seek
+SLOW_READS_FAIL = 5
+SLOW_ZONE_RATIO_HDD = 0.3    # of the median zone speed
+SLOW_ZONE_RATIO_SSD = 0.5
+MIN_SEQ_MB_S_HDD = 30
+MIN_SEQ_MB_S_SSD = 100
+
+_LINK = re.compile(r"SATA Version is:.*?([\d.]+) Gb/s(?: \(current: ([\d.]+) Gb/s\))?")
+
+
+def sata_link(smartctl_i: str) -> Optional[Dict[str, float]]:
+    """Link speeds from `smartctl -i`: 'SATA 3.3, 6.0 Gb/s (current: 1.5 Gb/s)'."""
+    m = _LINK.search(smartctl_i)
+    if not m:
+        return None
+    top = float(m.group(1))
+    return {"max": top, "current": float(m.group(2)) if m.group(2) else top}
+
+
+def _open(dev: str) -> Tuple[int, bool]:
+    flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+    direct = getattr(os, "O_DIRECT", 0)
+    if direct:
+        try:
+            return os.open(dev, flags | direct), True
+        except OSError:
+            pass
+    return os.open(dev, flags), False
+
+
+def _device_size(fd: int) -> int:
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _bucket(ms: float) -> int:
+    for i, top in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= top:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _bucket_labels() -> List[str]:
+    return [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+
+
+def run(dev: str, seconds: float, seed: Optional[int] = None) -> Dict[str, Any]:
+    """Benchmark dev for about `seconds`; never raises (errors end up in the result)."""
+    try:
+        fd, direct = _open(dev)
+    except OSError as e:
+        return {"error": f"open {dev}: {e.strerror or e}"}
+    seq_buf = mmap.mmap(-1, SEQ_CHUNK)
+    rand_buf = mmap.mmap(-1, RAND_CHUNK)
+    errors = 0
+    try:
+        size = _device_size(fd)
+        if size < SEQ_CHUNK * ZONES:
+            return {"error": f"{dev} too small ({size} bytes)"}
+
+        # ---- sequential, zone by zone ----
+        zone_len = (size // ZONES) // SEQ_CHUNK * SEQ_CHUNK
+        zone_time = seconds * SEQ_SHARE / ZONES
+        zones: List[float] = []
+        for z in range(ZONES):
+            offset = z * zone_len
+            end = offset + zone_len
+            done = 0
+            t0 = time.monotonic()
+            deadline = t0 + zone_time
+            while offset < end and time.monotonic() < deadline:
+                try:
+                    n = os.preadv(fd, [seq_buf], offset)
+                except OSError:
+                    errors += 1
+                    n = SEQ_CHUNK  # skip past the bad area
+                if n <= 0:
+                    break
+                offset += n
+                done += n
+            elapsed = time.monotonic() - t0
+            zones.append(round(done / elapsed / 1e6, 1) if elapsed > 0 else 0.0)
+
+        # ---- random 4K, queue depth 1 ----
+        rng = random.Random(seed if seed is not None else size)
+        blocks = size // RAND_CHUNK
+        hist = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        lat: List[float] = []
+        t0 = time.monotonic()
+        deadline = t0 + seconds * (1 - SEQ_SHARE)
+        while True:
+            start = time.monotonic()
+            if start >= deadline:
+                break
+            try:
+                os.preadv(fd, [rand_buf], rng.randrange(blocks) * RAND_CHUNK)
+            except OSError:
+                errors += 1
+            ms = (time.monotonic() - start) * 1000
+            lat.append(ms)
+            hist[_bucket(ms)] += 1
+        rand_s = time.monotonic() - t0
+    finally:
+        os.close(fd)
+        seq_buf.close()
+        rand_buf.close()
+
+    lat.sort()
+
+    def pct(q: float) -> float:
+        return round(lat[min(len(lat) - 1, int(q * len(lat)))], 2) if lat else 0.0
+
+    mid = median(zones) if zones else 0.0
+    return {
+        "direct": direct,
+        "size": size,
+        "seconds": seconds,
+        "read_errors": errors,
+        "seq": {"mb_s": mid, "min_mb_s": min(zones), "max_mb_s": max(zones), "zones": zones},
+        "random": {"reads": len(lat), "iops": round(len(lat) / rand_s, 1) if rand_s > 0 else 0.0,
+                   "p50_ms": pct(0.5), "p99_ms": pct(0.99), "max_ms": round(lat[-1], 2) if lat else 0.0,
+                   "slow_reads": sum(1 for ms in lat if ms >= SLOW_READ_MS),
+                   "histogram": dict(zip(_bucket_labels(), hist))},
+    }
+
+
+def bench_severity(result: Dict[str, Any], rotational: Optional[bool]) -> Tuple[str, List[str]]:
+    """(PASS/WARN/FAIL, reasons) of a run() result; rotational None counts as SSD."""
+    if "error" in result:
+        return "PASS", []
+    sev = "PASS"
+    why: List[str] = []
+
+    def worse(level: str, reason: str) -> None:
+        nonlocal sev
+        if level == "FAIL" or sev == "PASS":
+            sev = level
+        why.append(reason)
+
+    if result["read_errors"]:
+        worse("FAIL", f"read_errors={result['read_errors']}")
+
+    slow = result["random"]["slow_reads"]
+    if slow >= SLOW_READS_FAIL:
+        worse("FAIL", f"slow_reads={slow}(≥{SLOW_READ_MS}ms)")
+    elif slow:
+        worse("WARN", f"slow_reads={slow}(≥{SLOW_READ_MS}ms)")
+
+    seq = result["seq"]
+    ratio = SLOW_ZONE_RATIO_HDD if rotational else SLOW_ZONE_RATIO_SSD
+    slow_zones = [i for i, v in enumerate(seq["zones"]) if v < seq["mb_s"] * ratio]
+    if slow_zones:
+        worse("WARN", f"slow_zones={','.join(map(str, slow_zones))}")
+
+    floor = MIN_SEQ_MB_S_HDD if rotational else MIN_SEQ_MB_S_SSD
+    if seq["mb_s"] < floor:
+        worse("WARN", f"seq_read={seq['mb_s']:.0f}MB/s(<{floor})")
+
+    link = result.get("link")
+    if link and link["current"] < link["max"]:
+        worse("WARN", f"sata_link={link['current']:g}/{link['max']:g}Gb/s")
+    return sev, why
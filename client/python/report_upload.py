@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+report_upload.py — send the diagnostic reports of this machine to the PXE server.
+
+Notes:
+- The reports (/root/diagnostic_report.txt, /root/usb_report.json,
+  /root/disk_report.ndjson) only live in RAM; this bundles them into one JSON
+  document, gzips it into a spool directory and POSTs every spooled file to
+  <server>/results.
+- Per-disk results come from the NDJSON records of disk_health.py --json-out;
+  without them (older overlay, aborted before the disk test) they are read
+  from the text report.
+- A file is removed from the spool only after the server accepted it; failed
+  uploads are retried with exponential backoff (plus jitter, so a room full of
+  machines finishing together does not retry in lockstep) until a deadline.
+- The server address is taken from the kernel command line (apkovl=/modloop=
+  URLs written by boot.ipxe), the MAC from BOOTIF=. Both can be overridden.
+- Only the standard library is used (Alpine ships python3 without extras).
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import uuid
+import random
+import argparse
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+DIAG_REPORT = "/root/diagnostic_report.txt"
+USB_REPORT = "/root/usb_report.json"
+DISK_REPORT = "/root/disk_report.ndjson"
+SPOOL_DIR = "/var/spool/gtpxe"
+
+# --------------------------- helpers ---------------------------
+
+
+def read_cmdline() -> str:
+    try:
+        with open("/proc/cmdline") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def server_from_cmdline(cmdline: str) -> Optional[str]:
+    """http://host[:port] of the server the overlay/modloop came from."""
+    for key in ("apkovl", "modloop", "alpine_repo"):
+        m = re.search(rf"(?:^|\s){key}=(\S+)", cmdline)
+        if m and m.group(1).startswith(("http://", "https://")):
+            u = urlsplit(m.group(1))
+            return f"{u.scheme}://{u.netloc}"
+    return None
+
+
+def mac_from_cmdline(cmdline: str) -> Optional[str]:
+    # BOOTIF=01-aa-bb-cc-dd-ee-ff (01 = Ethernet hardware type)
+    m = re.search(r"(?:^|\s)BOOTIF=01-((?:[0-9a-fA-F]{2}-){5}[0-9a-fA-F]{2})", cmdline)
+    return m.group(1).replace("-", ":").lower() if m else None
+
+
+def first_nic_mac() -> Optional[str]:
+    try:
+        names = sorted(os.listdir("/sys/class/net"))
+    except OSError:
+        return None
+    for name in names:
+        if name == "lo":
+            continue
+        try:
+            with open(f"/sys/class/net/{name}/address") as f:
+                mac = f.read().strip().lower()
+        except OSError:
+            continue
+        if mac and mac != "00:00:00:00:00:00":
+            return mac
+    return None
+
+
+def read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, "r", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_json(path: str) -> Optional[Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_ndjson(path: str) -> Optional[List[Dict[str, Any]]]:
+    """Records of an NDJSON file; a torn last line (run aborted mid-write) is skipped."""
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    records = []
+    for line in lines:
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(rec, dict):
+            records.append(rec)
+    return records
+
+
+def disks_from_records(records: List[Dict[str, Any]]) -> List[Dict[str, Optional[str]]]:
+    """Per-disk summary from the device records of disk_health.py --json-out."""
+    return [{"device": r.get("dev"), "serial": r.get("serial") or None, "model": r.get("model") or None,
+             "size": r.get("size") or None, "bus": r.get("bus") or None, "health": r.get("health"),
+             "why": " ".join(r.get("reasons") or ()) or None}
+            for r in records if r.get("type") == "device"]
+
+
+DEVICE_RE = re.compile(r"^Device: (/dev/\S+)")
+INFO_RE = re.compile(r"^\s*Model: (.*?) \| Serial: (.*?) \| Size: (.*?) \| Bus: (.*?) \| Type: (.*)$")
+HEALTH_RE = re.compile(r"^\s*Health: (\w+)")
+
+
+def disks_from_report(text: str) -> List[Dict[str, Optional[str]]]:
+    """Per-disk summary from the disk_health.py section of the (color-stripped) report."""
+    disks: List[Dict[str, Optional[str]]] = []
+    cur: Optional[Dict[str, Optional[str]]] = None
+    for line in text.splitlines():
+        m = DEVICE_RE.match(line)
+        if m:
+            cur = {"device": m.group(1), "serial": None, "model": None, "size": None,
+                   "bus": None, "health": None}
+            disks.append(cur)
+            continue
+        if cur is None:
+            continue
+        m = INFO_RE.match(line)
+        if m:
+            model, serial, size, bus, _ = (v.strip() for v in m.groups())
+            cur["model"] = model or None
+            cur["serial"] = serial if serial and serial != "N/A" else None
+            cur["size"] = size or None
+            cur["bus"] = bus if bus and bus != "N/A" else None
+            continue
+        m = HEALTH_RE.match(line)
+        if m and cur["health"] is None:
+            cur["health"] = m.group(1)
+    return disks
+
+# ---------------------------- spool -----------------------------
+
+
+def build_document(mac: str, verdict: str, reasons: List[str]) -> Dict[str, Any]:
+    report = read_text(DIAG_REPORT)
+    disk_records = read_ndjson(DISK_REPORT)
+    disks = disks_from_records(disk_records or [])
+    return {
+        "upload_id": uuid.uuid4().hex,
+        "mac": mac,
+        "verdict": verdict,
+        "reason": reasons,
+        "finished": time.time(),
+        "hostname": os.uname().nodename,
+        "kernel": os.uname().release,
+        "report": report,
+        "disks": disks or disks_from_report(report or ""),
+        "disk_report": disk_records,
+        "usb_report": read_json(USB_REPORT),
+    }
+
+
+def spool(doc: Dict[str, Any], spool_dir: str) -> str:
+    os.makedirs(spool_dir, exist_ok=True)
+    name = f"{int(doc['finished'])}-{doc['upload_id']}.json.gz"
+    tmp = os.path.join(spool_dir, "." + name)
+    with gzip.open(tmp, "wb", compresslevel=6) as f:
+        f.write(json.dumps(doc, separators=(",", ":")).encode())
+    final = os.path.join(spool_dir, name)
+    os.replace(tmp, final)
+    return final
+
+
+def post(server: str, path: str, timeout: float) -> Optional[float]:
+    """
+    POST one spooled file. Returns None on success, otherwise the number of
+    seconds the server asked us to wait (0 when it did not say).
+    Raises ValueError when the server rejected the document for good.
+    """
+    with open(path, "rb") as f:
+        body = f.read()
+    req = urllib.request.Request(
+        server.rstrip("/") + "/results", data=body, method="POST",
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip",
+                 "Content-Length": str(len(body))})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+        return None
+    except urllib.error.HTTPError as e:
+        if e.code in (400, 413, 415):
+            raise ValueError(f"server rejected {os.path.basename(path)}: HTTP {e.code}")
+        retry_after = e.headers.get("Retry-After", "0") if e.headers else "0"
+        return float(retry_after) if retry_after.isdigit() else 0.0
+    except (urllib.error.URLError, OSError):
+        return 0.0
+
+
+def drain(server: str, spool_dir: str, deadline: float, timeout: float = 30.0) -> int:
+    """Upload everything in the spool until done or the deadline passes. Returns files left."""
+    delay = 1.0
+    while True:
+        try:
+            pending = sorted(fn for fn in os.listdir(spool_dir)
+                             if fn.endswith(".json.gz") and not fn.startswith("."))
+        except OSError:
+            return 0
+        if not pending:
+            return 0
+        wait = None
+        for fn in pending:
+            path = os.path.join(spool_dir, fn)
+            try:
+                wait = post(server, path, timeout)
+            except ValueError as e:
+                print(f"[upload] {e}; dropping it", file=sys.stderr)
+                os.replace(path, path + ".rejected")
+                continue
+            if wait is not None:
+                break
+            os.unlink(path)
+            print(f"[upload] sent {fn}")
+            delay = 1.0
+        if wait is None:
+            continue
+        sleep = max(wait, delay) * random.uniform(0.8, 1.2)
+        if time.time() + sleep > deadline:
+            return len(pending)
+        print(f"[upload] server not reachable, retrying in {sleep:.0f}s", file=sys.stderr)
+        time.sleep(sleep)
+        delay = min(delay * 2, 60.0)
+
+# ---------------------------- main ------------------------------
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Upload diagnostic reports to the PXE server")
+    ap.add_argument("--verdict", choices=("pass", "fail", "aborted"), default="pass")
+    ap.add_argument("--reason", action="append", default=[],
+                    help="failed test (repeatable)")
+    ap.add_argument("--server", default=os.environ.get("GTPXE_SERVER"),
+                    help="http://host of the PXE server (default: from /proc/cmdline)")
+    ap.add_argument("--mac", default=None, help="MAC address (default: BOOTIF= or first NIC)")
+    ap.add_argument("--spool", default=SPOOL_DIR)
+    ap.add_argument("--deadline", type=float, default=120.0,
+                    help="give up retrying after this many seconds (files stay spooled)")
+    ap.add_argument("--retry-only", action="store_true",
+                    help="only send what is already spooled")
+    args = ap.parse_args()
+
+    cmdline = read_cmdline()
+    server = args.server or server_from_cmdline(cmdline)
+    if not args.retry_only:
+        mac = args.mac or mac_from_cmdline(cmdline) or first_nic_mac() or "unknown"
+        path = spool(build_document(mac, args.verdict, args.reason), args.spool)
+        print(f"[upload] report spooled to {path}")
+    if not server:
+        print("[upload] no server address (pass --server); report stays spooled",
+              file=sys.stderr)
+        return 1
+
+    left = drain(server, args.spool, time.time() + args.deadline)
+    if left:
+        print(f"[upload] {left} report(s) not sent yet, kept in {args.spool}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
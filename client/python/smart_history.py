@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+smart_history.py — SMART counter growth of a drive since its previous check (by serial).
+
+Notes:
+- The PXE server keeps a few counters per disk serial from every uploaded
+  disk report (reallocated, pending, offline-uncorrectable and CRC counts,
+  NVMe media errors and wear, power-on hours), stamped with the time the
+  server received them. fetch() gets the newest HISTORY_DEPTH snapshots of
+  all drives of this machine, and the server's clock, in one GET
+  /api/smart_history at startup; no server, no snapshot or a slow answer
+  just means no growth check.
+- Both ends of the window come from the server's clock: refurbished machines
+  often boot with a dead CMOS battery and a clock that is years off.
+- growth() compares a drive's counters with the newest snapshot at least
+  BASELINE_DAYS old (else the oldest one there is): the increase of each
+  counter and its rate per 30 days (at least one day, so a check repeated
+  the same afternoon does not divide by minutes). A drive checked every day
+  is judged on the growth over several days, not on one day's small step.
+- growth_severity() escalates on counters that grow fast, even when their
+  absolute value is still below the thresholds of smart_severity(): 40 new
+  reallocated sectors in a week FAIL although 41 in total would only WARN.
+- A snapshot with more power-on hours than the drive has now is not from this
+  drive (duplicate or placeholder serial) and is ignored; so are counters
+  that went down (firmware reset, different reporting).
+- Standard library only; disk_health.py imports it.
+"""
+
+import json
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+COUNTERS = ("ralloc", "pend", "offunc", "crc", "media_errors", "percentage_used")
+
+FETCH_TIMEOUT_S = 5.0
+HISTORY_DEPTH = 20          # snapshots fetched per serial
+BASELINE_DAYS = 3.0
+MIN_WINDOW_DAYS = 1.0
+
+# counter: (minimum increase, WARN and FAIL at this increase per 30 days; None = never)
+GROWTH_LIMITS: Dict[str, Tuple[int, float, Optional[float]]] = {
+    "ralloc": (5, 5, 20),
+    "crc": (10, 10, 50),
+    "pend": (1, 1, 1),
+    "offunc": (1, 1, 1),
+    "media_errors": (1, 1, 1),
+    "percentage_used": (2, 3, None),
+}
+
+
+def fetch(server: str, serials: List[str], timeout: float = FETCH_TIMEOUT_S) -> Dict[str, Any]:
+    """
+    Newest snapshots per serial from the server: {"now": the server's unix
+    time, "snapshots": {serial: [snapshot, ...] newest first}, "error": "..."
+    on failure}. Never raises.
+    """
+    out: Dict[str, Any] = {"now": round(time.time(), 3), "snapshots": {}}
+    query = urlencode({"serial": ",".join(serials), "limit": HISTORY_DEPTH})
+    url = f"{server.rstrip('/')}/api/smart_history?{query}"
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            doc = json.loads(resp.read().decode("utf-8"))
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        out["error"] = str(getattr(e, "reason", None) or e)
+        return out
+    if isinstance(doc.get("now"), (int, float)):
+        out["now"] = doc["now"]
+    for serial, snaps in (doc.get("history") or {}).items():
+        if snaps:
+            out["snapshots"][serial] = snaps
+    return out
+
+
+def baseline(snaps: List[Dict[str, Any]], poh: Optional[int], now: float) -> Optional[Dict[str, Any]]:
+    """
+    The snapshot to compare with: the newest at least BASELINE_DAYS old, else
+    the oldest. Snapshots with more power-on hours than the drive has now are
+    not from this drive and are skipped.
+    """
+    usable = [s for s in snaps
+              if poh is None or s.get("poh") is None or s["poh"] <= poh]
+    for snap in usable:
+        if now - snap["ts"] >= BASELINE_DAYS * 86400:
+            return snap
+    return usable[-1] if usable else None
+
+
+def growth(snaps: List[Dict[str, Any]], extras: Dict[str, int], poh: Optional[int],
+           now: float) -> Optional[Dict[str, Any]]:
+    """Counter increases since baseline() of snaps (newest first); None when none is comparable."""
+    prev = baseline(snaps, poh, now)
+    if prev is None:
+        return None
+    days = max(0.0, (now - prev["ts"]) / 86400)
+    window = max(days, MIN_WINDOW_DAYS)
+    deltas: Dict[str, int] = {}
+    per_30d: Dict[str, float] = {}
+    for key in COUNTERS:
+        if key in extras and prev.get(key) is not None and extras[key] > prev[key]:
+            deltas[key] = extras[key] - prev[key]
+            per_30d[key] = round(deltas[key] * 30 / window, 1)
+    return {"since_days": round(days, 1), "snapshots": len(snaps),
+            "poh_hours": poh - prev["poh"] if poh is not None and prev.get("poh") is not None else None,
+            "previous": {k: prev.get(k) for k in ("ts", "poh") + COUNTERS if prev.get(k) is not None},
+            "deltas": deltas, "per_30d": per_30d}
+
+
+def growth_severity(g: Optional[Dict[str, Any]]) -> Tuple[str, List[str]]:
+    """(PASS/WARN/FAIL, reasons) of a growth() result."""
+    sev = "PASS"
+    why: List[str] = []
+    if not g:
+        return sev, why
+    for key, delta in g["deltas"].items():
+        min_delta, warn, fail = GROWTH_LIMITS[key]
+        rate = g["per_30d"][key]
+        if delta < min_delta or rate < warn:
+            continue
+        reason = f"{key}+{delta}/{g['since_days']:g}d"
+        if fail is not None and rate >= fail:
+            sev = "FAIL"
+            why.append(f"{reason}(≥{fail:g}/30d)")
+        else:
+            if sev == "PASS":
+                sev = "WARN"
+            why.append(f"{reason}(≥{warn:g}/30d)")
+    return sev, why
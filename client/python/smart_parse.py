@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+smart_parse.py — parsers for smartctl (ATA/SATA, USB-SAT) and nvme-cli health output.
+
+Notes:
+- JSON first: `smartctl --json` (smartmontools >= 7.0) and `nvme smart-log -o
+  json` are parsed with json.loads and read by key. Output that is not JSON
+  (older tools, BusyBox builds without JSON support) goes through the text
+  parsers, which give the same results.
+- The text parsers are table driven: every pattern is compiled once at import,
+  the attribute table is matched line by line with a single regex, and NVMe
+  fields are picked out by one alternation over the keys we use instead of
+  splitting every line.
+- ATA attributes are indexed by ID (raw value) plus a name -> ID map, so a
+  lookup is one dict access and names that differ between vendors (e.g. 187
+  Reported_Uncorrect vs Uncorrectable_Error_Cnt) are found by their ID.
+- Raw values are normalised the same way for both sources: the first integer
+  of the raw string, or the hours/minutes/seconds of '497h+18m+30s'.
+- Standard library only; disk_health.py and the parse benchmark
+  (client/bench/bench_smart_parse.py) import it.
+"""
+
+import re
+import json
+from typing import Dict, List, Optional, Tuple
+
+# ATA attribute IDs used for the health verdict
+REALLOCATED = 5
+POWER_ON = 9
+REPORTED_UNCORRECT = 187
+PENDING = 197
+OFFLINE_UNCORRECTABLE = 198
+CRC_ERRORS = 199
+
+# smartctl could not talk to the drive through its USB bridge without -d sat
+NEEDS_DEVICE_TYPE = re.compile(r"Unknown USB bridge|please specify device type", re.I)
+
+# ------------------------- raw values ---------------------------
+
+_HMS = re.compile(r"(\d+)h\+(\d+)m\+(\d+)(?:\.\d+)?s")
+_FIRST_INT = re.compile(r"\d+")
+
+
+def raw_to_int(raw: str) -> int:
+    """'44 (Min/Max 10/65)' -> 44, '497h+18m+30s' -> seconds, '' -> 0."""
+    m = _HMS.match(raw)
+    if m:
+        return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3))
+    m = _FIRST_INT.search(raw)
+    return int(m.group()) if m else 0
+
+
+# --------------------------- ATA/SATA ---------------------------
+
+
+class AtaReport:
+    """Parsed `smartctl -H -A -l error -l selftest` of one drive."""
+
+    __slots__ = ("source", "answered", "health_known", "health_failed", "raw_by_id", "id_by_name",
+                 "raw_strings", "ata_errors", "error_lines", "selftest_lines", "messages")
+
+    def __init__(self, source: str):
+        self.source = source                  # "json" or "text"
+        self.answered = False                 # smartctl printed anything at all
+        self.health_known = False             # overall health was reported (SAS: no attributes)
+        self.health_failed = False
+        self.raw_by_id: Dict[int, int] = {}
+        self.id_by_name: Dict[str, int] = {}
+        self.raw_strings: Dict[int, str] = {}
+        self.ata_errors = 0                   # ATA error log count
+        self.error_lines: List[str] = []      # most recent logged errors
+        self.selftest_lines: List[str] = []   # execution status + latest log entry
+        self.messages: List[str] = []         # smartctl's own complaints
+
+    @property
+    def has_data(self) -> bool:
+        """Attributes or an overall health were found (worth retrying with -d sat if not)."""
+        return bool(self.raw_by_id) or self.health_known
+
+    @property
+    def needs_device_type(self) -> bool:
+        return any(NEEDS_DEVICE_TYPE.search(m) for m in self.messages)
+
+    def raw(self, attr_id: int) -> int:
+        return self.raw_by_id.get(attr_id, 0)
+
+    def power_on_hours(self) -> int:
+        """Attribute 9 in hours, whatever unit the vendor counts in."""
+        if POWER_ON not in self.raw_by_id:
+            return 0
+        val = self.raw_by_id[POWER_ON]
+        if _HMS.match(self.raw_strings.get(POWER_ON, "")):
+            return val // 3600
+        name = next((k for k, v in self.id_by_name.items() if v == POWER_ON), "")
+        if "Seconds" in name:
+            return val // 3600
+        if "Half_Minutes" in name:
+            return val // 120
+        if "Minutes" in name:
+            return val // 60
+        return val
+
+    def _add(self, attr_id: int, name: str, raw: str) -> None:
+        self.raw_by_id[attr_id] = raw_to_int(raw)
+        self.id_by_name[name] = attr_id
+        self.raw_strings[attr_id] = raw
+
+
+# ID# ATTRIBUTE_NAME FLAG VALUE WORST THRESH TYPE UPDATED WHEN_FAILED RAW_VALUE
+_ATTR_ROW = re.compile(
+    r"^\s*(\d{1,3})\s+(\S+)\s+0x[0-9a-fA-F]+\s+\d+\s+\d+\s+\S+\s+\S+\s+\S+\s+\S+\s+(.+?)\s*$", re.M)
+_ATTR_END = re.compile(r"^(?:SMART|General SMART Values)", re.M)
+_ATA_ERR_COUNT = re.compile(r"ATA Error Count\s*:\s*(\d+)")
+_ERR_LINE = re.compile(r"Error (?:\d+ occurred|: )")
+
+# Literal markers, located with str.find: much cheaper than regex alternations
+# ('^.*(?:a|b).*$'), which Python retries at every position of the text.
+ATTR_TABLE_MARK = "Vendor Specific SMART Attributes"
+HEALTH_MARKS = ("overall-health self-assessment test result:", "SMART Health Status:")
+SELFTEST_MARKS = ("Self-test execution status", "# 1 ")
+MESSAGE_MARKS = ("Unknown USB bridge", "Please specify device type", "please specify device type",
+                 "Smartctl open device", "Read Device Identity failed")
+
+
+def _line_at(text: str, pos: int) -> Tuple[int, int]:
+    """(start, end) of the line containing pos."""
+    end = text.find("\n", pos)
+    return text.rfind("\n", 0, pos) + 1, end if end >= 0 else len(text)
+
+
+def _lines_with(text: str, marks: Tuple[str, ...]) -> List[str]:
+    """Lines of text containing any of marks, in text order, each once."""
+    spans = set()
+    for mark in marks:
+        pos = text.find(mark)
+        while pos >= 0:
+            start, end = _line_at(text, pos)
+            spans.add((start, end))
+            pos = text.find(mark, end)
+    return [text[a:b] for a, b in sorted(spans)]
+
+
+def parse_ata_text(text: str) -> AtaReport:
+    r = AtaReport("text")
+    r.answered = bool(text.strip())
+    for mark in HEALTH_MARKS:
+        pos = text.find(mark)
+        if pos >= 0:
+            r.health_known = True
+            r.health_failed = "FAILED" in text[pos + len(mark):_line_at(text, pos)[1]].upper()
+            break
+
+    pos = text.find(ATTR_TABLE_MARK)
+    if pos >= 0:
+        start = _line_at(text, pos)[1]
+        end = _ATTR_END.search(text, start)
+        for attr_id, name, raw in _ATTR_ROW.findall(text, start, end.start() if end else len(text)):
+            r._add(int(attr_id), name, raw)
+
+    m = _ATA_ERR_COUNT.search(text)
+    r.ata_errors = int(m.group(1)) if m else 0
+    if r.ata_errors:
+        # "Error 23 occurred at ..." and "Error: ..." at the start of a line
+        r.error_lines = [ln for ln in _lines_with(text, ("Error ",)) if _ERR_LINE.match(ln)]
+    r.selftest_lines = _lines_with(text, SELFTEST_MARKS)
+    r.messages = [ln.strip() for ln in _lines_with(text, MESSAGE_MARKS)]
+    return r
+
+
+def parse_ata_json(doc: Dict) -> AtaReport:
+    r = AtaReport("json")
+    r.answered = True
+    status = doc.get("smart_status") or {}
+    r.health_known = "passed" in status
+    r.health_failed = status.get("passed") is False
+
+    for row in (doc.get("ata_smart_attributes") or {}).get("table") or ():
+        raw = row.get("raw") or {}
+        r._add(int(row.get("id", 0)), str(row.get("name", "")), str(raw.get("string", raw.get("value", ""))))
+
+    errlog = (doc.get("ata_smart_error_log") or {}).get("summary") or {}
+    r.ata_errors = int(errlog.get("count") or 0)
+    for e in errlog.get("table") or ():
+        line = (f"Error {e.get('error_number', '?')} occurred at disk power-on lifetime: "
+                f"{e.get('lifetime_hours', '?')} hours")
+        if e.get("error_description"):
+            line += f" ({e['error_description']})"
+        r.error_lines.append(line)
+
+    execution = ((doc.get("ata_smart_data") or {}).get("self_test") or {}).get("status") or {}
+    if execution.get("string"):
+        r.selftest_lines.append(f"Self-test execution status: {execution['string']}")
+    tests = ((doc.get("ata_smart_self_test_log") or {}).get("standard") or {}).get("table") or ()
+    if tests:
+        t = tests[0]
+        r.selftest_lines.append(
+            f"# 1  {(t.get('type') or {}).get('string', '?'):<18} "
+            f"{(t.get('status') or {}).get('string', '?'):<30} {t.get('lifetime_hours', '?')}")
+
+    for msg in (doc.get("smartctl") or {}).get("messages") or ():
+        if msg.get("string"):
+            r.messages.append(msg["string"])
+    return r
+
+
+def parse_ata(output: str) -> AtaReport:
+    """smartctl output, JSON (from --json) or text."""
+    doc = _json_object(output)
+    return parse_ata_json(doc) if doc is not None else parse_ata_text(output)
+
+# ----------------------------- NVMe -----------------------------
+
+
+NVME_FIELDS = ("critical_warning", "media_errors", "num_err_log_entries",
+               "percentage_used", "power_on_hours")
+
+# nvme-cli spells some keys differently between versions and output formats
+_NVME_ALIASES = {"percent_used": "percentage_used"}
+
+
+class NvmeHealth:
+    """The fields of `nvme smart-log` the health verdict uses (missing -> 0)."""
+
+    __slots__ = ("source",) + NVME_FIELDS
+
+    def __init__(self, source: str):
+        self.source = source
+        for f in NVME_FIELDS:
+            setattr(self, f, 0)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {f: getattr(self, f) for f in NVME_FIELDS}
+
+
+_NVME_ROW = re.compile(
+    r"^(critical_warning|media_errors|num_err_log_entries|percentage_used|percent_used|power_on_hours)"
+    r"\s*:\s*(0x[0-9a-fA-F]+|[\d,]+)", re.M | re.I)
+
+
+def parse_nvme_text(text: str) -> NvmeHealth:
+    h = NvmeHealth("text")
+    for key, val in _NVME_ROW.findall(text):
+        key = key.lower()
+        setattr(h, _NVME_ALIASES.get(key, key), int(val.replace(",", ""), 0))
+    return h
+
+
+def parse_nvme_json(doc: Dict) -> NvmeHealth:
+    h = NvmeHealth("json")
+    for key, val in doc.items():
+        key = _NVME_ALIASES.get(key, key)
+        if key in NVME_FIELDS:
+            if isinstance(val, dict):   # nvme-cli 2.x with --verbose nests {"value": ...}
+                val = val.get("value", 0)
+            try:
+                setattr(h, key, int(val, 0) if isinstance(val, str) else int(val))
+            except (TypeError, ValueError):
+                pass
+    return h
+
+
+def parse_nvme(output: str) -> NvmeHealth:
+    """`nvme smart-log` output, JSON (-o json) or text."""
+    doc = _json_object(output)
+    return parse_nvme_json(doc) if doc is not None else parse_nvme_text(output)
+
+
+def _json_object(output: str) -> Optional[Dict]:
+    if not output.lstrip().startswith("{"):
+        return None
+    try:
+        doc = json.loads(output)
+    except ValueError:
+        return None
+    return doc if isinstance(doc, dict) else None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+admission.py — cap concurrent large downloads across all pxe_http workers.
+
+Notes:
+- A transfer slot is an flock()ed file <dir>/slot-<n>. Locks belong to the
+  open file, so they work between gunicorn workers, between threads of one
+  worker and in the single-process async mode alike, and a crashed worker's
+  slots are freed by the kernel.
+- The last `late_reserved` slots are only handed to late-stage artifacts: the
+  modloop and the apkovl overlays, both fetched by the initramfs once the
+  kernel is already running. A machine that is nearly done is not stuck
+  behind a room full of machines asking for their first initramfs, so more
+  machines reach the diagnostics sooner.
+- Only downloads of at least PXE_LARGE_TRANSFER_MB come here (pxe_http
+  decides by size). /bootstage and the boot scripts never do; an overlay
+  does when it is that large (localhost/base.apkovl carry the APK cache
+  and binaries), while the small split delta normally does not.
+- Waiting for a slot holds a request thread, so at most `max_waiters` requests
+  of a worker wait at once; further ones get no slot at once (the caller
+  serves them over the cap). The app threads are never all asleep here, and
+  /bootstage and the boot scripts keep being answered while the slots are full.
+"""
+
+import os
+import time
+import fcntl
+import random
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger("pxe_http.admission")
+
+# Artifacts fetched by the initramfs after the kernel booted; when large enough
+# to need a slot, they may use the reserved ones.
+LATE_STAGE = ("modloop", "apkovl")
+
+
+def is_late_stage(relpath: str) -> bool:
+    name = relpath.rsplit("/", 1)[-1]
+    return any(key in name for key in LATE_STAGE)
+
+
+class Slot:
+    def __init__(self, fd: int, index: int):
+        self.fd = fd
+        self.index = index
+
+    def release(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)  # closing drops the flock
+            self.fd = -1
+
+
+class TransferScheduler:
+    def __init__(self, directory, slots: int, late_reserved: int = 0, max_waiters: int = 4):
+        self.dir = str(directory)
+        self.slots = max(0, slots)
+        self.late_reserved = min(max(0, late_reserved), max(0, self.slots - 1))
+        self.max_waiters = max(0, max_waiters)
+        self._waiters = 0
+        self._waiters_lock = threading.Lock()
+        if self.slots:
+            os.makedirs(self.dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.slots > 0
+
+    def try_acquire(self, late: bool = False) -> Optional[Slot]:
+        """A free slot, or None without blocking."""
+        usable = self.slots if late else self.slots - self.late_reserved
+        # Start at a random slot so workers do not all contend for slot 0.
+        first = random.randrange(usable)
+        for k in range(usable):
+            i = (first + k) % usable
+            fd = os.open(os.path.join(self.dir, f"slot-{i}"), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return Slot(fd, i)
+        return None
+
+    def waiting(self) -> int:
+        return self._waiters
+
+    def acquire(self, late: bool = False, timeout: float = 30.0) -> Optional[Slot]:
+        """
+        Wait up to timeout seconds for a slot; None if none became free, and
+        None at once when max_waiters requests of this process already wait.
+        """
+        with self._waiters_lock:
+            if self._waiters >= self.max_waiters:
+                return None
+            self._waiters += 1
+        try:
+            deadline = time.monotonic() + timeout
+            delay = 0.05
+            while True:
+                slot = self.try_acquire(late)
+                if slot is not None:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+                delay = min(delay * 2, 0.5)
+        finally:
+            with self._waiters_lock:
+                self._waiters -= 1
+
+
+def retry_after(base: int) -> int:
+    """Jittered Retry-After in seconds, so deferred clients do not return in lockstep."""
+    return random.randint(max(1, base), max(1, base) * 2)
@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+"""
+artifacts.py — helpers for serving boot artifacts (kernel, initramfs, modloop, apkovl).
+
+Notes:
+- Framework agnostic: pxe_http wires these into Flask routes.
+- Bodies are handed to the server as real files so gunicorn can use sendfile()
+  (zero-copy). The file position and Content-Length select the byte range.
+- ArtifactCache keeps the boot files mapped and resident in RAM, so a boot
+  storm is served from the page cache instead of SD card reads.
+- HashManifest gives every file version a SHA-256 (strong ETag, immutable
+  /a/<digest>/... URL) and gzip/zstd variants for text files. Hashes are
+  computed once per version in the background and persisted.
+- Files matching `retain` (the split overlays) keep every hashed version
+  readable under its digest (a hard link in the variants dir) for `grace_s`
+  after it was replaced, so a URL rendered into a boot script just before a
+  rebuild still serves the version the script was rendered with.
+"""
+
+import io
+import os
+import re
+import gzip
+import json
+import mmap
+import fcntl
+import hashlib
+import time
+import queue
+import fnmatch
+import logging
+import mimetypes
+import pathlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional: gzip variants only
+    zstandard = None
+
+logger = logging.getLogger("pxe_http.artifacts")
+
+# Guards the per-process (re)initialisation after a gunicorn fork.
+_start_lock = threading.Lock()
+
+READ_CHUNK = 256 * 1024
+PAGE = mmap.PAGESIZE
+
+# Files worth keeping in RAM: everything iPXE and the Alpine initramfs fetch.
+CACHE_PATTERNS = ("alpine/boot/*/*", "mt86plus.efi")
+
+# Text-like files that are worth serving precompressed. Kernels, initramfs,
+# modloops, apks and overlays are compressed already.
+COMPRESSIBLE_SUFFIXES = (".ipxe", ".json", ".txt", ".cfg", ".conf", ".sh",
+                         ".html", ".csv", ".ndjson", ".list")
+COMPRESS_MAX_BYTES = 16 * 1024 * 1024
+# Preferred first when the client accepts several.
+ENCODINGS = (("zstd", ".zst"), ("gzip", ".gz"))
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def resolve(static_dir: pathlib.Path, relpath: str) -> Optional[pathlib.Path]:
+    """Map a URL path to a regular file below static_dir, or None (missing or escaping)."""
+    base = static_dir.resolve()
+    try:
+        path = (base / relpath.lstrip("/")).resolve()
+    except (OSError, RuntimeError):
+        return None
+    if path != base and base not in path.parents:
+        return None
+    return path if path.is_file() else None
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range 'Range: bytes=a-b' header into an inclusive (start, end).
+    Returns None when the whole file should be sent (no header, or a form we
+    do not support such as multiple ranges). Raises RangeNotSatisfiable.
+    """
+    if not header:
+        return None
+    m = _RANGE_RE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.group(1), m.group(2)
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes.
+        n = int(last)
+        if n == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - n), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def content_type(path: pathlib.Path) -> str:
+    ctype, _ = mimetypes.guess_type(path.name)
+    return ctype or "application/octet-stream"
+
+
+class TrackedFile(io.FileIO):
+    """Unbuffered file that runs callbacks once closed, i.e. after the server has sent it."""
+
+    def __init__(self, path):
+        super().__init__(str(path), "rb")
+        self.on_close: List[Callable[[], None]] = []
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        for fn in self.on_close:
+            try:
+                fn()
+            except Exception:
+                pass
+
+
+def iter_range(f: TrackedFile, length: int, chunk: int = READ_CHUNK) -> Iterator[bytes]:
+    """Yield length bytes from the current position, then close f."""
+    try:
+        while length > 0:
+            data = f.read(min(chunk, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def open_body(path: pathlib.Path, start: int, length: int, size: int,
+              file_wrapper=None):
+    """
+    Open path positioned at start and return (file, body iterable).
+
+    With a WSGI file_wrapper the server streams until EOF (gunicorn stops at
+    Content-Length and uses sendfile), so it is only used when the range runs
+    to the end of the file. Other ranges use a bounded read loop.
+    """
+    f = TrackedFile(path)
+    if start:
+        f.seek(start)
+    # Larger readahead for whatever is not already in the page cache.
+    os.posix_fadvise(f.fileno(), start, length, os.POSIX_FADV_SEQUENTIAL)
+    if file_wrapper is not None and start + length == size:
+        return f, file_wrapper(f, READ_CHUNK)
+    return f, iter_range(f, length)
+
+
+# Every boot fetches kernel and initramfs; modloop and overlay only when
+# booting Alpine; memtest only on its day.
+_WARM_ORDER = ("vmlinuz", "initramfs", "apkovl", "modloop")
+
+
+def _warm_priority(relpath: str) -> int:
+    name = relpath.rsplit("/", 1)[-1]
+    for i, key in enumerate(_WARM_ORDER):
+        if key in name:
+            return i
+    return len(_WARM_ORDER)
+
+
+def signature(st: os.stat_result) -> Tuple[int, int, int, int]:
+    """Identity of one version of a file; changes when it is replaced or rewritten."""
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class _Mapped:
+    __slots__ = ("sig", "size", "mm")
+
+    def __init__(self, sig, size, mm):
+        self.sig = sig
+        self.size = size
+        self.mm = mm
+
+
+class ArtifactCache:
+    """
+    Keeps boot artifacts memory-mapped and their pages resident.
+
+    The mappings are MAP_SHARED, so every worker maps the same physical pages:
+    whichever worker loads a file first reads it from disk, the others find it
+    in RAM. Mapped pages are also the last the kernel reclaims. The mapping is
+    never read directly: bodies go out from a file descriptor (sendfile reads
+    the same page cache), so a file replaced while mapped cannot crash a worker.
+
+    Entries are keyed by path relative to static_dir and dropped when the
+    file's inode/size/mtime changes. Over budget, the least recently served
+    entry is unmapped first.
+    """
+
+    def __init__(self, static_dir: pathlib.Path, budget_bytes: int,
+                 patterns=CACHE_PATTERNS, recheck_interval: float = 30.0):
+        self.static_dir = pathlib.Path(static_dir)
+        self.budget = budget_bytes
+        self.patterns = patterns
+        self.recheck_interval = recheck_interval
+        self._pid = None
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._entries: "OrderedDict[str, _Mapped]" = OrderedDict()
+            self.used = 0
+            self._todo: "queue.Queue[Tuple[str, os.stat_result]]" = queue.Queue()
+            threading.Thread(target=self._warm_loop, name="artifact-warmer",
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def cacheable(self, relpath: str) -> bool:
+        return any(fnmatch.fnmatch(relpath, p) for p in self.patterns)
+
+    def index(self) -> List[Tuple[str, os.stat_result]]:
+        """All cacheable files below static_dir as (relpath, stat)."""
+        out = []
+        for pattern in self.patterns:
+            for path in sorted(self.static_dir.glob(pattern)):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                if path.is_file():
+                    out.append((path.relative_to(self.static_dir).as_posix(), st))
+        return out
+
+    def prewarm(self) -> None:
+        """
+        Queue indexed artifacts for loading (done by the warmer thread), most
+        requested first, as many as fit in the budget.
+        """
+        if not self.enabled():
+            return
+        self._ensure_started()
+        total = 0
+        for relpath, st in sorted(self.index(), key=lambda e: _warm_priority(e[0])):
+            if total + st.st_size > self.budget:
+                continue
+            total += st.st_size
+            self._todo.put((relpath, st))
+
+    def lookup(self, relpath: str, st: os.stat_result) -> bool:
+        """
+        Note that relpath (with stat st) is about to be served. Returns True if
+        it is resident. Misses and stale entries are (re)loaded in the background.
+        """
+        if not self.enabled() or not self.cacheable(relpath):
+            return False
+        self._ensure_started()
+        with self._lock:
+            entry = self._entries.get(relpath)
+            if entry is not None and entry.sig == signature(st):
+                self._entries.move_to_end(relpath)
+                return True
+        self._todo.put((relpath, st))
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        if not self.enabled():
+            return {"entries": 0, "bytes": 0, "budget": 0}
+        self._ensure_started()
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.used, "budget": self.budget}
+
+    # ------------------------- internals -------------------------
+
+    def _warm_loop(self) -> None:
+        next_check = time.monotonic() + self.recheck_interval
+        while True:
+            try:
+                relpath, st = self._todo.get(timeout=max(0.1, next_check - time.monotonic()))
+                self._load(relpath, st)
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + self.recheck_interval
+                self._recheck()
+
+    def _recheck(self) -> None:
+        # Picks up redeployed files (new inode or mtime) and re-touches pages
+        # the kernel may have reclaimed.
+        with self._lock:
+            current = list(self._entries.items())
+        for relpath, entry in current:
+            try:
+                st = (self.static_dir / relpath).stat()
+            except OSError:
+                self._drop(relpath)
+                continue
+            if signature(st) != entry.sig:
+                self._load(relpath, st)
+            else:
+                try:
+                    self._touch(self.static_dir / relpath, entry.size, full=False)
+                except OSError:
+                    pass
+
+    def _drop(self, relpath: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(relpath, None)
+            if entry is not None:
+                self.used -= entry.size
+        if entry is not None:
+            entry.mm.close()
+
+    @staticmethod
+    def _touch(path: pathlib.Path, size: int, full: bool) -> None:
+        # Warm through read()/readahead, never by dereferencing the mapping:
+        # touching a mapped page past EOF of a truncated file raises SIGBUS.
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            if full:
+                buf = bytearray(1024 * 1024)
+                off = 0
+                while off < size:
+                    n = os.preadv(fd, [buf], off)
+                    if n <= 0:
+                        break
+                    off += n
+        finally:
+            os.close(fd)
+
+    def _load(self, relpath: str, st: os.stat_result) -> None:
+        sig = signature(st)
+        with self._lock:
+            entry = self._entries.get(relpath)
+            if entry is not None and entry.sig == sig:
+                return
+        self._drop(relpath)
+        size = st.st_size
+        if size == 0 or size > self.budget:
+            return
+
+        # Evict least recently served entries until the new one fits.
+        while True:
+            with self._lock:
+                if self.used + size <= self.budget or not self._entries:
+                    break
+                victim = next(iter(self._entries))
+            logger.info(f"Artifact cache evicting {victim}")
+            self._drop(victim)
+
+        path = self.static_dir / relpath
+        try:
+            with open(path, "rb") as f:
+                if signature(os.fstat(f.fileno())) != sig:
+                    return  # replaced since it was queued; the next lookup re-queues it
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            mm.madvise(mmap.MADV_WILLNEED)
+            self._touch(path, size, full=True)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Artifact cache could not load {relpath}: {e}")
+            return
+        with self._lock:
+            self._entries[relpath] = _Mapped(sig, size, mm)
+            self.used += size
+        logger.info(f"Artifact cache loaded {relpath} ({size // 1024} KiB, "
+                    f"{self.used // (1024 * 1024)}/{self.budget // (1024 * 1024)} MiB used)")
+
+
+# ---------------------- content hashes ----------------------
+
+
+def pick_encoding(accept: Optional[str], available) -> Optional[str]:
+    """Choose a content-coding from an Accept-Encoding header, or None for identity."""
+    if not accept or not available:
+        return None
+    accepted = {}
+    for part in accept.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    for name, _ in ENCODINGS:
+        q = accepted[name] if name in accepted else accepted.get("*", 0.0)
+        if name in available and q > 0:
+            return name
+    return None
+
+
+class ManifestEntry:
+    __slots__ = ("sig", "sha256", "variants")
+
+    def __init__(self, sig, sha256, variants):
+        self.sig = sig
+        self.sha256 = sha256
+        self.variants = variants    # encoding -> compressed size
+
+    @property
+    def token(self) -> str:
+        """Short form of the digest used in ETags and immutable URLs."""
+        return self.sha256[:32]
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        return f'"{self.token}-{encoding}"' if encoding else f'"{self.token}"'
+
+
+class HashManifest:
+    """
+    Content hashes of files below static_dir, persisted as JSON.
+
+    A file is only hashed when its (dev, inode, size, mtime) signature is new;
+    unchanged files keep their digest across restarts. Hashing and compression
+    run on a background thread, one worker at a time (flock), and the result
+    is shared with the other workers through the manifest file.
+    """
+
+    def __init__(self, static_dir: pathlib.Path, manifest_path: pathlib.Path,
+                 variants_dir: pathlib.Path, preload_patterns=CACHE_PATTERNS,
+                 retain=(), grace_s: float = 3600.0):
+        self.static_dir = pathlib.Path(static_dir)
+        self.path = pathlib.Path(manifest_path)
+        self.variants_dir = pathlib.Path(variants_dir)
+        self.preload_patterns = preload_patterns
+        self.retain = tuple(retain)
+        self.grace_s = grace_s
+        self._pid = None
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._entries: Dict[str, ManifestEntry] = {}
+            # relpath -> [{"sha256", "sig", "until"}]: replaced versions still served
+            self._retired: Dict[str, List[Dict]] = {}
+            self._loaded_mtime = None
+            self._pending = set()
+            self._todo: "queue.Queue[str]" = queue.Queue()
+            self._reload()
+            threading.Thread(target=self._hash_loop, name="artifact-hasher",
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def rebuild(self) -> None:
+        """Queue the boot artifacts so their hashes are ready before the first client."""
+        self._ensure_started()
+        for pattern in self.preload_patterns:
+            for path in sorted(self.static_dir.glob(pattern)):
+                if path.is_file():
+                    self._queue(path.relative_to(self.static_dir).as_posix())
+
+    def lookup(self, relpath: str, st: os.stat_result) -> Optional[ManifestEntry]:
+        """
+        Entry for the current version of relpath, or None if it is not hashed
+        yet (it is then queued). Never hashes itself: requests do not wait for
+        a digest, and never for the manifest lock the hasher holds.
+        """
+        self._ensure_started()
+        sig = list(signature(st))
+        self._reload()
+        with self._lock:
+            entry = self._entries.get(relpath)
+        if entry is not None and entry.sig == sig:
+            return entry
+        self._queue(relpath)
+        return None
+
+    def retained(self, relpath: str, token: str) -> Optional[Tuple[pathlib.Path, ManifestEntry]]:
+        """
+        (kept copy, entry) of an earlier version of relpath whose token is
+        `token`: the last hashed version (the file may have been replaced since)
+        or one replaced less than grace_s ago. None when there is no such copy.
+        """
+        self._ensure_started()
+        if not self._retains(relpath):
+            return None
+        self._reload()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(relpath)
+            versions = [(entry.sha256, entry.sig)] if entry is not None else []
+            versions += [(v["sha256"], v["sig"]) for v in self._retired.get(relpath, ())
+                         if v["until"] > now]
+        for sha, sig in versions:
+            if sha[:32] != token:
+                continue
+            copy = self.variants_dir / sha
+            try:
+                st = copy.stat()
+            except FileNotFoundError:
+                return None
+            # Same size and mtime as the version that was hashed (see _keep()).
+            if [st.st_size, st.st_mtime_ns] != sig[2:]:
+                return None
+            return copy, ManifestEntry(sig, sha, {})
+        return None
+
+    def variant_path(self, entry: ManifestEntry, encoding: str) -> pathlib.Path:
+        ext = dict(ENCODINGS)[encoding]
+        return self.variants_dir / (entry.sha256 + ext)
+
+    def snapshot(self) -> Dict[str, ManifestEntry]:
+        self._ensure_started()
+        self._reload()
+        with self._lock:
+            return dict(self._entries)
+
+    # ------------------------- internals -------------------------
+
+    def _retains(self, relpath: str) -> bool:
+        return any(fnmatch.fnmatch(relpath, p) for p in self.retain)
+
+    def _queue(self, relpath: str) -> None:
+        with self._lock:
+            if relpath in self._pending:
+                return
+            self._pending.add(relpath)
+        self._todo.put(relpath)
+
+    def _reload(self) -> None:
+        # Another worker may have hashed something; the file mtime tells us.
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._loaded_mtime:
+            return
+        try:
+            raw = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {self.path}: {e}")
+            return
+        entries = {rel: ManifestEntry(e["sig"], e["sha256"], e.get("variants", {}))
+                   for rel, e in raw.get("files", {}).items()}
+        with self._lock:
+            self._entries = entries
+            self._retired = raw.get("retired", {})
+            self._loaded_mtime = mtime
+
+    def _save(self) -> None:
+        with self._lock:
+            files = {rel: {"sig": e.sig, "sha256": e.sha256, "variants": e.variants}
+                     for rel, e in sorted(self._entries.items())}
+            retired = {rel: v for rel, v in sorted(self._retired.items()) if v}
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"version": 1, "files": files, "retired": retired},
+                                  separators=(",", ":")))
+        os.replace(tmp, self.path)
+        self._loaded_mtime = self.path.stat().st_mtime_ns
+
+    def _hash_loop(self) -> None:
+        while True:
+            relpath = self._todo.get()
+            try:
+                self._update(relpath)
+            except Exception as e:
+                logger.warning(f"Hashing {relpath} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(relpath)
+
+    def _update(self, relpath: str) -> Optional[ManifestEntry]:
+        path = self.static_dir / relpath
+        self.variants_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._reload()
+            try:
+                f = open(path, "rb")
+            except OSError:
+                return None
+            with f:
+                st = os.fstat(f.fileno())
+                sig = list(signature(st))
+                with self._lock:
+                    entry = self._entries.get(relpath)
+                if entry is not None and entry.sig == sig:
+                    return entry
+                t0 = time.monotonic()
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                    digest.update(chunk)
+                sha = digest.hexdigest()
+                variants = self._compress(path, sha, st.st_size)
+                if self._retains(relpath):
+                    self._keep(path, f, sha, sig)
+            if list(signature(os.stat(path))) != sig:
+                return None  # changed while hashing; queued again on the next request
+            entry = ManifestEntry(sig, sha, variants)
+            with self._lock:
+                old = self._entries.get(relpath)
+                if old is not None and old.sha256 != sha and self._retains(relpath):
+                    self._retired.setdefault(relpath, []).append(
+                        {"sha256": old.sha256, "sig": old.sig, "until": time.time() + self.grace_s})
+                self._entries[relpath] = entry
+            self._collect_garbage()
+            self._save()
+        logger.info(f"Hashed {relpath} ({st.st_size // 1024} KiB) in "
+                    f"{(time.monotonic() - t0) * 1000:.0f} ms: {sha[:16]}")
+        return entry
+
+    def _keep(self, path: pathlib.Path, f, sha: str, sig: List[int]) -> None:
+        """Keep this version readable as variants_dir/<sha> (hard link, else a copy of f)."""
+        target = self.variants_dir / sha
+        if target.exists():
+            return
+        tmp = target.with_name(target.name + ".tmp")
+        try:
+            os.link(path, tmp)
+            st = os.stat(tmp)
+            if [st.st_ino, st.st_size, st.st_mtime_ns] != sig[1:]:
+                os.unlink(tmp)  # replaced between hashing and linking
+                return
+        except OSError:
+            # Another filesystem: copy the version that was hashed, with its mtime.
+            f.seek(0)
+            with open(tmp, "wb") as out:
+                for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                    out.write(chunk)
+            os.utime(tmp, ns=(sig[3], sig[3]))
+        os.replace(tmp, target)
+
+    def _compress(self, path: pathlib.Path, sha: str, size: int) -> Dict[str, int]:
+        if not path.name.endswith(COMPRESSIBLE_SUFFIXES) or size > COMPRESS_MAX_BYTES:
+            return {}
+        data = path.read_bytes()
+        out = {}
+        for encoding, ext in ENCODINGS:
+            if encoding == "zstd":
+                if zstandard is None:
+                    continue
+                packed = zstandard.ZstdCompressor(level=19).compress(data)
+            else:
+                packed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(packed) >= size:
+                continue  # not worth it
+            target = self.variants_dir / (sha + ext)
+            tmp = target.with_name(target.name + ".tmp")
+            tmp.write_bytes(packed)
+            os.replace(tmp, target)
+            out[encoding] = len(packed)
+        return out
+
+    def _collect_garbage(self) -> None:
+        # Forget deleted files and remove variants nothing refers to any more.
+        now = time.time()
+        with self._lock:
+            for rel in [r for r in self._entries if not (self.static_dir / r).is_file()]:
+                del self._entries[rel]
+            for rel, versions in list(self._retired.items()):
+                self._retired[rel] = [v for v in versions if v["until"] > now]
+            live = {e.sha256 for rel, e in self._entries.items()
+                    if e.variants or self._retains(rel)}
+            live |= {v["sha256"] for versions in self._retired.values() for v in versions}
+        for p in self.variants_dir.iterdir():
+            if p.name.split(".", 1)[0] not in live and not p.name.endswith(".tmp"):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
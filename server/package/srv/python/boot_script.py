@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+boot_script.py — per-client iPXE scripts rendered from templates (GET /boot.ipxe).
+
+Notes:
+- Templates live in /srv/ipxe and use @{name} placeholders, so iPXE's own
+  ${var} syntax passes through untouched.
+- A rendered script depends only on (template, arch, fw, target, server), so
+  it is rendered once per combination and then served from a dict.
+- The cache is dropped when a template file changes (checked at most once per
+  check_interval), so editing a template needs no restart.
+"""
+
+import os
+import time
+import string
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("pxe_http.boot_script")
+
+MAX_CACHED = 256  # the Host header is client controlled; keep the cache bounded
+
+
+class IpxeTemplate(string.Template):
+    delimiter = "@"
+
+
+class ScriptRenderer:
+    def __init__(self, template_dir, check_interval: float = 1.0):
+        self.dir = str(template_dir)
+        self.check_interval = check_interval
+        self._templates: Dict[str, Tuple[Tuple, IpxeTemplate]] = {}
+        self._rendered: Dict[Tuple, str] = {}
+        self._checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _template(self, name: str) -> Tuple[Tuple, IpxeTemplate]:
+        """(signature, compiled template), reloaded when the file changed."""
+        now = time.monotonic()
+        cached = self._templates.get(name)
+        if cached is not None and now < self._checked.get(name, 0.0):
+            return cached
+        path = os.path.join(self.dir, name)
+        st = os.stat(path)
+        sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            self._checked[name] = now + self.check_interval
+            cached = self._templates.get(name)
+            if cached is None or cached[0] != sig:
+                with open(path) as f:
+                    template = IpxeTemplate(f.read())
+                self._templates[name] = (sig, template)
+                self._rendered = {k: v for k, v in self._rendered.items() if k[0] != name}
+                if cached is not None:
+                    logger.info(f"Template {path} changed, cached scripts dropped")
+                return sig, template
+            return cached
+
+    def render(self, name: str, **values: str) -> str:
+        """Render template name with values (all of them form the cache key)."""
+        sig, template = self._template(name)
+        # The signature is part of the key: a render of an older version is never served.
+        key = (name, sig) + tuple(sorted(values.items()))
+        text = self._rendered.get(key)
+        if text is None:
+            text = template.substitute(values)
+            with self._lock:
+                if len(self._rendered) >= MAX_CACHED:
+                    self._rendered.clear()
+                self._rendered[key] = text
+        return text
+
+    def cached(self) -> int:
+        return len(self._rendered)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+boot_timeline.py — boot sessions and per-phase durations from the pxe_http log.
+
+Notes:
+- One pass over JSON-lines logs (plain or .gz, any size). Memory is bounded:
+  open sessions are capped and closed after `idle` seconds of log time, and
+  durations go into fixed log-scale histograms instead of lists.
+- A session starts with /bootstage or /boot.ipxe (which carry the MAC) and
+  collects the following requests of that machine. Artifact downloads carry
+  no MAC, so they are matched through the client address last seen with it.
+- Records are written when a response finishes; start = ts - ms.
+- Phases (seconds):
+    decision     session start -> vmlinuz requested (menu, policy, retries)
+    vmlinuz      vmlinuz transfer
+    initramfs    initramfs transfer
+    kernel_boot  initramfs done -> first apkovl/modloop request
+    apkovl       apkovl transfer
+    modloop      modloop transfer
+    diagnostics  last apkovl/modloop done -> result upload (POST /results)
+    total        session start -> result upload
+- Imported by pxe_http for GET /timeline (LiveTimeline tails the current log).
+
+Usage:
+  python3 boot_timeline.py /srv/pxe_http.log.5 ... /srv/pxe_http.log [--sessions out.ndjson]
+"""
+
+import os
+import sys
+import gzip
+import json
+import math
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, TextIO
+
+PHASES = ("decision", "vmlinuz", "initramfs", "kernel_boot", "apkovl", "modloop",
+          "diagnostics", "total")
+ARTIFACT_KEYS = ("vmlinuz", "initramfs", "modloop", "apkovl")
+
+# Log-scale buckets: 1 ms * 1.05^k, about 2.5% resolution, up to ~2 days.
+_BASE = 0.001
+_FACTOR = 1.05
+_NBUCKETS = 400
+
+
+class Distribution:
+    """Count, sum, max and approximate percentiles in constant memory."""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _NBUCKETS
+
+    def add(self, value: float) -> None:
+        value = max(value, 0.0)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        i = 0 if value <= _BASE else int(math.log(value / _BASE, _FACTOR)) + 1
+        self.buckets[min(i, _NBUCKETS - 1)] += 1
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = math.ceil(p / 100.0 * self.count)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(_BASE * _FACTOR ** i, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_s": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_s": round(self.percentile(50), 3),
+            "p90_s": round(self.percentile(90), 3),
+            "p99_s": round(self.percentile(99), 3),
+            "max_s": round(self.max, 3),
+        }
+
+
+class Session:
+    __slots__ = ("mac", "remote", "start", "last", "target", "marks", "deferred", "result")
+
+    def __init__(self, mac: str, remote: Optional[str], start: float, target: Optional[str]):
+        self.mac = mac
+        self.remote = remote
+        self.start = start
+        self.last = start
+        self.target = target
+        self.marks: Dict[str, List[float]] = {}   # artifact -> [first start, last end]
+        self.deferred = 0
+        self.result: Optional[float] = None
+
+    def mark(self, key: str, start: float, end: float) -> None:
+        m = self.marks.get(key)
+        if m is None:
+            self.marks[key] = [start, end]
+        else:
+            m[0] = min(m[0], start)
+            m[1] = max(m[1], end)
+        self.last = max(self.last, end)
+
+    def phases(self) -> Dict[str, float]:
+        m = self.marks
+        out: Dict[str, float] = {}
+        if "vmlinuz" in m:
+            out["decision"] = m["vmlinuz"][0] - self.start
+        for key in ARTIFACT_KEYS:
+            if key in m:
+                out[key] = m[key][1] - m[key][0]
+        late = [m[k] for k in ("apkovl", "modloop") if k in m]
+        if "initramfs" in m and late:
+            out["kernel_boot"] = min(x[0] for x in late) - m["initramfs"][1]
+        if self.result is not None:
+            if late:
+                out["diagnostics"] = self.result - max(x[1] for x in late)
+            out["total"] = self.result - self.start
+        return out
+
+    def kind(self) -> str:
+        if "memtest" in self.marks:
+            return "memtest"
+        if self.result is not None:
+            return "complete"
+        return "incomplete"
+
+    def as_dict(self) -> Dict:
+        return {
+            "mac": self.mac,
+            "remote": self.remote,
+            "start": datetime.fromtimestamp(self.start).isoformat(timespec="milliseconds"),
+            "kind": self.kind(),
+            "target": self.target,
+            "deferred": self.deferred,
+            "phases": {k: round(v, 3) for k, v in self.phases().items()},
+        }
+
+
+def classify(path: str, method: str, status: int) -> Optional[str]:
+    """Which session event a request is (None: not part of a boot)."""
+    if path in ("/bootstage", "/boot.ipxe"):
+        return "start"
+    if path == "/results":
+        return "result" if method == "POST" and status < 300 else None
+    name = path.rsplit("/", 1)[-1]
+    if name.startswith("mt86plus"):
+        return "memtest"
+    for key in ARTIFACT_KEYS:
+        if key in name:
+            return key
+    return None
+
+
+def parse_ts(ts: str) -> float:
+    return datetime.fromisoformat(ts).timestamp()
+
+
+class TimelineAnalyzer:
+    def __init__(self, idle: float = 7200.0, max_open: int = 20000, max_remotes: int = 65536,
+                 on_close=None):
+        self.idle = idle
+        self.max_open = max_open
+        self.max_remotes = max_remotes
+        self.on_close = on_close
+        self.open: "OrderedDict[str, Session]" = OrderedDict()   # mac -> session, by activity
+        self.remotes: "OrderedDict[str, str]" = OrderedDict()    # remote -> mac, LRU
+        self.dist = {p: Distribution() for p in PHASES}
+        self.kinds: Dict[str, int] = {}
+        self.records = 0
+        self.bad_lines = 0
+        self._now = 0.0
+
+    # ------------------------- input -------------------------
+
+    def feed_line(self, line: str) -> None:
+        # Cheap filter before json.loads: most lines of a big log are requests anyway,
+        # but warnings and other events are skipped without parsing.
+        if '"event":"request"' not in line:
+            return
+        try:
+            rec = json.loads(line)
+            end = parse_ts(rec["ts"])
+        except (ValueError, KeyError, TypeError):
+            self.bad_lines += 1
+            return
+        self.feed(rec, end)
+
+    def feed(self, rec: Dict, end: float) -> None:
+        self.records += 1
+        status = rec.get("status") or 0
+        event = classify(rec.get("path") or "", rec.get("method") or "", status)
+        if event is None:
+            return
+        start = end - (rec.get("ms") or 0) / 1000.0
+        remote = rec.get("remote")
+        mac = rec.get("mac")
+        if end > self._now:
+            self._now = end
+            if self.records % 4096 == 0:
+                self._expire()
+
+        if event == "start":
+            if not mac or status >= 400:
+                return
+            self._remember(remote, mac)
+            old = self.open.pop(mac, None)
+            if old is not None:
+                self._close(old)
+            self.open[mac] = Session(mac, remote, start, rec.get("target"))
+            if len(self.open) > self.max_open:
+                self._close(self.open.popitem(last=False)[1])
+            return
+
+        if not mac and remote:
+            mac = self.remotes.get(remote)
+        session = self.open.get(mac) if mac else None
+        if session is None:
+            return
+        self.open.move_to_end(mac)
+        if event == "result":
+            self._remember(remote, mac)
+            session.result = end
+            self._close(self.open.pop(mac))
+        elif status == 503:
+            session.deferred += 1
+        elif status < 400:
+            session.mark(event, start, end)
+
+    def _remember(self, remote: Optional[str], mac: str) -> None:
+        if not remote:
+            return
+        self.remotes[remote] = mac
+        self.remotes.move_to_end(remote)
+        if len(self.remotes) > self.max_remotes:
+            self.remotes.popitem(last=False)
+
+    def _expire(self) -> None:
+        cutoff = self._now - self.idle
+        while self.open:
+            mac, session = next(iter(self.open.items()))
+            if session.last >= cutoff:
+                break
+            self.open.popitem(last=False)
+            self._close(session)
+
+    def _close(self, session: Session) -> None:
+        kind = session.kind()
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        for phase, value in session.phases().items():
+            self.dist[phase].add(value)
+        if self.on_close is not None:
+            self.on_close(session)
+
+    def finish(self) -> None:
+        """Close every open session (end of input)."""
+        while self.open:
+            self._close(self.open.popitem(last=False)[1])
+
+    # ------------------------- output ------------------------
+
+    def summary(self) -> Dict:
+        phases = {p: d.summary() for p, d in self.dist.items() if d.count}
+        parts = {p: d.total / d.count for p, d in self.dist.items()
+                 if d.count and p != "total"}
+        dominant = max(parts, key=parts.get) if parts else None
+        return {
+            "records": self.records,
+            "bad_lines": self.bad_lines,
+            "sessions": dict(self.kinds),
+            "open_sessions": len(self.open),
+            "phases": phases,
+            "dominant_phase": dominant,
+        }
+
+
+def open_log(path: str) -> TextIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, "r", errors="replace")
+
+
+def analyze(paths: Iterable[str], analyzer: TimelineAnalyzer) -> TimelineAnalyzer:
+    for path in paths:
+        with (sys.stdin if path == "-" else open_log(path)) as f:
+            for line in f:
+                analyzer.feed_line(line)
+    analyzer.finish()
+    return analyzer
+
+
+class LiveTimeline:
+    """Tails the current log incrementally for GET /timeline (one instance per worker)."""
+
+    def __init__(self, log_file, idle: float = 7200.0):
+        self.path = str(log_file)
+        self.analyzer = TimelineAnalyzer(idle=idle)
+        self._inode: Optional[int] = None
+        self._offset = 0
+        self._partial = b""
+        self._lock = threading.Lock()
+
+    def update(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        """Feed what was appended since the last call (follows rotation)."""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._inode, self._offset, self._partial = st.st_ino, 0, b""
+            if st.st_size == self._offset:
+                return
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = self._partial + f.read(max_bytes)
+                self._offset = f.tell()
+            lines = data.split(b"\n")
+            self._partial = lines.pop()   # a record still being written
+            for line in lines:
+                self.analyzer.feed_line(line.decode("utf-8", "replace"))
+
+    def snapshot(self, recent: int = 0) -> Dict:
+        self.update()
+        with self._lock:
+            out = self.analyzer.summary()
+            if recent:
+                out["open"] = [s.as_dict() for s in list(self.analyzer.open.values())[-recent:]]
+        return out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Boot session phases from pxe_http JSON logs")
+    ap.add_argument("logs", nargs="+", help="log files, oldest first (.gz ok, - for stdin)")
+    ap.add_argument("--sessions", help="also write one JSON line per session here")
+    ap.add_argument("--idle", type=float, default=7200.0,
+                    help="close a session after this many seconds without requests")
+    args = ap.parse_args()
+
+    out = open(args.sessions, "w") if args.sessions else None
+
+    def emit(session: Session) -> None:
+        out.write(json.dumps(session.as_dict(), separators=(",", ":")) + "\n")
+
+    analyzer = TimelineAnalyzer(idle=args.idle, on_close=emit if out else None)
+    try:
+        analyze(args.logs, analyzer)
+    finally:
+        if out:
+            out.close()
+    print(json.dumps(analyzer.summary(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
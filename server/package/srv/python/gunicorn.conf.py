@@ -0,0 +1,26 @@
+# gunicorn settings for pxe_http (see conf/pxe-http.service).
+#
+# Threaded workers: a slow client pulling a 30 MB initramfs ties up one thread,
+# not a whole worker, so /bootstage and other small requests keep getting
+# served while dozens of machines download at once. Bodies go out with
+# sendfile(), so a transfer costs almost no CPU in the worker.
+import os
+
+bind = os.environ.get("PXE_HTTP_BIND", "0.0.0.0:80")
+workers = int(os.environ.get("PXE_HTTP_WORKERS", "4"))
+worker_class = "gthread"
+threads = int(os.environ.get("PXE_HTTP_THREADS", "32"))
+# Open client connections per worker (in transfer or keep-alive).
+worker_connections = int(os.environ.get("PXE_HTTP_CONNECTIONS", "256"))
+keepalive = 5
+sendfile = True
+# Worker heartbeat timeout; does not limit how long a download may take.
+timeout = 60
+
+
+def on_starting(server):
+    # Metric files of the previous run would otherwise be summed in forever.
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import metrics
+    metrics.reset_dir(os.environ.get("PXE_METRICS_DIR", "/dev/shm/pxe_http_metrics"))
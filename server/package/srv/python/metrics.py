@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+metrics.py — Prometheus text-format metrics for pxe_http, across gunicorn workers.
+
+Notes:
+- Request threads only add to a per-thread array of floats: no locks, no
+  syscalls. Locking happens once per new series or new thread.
+- Once a second (and before every scrape) each worker folds its thread arrays
+  into a memory-mapped file <dir>/<pid>.bin; the series names go to
+  <dir>/<pid>.keys. /metrics sums the files of all workers.
+- Counters and histograms from exited workers keep counting (totals never go
+  backwards); gauges only count live workers.
+- The last slot is reserved: updates to series beyond the capacity are
+  counted there as pxe_http_metrics_overflow_total{overflow="true"} instead
+  of being added to some other series.
+"""
+
+import os
+import mmap
+import time
+import array
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("pxe_http.metrics")
+
+# Guards the per-process (re)initialisation after a gunicorn fork.
+_start_lock = threading.Lock()
+
+CAPACITY = 8192             # series slots per worker
+OVERFLOW = CAPACITY - 1     # reserved: counts updates of series that did not fit
+OVERFLOW_METRIC = "pxe_http_metrics_overflow_total"
+FLUSH_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+def _labels(names: Tuple[str, ...], values: Iterable[str]) -> str:
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{n}="{v}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, registry: "Registry", name: str, help: str,
+                 labels: Tuple[str, ...] = (), agg: str = "sum"):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.agg = agg
+        self._series: Dict[Tuple, int] = {}
+        registry.register(self)
+
+    def _slot(self, suffix: str, labelvalues: Tuple, extra: str = "") -> int:
+        key = (suffix, labelvalues, extra)
+        slot = self._series.get(key)
+        if slot is None:
+            lbl = _labels(self.labelnames, labelvalues)
+            if extra:
+                lbl = lbl[:-1] + "," + extra + "}" if lbl else "{" + extra + "}"
+            slot = self.registry.slot(self.name + suffix + lbl)
+            self._series[key] = slot
+        return slot
+
+    def _values(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        self.registry.add(self._slot("", self._values(labels)), amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        self.registry.add(self._slot("", self._values(labels)), amount)
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.registry.add(self._slot("", self._values(labels)), -amount)
+
+    def set(self, value: float, **labels) -> None:
+        self.registry.set(self._slot("", self._values(labels)), value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        lv = self._values(labels)
+        reg = self.registry
+        # Buckets are stored cumulatively, so a scrape is a plain sum.
+        for i in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+            reg.add(self._slot("_bucket", lv, f'le="{_fmt(self.buckets[i])}"'), 1.0)
+        reg.add(self._slot("_sum", lv), value)
+        reg.add(self._slot("_count", lv), 1.0)
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+
+class Registry:
+    def __init__(self, directory):
+        self.dir = str(directory)
+        self.metrics: Dict[str, Metric] = {}
+        self._pid = None
+        self.counter(OVERFLOW_METRIC, f"Updates dropped because a worker had more than "
+                     f"{OVERFLOW} series", ("overflow",))
+
+    # ----------------------- definitions ------------------------
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return Counter(self, name, help, labels)
+
+    def gauge(self, name, help, labels=(), agg="sum") -> Gauge:
+        return Gauge(self, name, help, labels, agg)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return Histogram(self, name, help, labels, buckets)
+
+    # ----------------------- worker state -----------------------
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._keys: Dict[str, int] = {}
+            self._shards: List[array.array] = []
+            self._absolute: Dict[int, float] = {}
+            self._tls = threading.local()
+            for m in self.metrics.values():
+                m._series = {}
+            os.makedirs(self.dir, exist_ok=True)
+            base = os.path.join(self.dir, str(os.getpid()))
+            self._keys_file = open(base + ".keys", "w")
+            self._keys_file.write(f'{OVERFLOW}\t{OVERFLOW_METRIC}{{overflow="true"}}\n')
+            self._keys_file.flush()
+            with open(base + ".bin", "wb") as f:
+                f.truncate(CAPACITY * 8)
+            with open(base + ".bin", "r+b") as f:
+                self._mm = mmap.mmap(f.fileno(), CAPACITY * 8)
+            threading.Thread(target=self._flush_loop, name="metrics-flush",
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def slot(self, key: str) -> int:
+        self._ensure_started()
+        with self._lock:
+            idx = self._keys.get(key)
+            if idx is None:
+                if len(self._keys) >= OVERFLOW:
+                    logger.warning(f"Metrics capacity reached, dropping series {key}")
+                    return OVERFLOW
+                idx = len(self._keys)
+                self._keys[key] = idx
+                self._keys_file.write(f"{idx}\t{key}\n")
+                self._keys_file.flush()
+            return idx
+
+    def _shard(self) -> array.array:
+        shard = getattr(self._tls, "shard", None)
+        if shard is None:
+            shard = array.array("d", bytes(CAPACITY * 8))
+            with self._lock:
+                self._shards.append(shard)
+            self._tls.shard = shard
+        return shard
+
+    def add(self, idx: int, amount: float) -> None:
+        self._ensure_started()
+        self._shard()[idx] += 1.0 if idx == OVERFLOW else amount
+
+    def set(self, idx: int, value: float) -> None:
+        self._ensure_started()
+        if idx == OVERFLOW:
+            self._shard()[idx] += 1.0
+        else:
+            self._absolute[idx] = value
+
+    def flush(self) -> None:
+        self._ensure_started()
+        with self._lock:
+            shards = list(self._shards)
+            n = len(self._keys)
+        total = array.array("d", bytes(n * 8))
+        for shard in shards:
+            for i in range(n):
+                v = shard[i]
+                if v:
+                    total[i] += v
+        for i, v in list(self._absolute.items()):
+            if i < n:
+                total[i] += v
+        self._mm[:n * 8] = total.tobytes()
+        dropped = array.array("d", [sum(shard[OVERFLOW] for shard in shards)])
+        self._mm[OVERFLOW * 8:] = dropped.tobytes()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Metrics flush failed: {e}")
+
+    # ------------------------- scraping -------------------------
+
+    def collect(self) -> Dict[str, Dict[str, float]]:
+        """Aggregate every worker file into {metric name: {series: value}}."""
+        self.flush()
+        out: Dict[str, Dict[str, float]] = {}
+        for fn in os.listdir(self.dir):
+            if not fn.endswith(".keys"):
+                continue
+            pid = fn[:-5]
+            alive = os.path.exists(f"/proc/{pid}")
+            try:
+                with open(os.path.join(self.dir, fn)) as f:
+                    keys = [line.rstrip("\n").split("\t", 1) for line in f if "\t" in line]
+                with open(os.path.join(self.dir, pid + ".bin"), "rb") as f:
+                    raw = f.read(CAPACITY * 8)
+            except OSError:
+                continue
+            values = array.array("d")
+            values.frombytes(raw[:len(raw) // 8 * 8])
+            for idx, key in keys:
+                i = int(idx)
+                if i >= len(values):
+                    continue
+                metric = self._metric_for(key)
+                if metric is None:
+                    continue
+                if metric.kind == "gauge" and not alive:
+                    continue
+                series = out.setdefault(metric.name, {})
+                if metric.agg == "max":
+                    series[key] = max(series.get(key, values[i]), values[i])
+                else:
+                    series[key] = series.get(key, 0.0) + values[i]
+        return out
+
+    def _metric_for(self, key: str) -> Optional[Metric]:
+        name = key.split("{", 1)[0]
+        m = self.metrics.get(name)
+        if m is None:
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix):
+                    m = self.metrics.get(name[:-len(suffix)])
+                    break
+        return m
+
+    def render(self) -> str:
+        data = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(data.get(name, {}).items(), key=lambda kv: _sort_key(kv[0])):
+                lines.append(f"{key} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _sort_key(key: str):
+    # Keep histogram buckets in ascending le order after the other series.
+    if 'le="' in key:
+        le = key.split('le="', 1)[1].split('"', 1)[0]
+        return (key.split('le="', 1)[0], float("inf") if le == "+Inf" else float(le))
+    return (key, 0.0)
+
+
+def reset_dir(directory) -> None:
+    """Remove files left by a previous server run (call from the gunicorn master)."""
+    os.makedirs(str(directory), exist_ok=True)
+    for fn in os.listdir(str(directory)):
+        if fn.endswith((".keys", ".bin")):
+            try:
+                os.unlink(os.path.join(str(directory), fn))
+            except OSError:
+                pass
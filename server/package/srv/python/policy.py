@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+policy.py — boot policy behind /bootstage (memtest or alpine).
+
+Notes:
+- The policy is a JSON file (see the README). It is compiled once into an
+  exact-MAC dict plus prefix tables (MAC prefixes and IP subnets, one dict per
+  prefix length), so a lookup is a handful of dict hits whatever the size of
+  the file.
+- Rules are merged field by field, most specific last:
+  default < arch < subnet < MAC prefix < exact MAC (longer prefixes win).
+- Every worker checks the file signature at most once per check_interval and
+  swaps in a freshly compiled policy by a single reference assignment. An
+  invalid file is logged and the previous policy stays in force, so nothing
+  needs a restart and no download is interrupted.
+- Without a policy file the behaviour is the old one: memtest once per
+  calendar day per MAC, otherwise alpine.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import ipaddress
+import threading
+from datetime import date, datetime, time as dtime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger("pxe_http.policy")
+
+TARGETS = ("alpine", "memtest")
+RULE_FIELDS = ("target", "memtest_every_days", "alpine_windows")
+DEFAULT_RULE = {"target": None, "memtest_every_days": 1, "alpine_windows": ()}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+class Decision(NamedTuple):
+    target: str
+    reason: str
+
+
+def _mac_hex(value: str) -> str:
+    return "".join(c for c in value.lower() if c in "0123456789abcdef")
+
+# ------------------------- compiling --------------------------
+
+
+def _parse_window(spec: str) -> Tuple:
+    """'08:00-17:00' (daily, may wrap midnight) or '<iso start>/<iso end>'."""
+    try:
+        if "/" in spec:
+            start, end = spec.split("/", 1)
+            return ("abs", datetime.fromisoformat(start), datetime.fromisoformat(end))
+        start, end = spec.split("-", 1)
+        return ("daily", dtime.fromisoformat(start.strip()), dtime.fromisoformat(end.strip()))
+    except ValueError:
+        raise PolicyError(f"bad alpine window {spec!r} (use HH:MM-HH:MM or start/end ISO times)")
+
+
+def _compile_rule(raw: Any, where: str) -> Dict[str, Any]:
+    if not isinstance(raw, dict):
+        raise PolicyError(f"{where}: rule must be an object")
+    unknown = set(raw) - set(RULE_FIELDS) - {"comment"}
+    if unknown:
+        raise PolicyError(f"{where}: unknown field(s) {', '.join(sorted(unknown))}")
+    rule: Dict[str, Any] = {}
+    if "target" in raw:
+        if raw["target"] not in TARGETS + (None,):
+            raise PolicyError(f"{where}: target must be one of {', '.join(TARGETS)} or null")
+        rule["target"] = raw["target"]
+    if "memtest_every_days" in raw:
+        every = raw["memtest_every_days"]
+        if not isinstance(every, int) or every < 0:
+            raise PolicyError(f"{where}: memtest_every_days must be an integer >= 0")
+        rule["memtest_every_days"] = every
+    if "alpine_windows" in raw:
+        if not isinstance(raw["alpine_windows"], list):
+            raise PolicyError(f"{where}: alpine_windows must be a list")
+        rule["alpine_windows"] = tuple(_parse_window(str(w)) for w in raw["alpine_windows"])
+    return rule
+
+
+class CompiledPolicy:
+    """Immutable lookup structure built from one version of the policy file."""
+
+    def __init__(self, doc: Dict[str, Any], version: str = "builtin"):
+        if not isinstance(doc, dict):
+            raise PolicyError("policy must be a JSON object")
+        self.version = version
+        self.rules: List[Dict[str, Any]] = []   # index -> rule; ids are used as cache keys
+        self.default = self._add(dict(DEFAULT_RULE, **_compile_rule(doc.get("default", {}),
+                                                                    "default")))
+        self.arch: Dict[str, int] = {
+            str(a): self._add(_compile_rule(r, f"arch.{a}"))
+            for a, r in (doc.get("arch") or {}).items()}
+
+        self.macs: Dict[str, int] = {}
+        for mac, r in (doc.get("macs") or {}).items():
+            key = _mac_hex(mac)
+            if len(key) != 12:
+                raise PolicyError(f"macs: {mac!r} is not a MAC address")
+            self.macs[key] = self._add(_compile_rule(r, f"macs.{mac}"))
+
+        # prefix length -> {prefix: rule id}, probed longest first
+        self.mac_prefixes: Dict[int, Dict[str, int]] = {}
+        for prefix, r in (doc.get("mac_prefixes") or {}).items():
+            key = _mac_hex(prefix)
+            if not 1 <= len(key) < 12:
+                raise PolicyError(f"mac_prefixes: {prefix!r} is not a MAC prefix")
+            self.mac_prefixes.setdefault(len(key), {})[key] = self._add(
+                _compile_rule(r, f"mac_prefixes.{prefix}"))
+        self.mac_prefix_lengths = sorted(self.mac_prefixes, reverse=True)
+
+        # (ip version, prefix length) -> {network as int: rule id}
+        self.subnets: Dict[Tuple[int, int], Dict[int, int]] = {}
+        for cidr, r in (doc.get("subnets") or {}).items():
+            try:
+                net = ipaddress.ip_network(cidr, strict=False)
+            except ValueError:
+                raise PolicyError(f"subnets: {cidr!r} is not a subnet")
+            self.subnets.setdefault((net.version, net.prefixlen), {})[
+                int(net.network_address)] = self._add(_compile_rule(r, f"subnets.{cidr}"))
+        self.subnet_lengths = sorted(self.subnets, key=lambda k: k[1], reverse=True)
+        self._merged: Dict[Tuple[int, ...], Dict[str, Any]] = {}
+        self._merged_lock = threading.Lock()
+
+    def _add(self, rule: Dict[str, Any]) -> int:
+        self.rules.append(rule)
+        return len(self.rules) - 1
+
+    def match(self, mac: str, ip: Optional[str], arch: Optional[str]) -> Tuple[int, ...]:
+        """Ids of the rules that apply, least specific first."""
+        ids = [self.default]
+        if arch in self.arch:
+            ids.append(self.arch[arch])
+        if ip and self.subnets:
+            try:
+                addr = ipaddress.ip_address(ip)
+            except ValueError:
+                addr = None
+            if addr is not None:
+                bits = addr.max_prefixlen
+                value = int(addr)
+                for version, plen in self.subnet_lengths:
+                    if version != addr.version:
+                        continue
+                    net = value >> (bits - plen) << (bits - plen) if plen else 0
+                    rid = self.subnets[(version, plen)].get(net)
+                    if rid is not None:
+                        ids.append(rid)
+                        break
+        key = _mac_hex(mac)
+        for plen in self.mac_prefix_lengths:
+            rid = self.mac_prefixes[plen].get(key[:plen])
+            if rid is not None:
+                ids.append(rid)
+                break
+        if key in self.macs:
+            ids.append(self.macs[key])
+        return tuple(ids)
+
+    def rule_for(self, mac: str, ip: Optional[str], arch: Optional[str]) -> Dict[str, Any]:
+        """Merged rule for this client (merges are cached per rule combination)."""
+        ids = self.match(mac, ip, arch)
+        merged = self._merged.get(ids)
+        if merged is None:
+            merged = {}
+            for rid in ids:
+                merged.update(self.rules[rid])
+            with self._merged_lock:
+                self._merged[ids] = merged
+        return merged
+
+# ------------------------- evaluation -------------------------
+
+
+def _in_window(windows: Tuple, now: datetime) -> bool:
+    for kind, start, end in windows:
+        if kind == "abs":
+            s = start if start.tzinfo is None else start.astimezone().replace(tzinfo=None)
+            e = end if end.tzinfo is None else end.astimezone().replace(tzinfo=None)
+            if s <= now < e:
+                return True
+        else:
+            t = now.time()
+            if (start <= t < end) if start <= end else (t >= start or t < end):
+                return True
+    return False
+
+
+def decide(rule: Dict[str, Any], last_memtest: Optional[str], now: datetime) -> Decision:
+    if rule.get("target"):
+        return Decision(rule["target"], "forced")
+    if _in_window(rule.get("alpine_windows", ()), now):
+        return Decision("alpine", "alpine_window")
+    every = rule.get("memtest_every_days", 1)
+    if every <= 0:
+        return Decision("alpine", "memtest_disabled")
+    if not last_memtest:
+        return Decision("memtest", "never_tested")
+    try:
+        age = (now.date() - date.fromisoformat(last_memtest)).days
+    except ValueError:
+        return Decision("memtest", "bad_last_date")
+    if age >= every:
+        return Decision("memtest", f"due_after_{every}d")
+    return Decision("alpine", "tested_recently")
+
+
+class BootPolicy:
+    """Policy file with cheap change detection; current() is safe from any thread."""
+
+    def __init__(self, path, check_interval: float = 1.0):
+        self.path = str(path)
+        self.check_interval = check_interval
+        self._policy = CompiledPolicy({})
+        self._sig: Optional[Tuple] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.error: Optional[str] = None
+        self.loaded_at: Optional[float] = None
+
+    def current(self) -> CompiledPolicy:
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=False):
+            # One thread per worker re-checks; the others keep using the current policy.
+            try:
+                self._next_check = now + self.check_interval
+                self._reload()
+            finally:
+                self._lock.release()
+        return self._policy
+
+    def _reload(self) -> None:
+        try:
+            st = os.stat(self.path)
+            sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            sig = None
+        if sig == self._sig:
+            return
+        self._sig = sig
+        if sig is None:
+            self._policy = CompiledPolicy({})
+            self.error = None
+            self.loaded_at = time.time()
+            logger.info(f"No policy file at {self.path}, using the built-in policy")
+            return
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            compiled = CompiledPolicy(json.loads(raw), hashlib.sha256(raw).hexdigest()[:12])
+        except (OSError, ValueError) as e:
+            # Keep serving the last good policy; a half-written file is retried next check.
+            self.error = str(e)
+            logger.error(f"Policy {self.path} not loaded, keeping version "
+                         f"{self._policy.version}: {e}")
+            return
+        self._policy = compiled
+        self.error = None
+        self.loaded_at = time.time()
+        logger.info(f"Loaded policy {self.path} version {compiled.version}")
+
+    def decide(self, mac: str, ip: Optional[str], arch: Optional[str],
+               last_memtest: Optional[str], now: Optional[datetime] = None) -> Decision:
+        rule = self.current().rule_for(mac, ip, arch)
+        return decide(rule, last_memtest, now or datetime.now())
@@ -1,40 +1,215 @@
 #!/usr/bin/env python3
-from flask import Flask, request, Response, send_from_directory, abort
-import shelve
+from flask import Flask, request, Response, abort, g
+from werkzeug.http import http_date, parse_date
+import io
 import os
+import csv
+import json
+import time
+import zlib
+import hmac
 import pathlib
+import tempfile
 import logging
 from datetime import date
+from typing import Optional
+from urllib.parse import urlsplit
 
-ROOT = pathlib.Path("/srv")
+import admission
+import artifacts
+import metrics
+
+from boot_script import ScriptRenderer
+from boot_timeline import LiveTimeline
+from policy import BootPolicy
+from replication import Replicator
+from state_store import StateStore
+from results_store import (ResultStore, InvalidResult, InvalidQuery, QueueFull,
+                           normalize, parse_filters)
+from request_log import setup_logging, log_event, RequestSampler
+
+ROOT = pathlib.Path(os.environ.get("PXE_ROOT", "/srv"))
 STATIC_DIR = ROOT / "http"         # all your static boot files
-DB_PATH = ROOT / "bootstage.db"    # tiny state per MAC
-LOG_FILE = ROOT / "pxe_http.log"   # log file path
+DB_PATH = ROOT / "bootstage.db"    # legacy shelve state, migrated once
+STATE_PATH = ROOT / "bootstage.sqlite"  # per-MAC state shared by all workers
+STATE_TTL_DAYS = int(os.environ.get("PXE_STATE_TTL_DAYS", "180"))
+# Other pxe_http servers to pull per-MAC state from, comma separated base URLs (empty: off)
+REPLICATION_PEERS = os.environ.get("PXE_REPLICATION_PEERS", "").split(",")
+REPLICATION_INTERVAL = float(os.environ.get("PXE_REPLICATION_INTERVAL", "5"))
+# Shared secret for /replication/changes (X-Replication-Token); empty allows anyone
+REPLICATION_TOKEN = os.environ.get("PXE_REPLICATION_TOKEN", "")
+# RAM budget for keeping boot artifacts resident (0 disables the cache)
+CACHE_BUDGET_MB = int(os.environ.get("PXE_CACHE_BUDGET_MB", "512"))
+# Admission control: at most PXE_MAX_TRANSFERS downloads larger than
+# PXE_LARGE_TRANSFER_MB run at once over all workers (0 disables)
+MAX_TRANSFERS = int(os.environ.get("PXE_MAX_TRANSFERS", "12"))
+LARGE_TRANSFER_BYTES = int(float(os.environ.get("PXE_LARGE_TRANSFER_MB", "4")) * 1024 * 1024)
+LATE_RESERVED = int(os.environ.get("PXE_LATE_RESERVED", "2"))  # slots kept for modloops
+ADMISSION_WAIT = float(os.environ.get("PXE_ADMISSION_WAIT", "60"))  # non-iPXE queue wait (s)
+# App threads of one worker: gunicorn's threads, or the pool of the async mode
+APP_THREADS = int(os.environ.get("PXE_ASYNC_THREADS", "16")
+                  if os.environ.get("PXE_HTTP_MODE") == "async"
+                  else os.environ.get("PXE_HTTP_THREADS", "32"))
+# Non-iPXE downloads of one worker that may wait for a slot at once (each holds
+# an app thread; default a quarter of them); further ones are served over the
+# cap without waiting
+ADMISSION_WAITERS = int(os.environ.get("PXE_ADMISSION_WAITERS") or max(1, APP_THREADS // 4))
+RETRY_AFTER = int(os.environ.get("PXE_RETRY_AFTER", "3"))      # base Retry-After for iPXE (s)
+SLOTS_DIR = pathlib.Path(os.environ.get("PXE_SLOTS_DIR", "/dev/shm/pxe_http_slots"))
+MANIFEST_PATH = ROOT / "artifact_manifest.json"  # content hashes of STATIC_DIR
+VARIANTS_DIR = ROOT / "http-variants"    # precompressed copies, by content hash
+# Per-worker metric files, summed by /metrics (tmpfs: nothing hits the SD card)
+METRICS_DIR = pathlib.Path(os.environ.get("PXE_METRICS_DIR", "/dev/shm/pxe_http_metrics"))
+POLICY_PATH = pathlib.Path(os.environ.get("PXE_POLICY_PATH", str(ROOT / "bootpolicy.json")))
+TEMPLATE_DIR = ROOT / "ipxe"       # templates of the scripts rendered by /boot.ipxe
+# Base URL written into rendered scripts (default: the Host the client used)
+PUBLIC_URL = os.environ.get("PXE_PUBLIC_URL", "").rstrip("/")
+# Overlay split by build_overlays.py: large base + small delta with the client scripts
+OVERLAY_SPLIT = ("base.apkovl.tar.gz", "delta.tar.gz")
+# How long a replaced split overlay stays readable under its old /a/<digest>/ URL (s)
+ARTIFACT_GRACE_S = float(os.environ.get("PXE_ARTIFACT_GRACE_S", "3600"))
+# Boot menu timeout of rendered scripts; 0 boots the default target at once
+MENU_TIMEOUT_MS = int(os.environ.get("PXE_MENU_TIMEOUT_MS", "3000"))
+RESULTS_PATH = ROOT / "results.sqlite"  # diagnostic results uploaded by clients
+# Largest accepted result upload (after decompression)
+RESULTS_MAX_BYTES = int(os.environ.get("PXE_RESULTS_MAX_BYTES", str(16 * 1024 * 1024)))
+LOG_FILE = ROOT / "pxe_http.log"   # log file path (JSON lines)
+LOG_MAX_BYTES = int(os.environ.get("PXE_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("PXE_LOG_BACKUPS", "5"))
+# Fraction of successful static file requests that get a log record (1.0 = all)
+LOG_SAMPLE_STATIC = float(os.environ.get("PXE_LOG_SAMPLE_STATIC", "1.0"))
+
+# Static files are served by the artifact() route below (Range + sendfile),
+# not by Flask's static_folder.
+app = Flask(__name__, static_folder=None)
+
+# Configure logging: records are queued and written as JSON lines by a
+# background thread, so a slow SD card never stalls a request.
+logger = logging.getLogger("pxe_http")
+log_listener = setup_logging(logger, LOG_FILE, max_bytes=LOG_MAX_BYTES,
+                             backups=LOG_BACKUPS)
+sampler = RequestSampler(LOG_SAMPLE_STATIC)
+# Boot sessions rebuilt from the log for GET /timeline (read incrementally)
+timeline = LiveTimeline(LOG_FILE)
+
+# Metrics: cheap enough to update on every request (see metrics.py)
+registry = metrics.Registry(METRICS_DIR)
+REQUEST_SECONDS = registry.histogram(
+    "pxe_http_request_duration_seconds",
+    "Time from request start until the body was sent", ("route",))
+REQUESTS = registry.counter(
+    "pxe_http_requests_total", "Requests by route and status", ("route", "status"))
+INFLIGHT = registry.gauge(
+    "pxe_http_inflight_requests", "Requests currently being handled or sent", ("route",))
+ARTIFACT_BYTES = registry.counter(
+    "pxe_http_artifact_bytes_total", "Response body bytes sent per file", ("path",))
+STATE_LOOKUP_SECONDS = registry.histogram(
+    "pxe_http_state_lookup_seconds", "Time to read a MAC entry from the state store",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+             0.0025, 0.005, 0.01, 0.05, 0.1))
+DECISIONS = registry.counter(
+    "pxe_http_bootstage_decisions_total", "bootstage answers by target", ("target",))
+RESULTS = registry.counter(
+    "pxe_http_results_total", "Diagnostic results accepted, by verdict", ("verdict",))
+TRANSFER_SLOTS = registry.gauge(
+    "pxe_http_transfer_slots_in_use", "Large downloads holding a transfer slot")
+TRANSFER_QUEUE = registry.gauge(
+    "pxe_http_transfer_queue_depth", "Large downloads waiting for a transfer slot")
+ADMISSIONS = registry.counter(
+    "pxe_http_admissions_total",
+    "Large download admission: admitted, queued, deferred (503 to iPXE), overcommit "
+    "(waited in vain) or overflow (too many waiting, served at once)",
+    ("result",))
+ADMISSION_WAIT_SECONDS = registry.histogram(
+    "pxe_http_admission_wait_seconds", "Time queued large downloads waited for a slot")
+CACHE_BYTES = registry.gauge(
+    "pxe_http_artifact_cache_bytes", "Bytes of boot artifacts held in RAM", agg="max")
+
+store = StateStore(STATE_PATH, ttl_days=STATE_TTL_DAYS)
+store.migrate_shelve(DB_PATH)
 
-app = Flask(__name__, static_url_path="", static_folder=str(STATIC_DIR))
+results = ResultStore(RESULTS_PATH)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+# Pulls state changes from the other servers in the background (one worker polls).
+replicator = Replicator(store, REPLICATION_PEERS, REPLICATION_INTERVAL, REPLICATION_TOKEN)
+replicator.start()
 
-# Add file handler for logging to file
-file_handler = logging.FileHandler(LOG_FILE)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-))
-logger.addHandler(file_handler)
+# memtest/alpine rules; the file is re-read by every worker when it changes.
+policy = BootPolicy(POLICY_PATH)
+scripts = ScriptRenderer(TEMPLATE_DIR)
+
+# Load kernels, initramfs, modloops and overlays into RAM before the first
+# client asks for them (in the background; startup is not delayed).
+cache = artifacts.ArtifactCache(STATIC_DIR, CACHE_BUDGET_MB * 1024 * 1024)
+cache.prewarm()
+
+# Caps concurrent large downloads so each one gets a useful share of the NIC.
+scheduler = admission.TransferScheduler(SLOTS_DIR, MAX_TRANSFERS, LATE_RESERVED,
+                                        ADMISSION_WAITERS)
+
+# Content hashes for ETags and /a/<digest>/ URLs, computed once per file version.
+manifest = artifacts.HashManifest(STATIC_DIR, MANIFEST_PATH, VARIANTS_DIR,
+                                  retain=[f"alpine/boot/*/{name}" for name in OVERLAY_SPLIT],
+                                  grace_s=ARTIFACT_GRACE_S)
+manifest.rebuild()
 
 
 @app.before_request
 def log_request():
-    logger.info(
-        f"Request: {request.method} {request.path} from {request.remote_addr}")
+    g.start = time.perf_counter()
+    g.log_fields = {}
+    # Whoever pops g.inflight decrements the gauge: the end of the body sent by
+    # log_response(), or release_inflight() when no response got that far.
+    g.inflight = request.endpoint or "unmatched"
+    INFLIGHT.inc(route=g.inflight)
+
+
+@app.after_request
+def log_response(response: Response) -> Response:
+    route = request.endpoint or "unmatched"
+    status = response.status_code
+    is_static = route in ("artifact", "immutable_artifact")
+    start = g.get("start", time.perf_counter())
+    sent = response.content_length if request.method != "HEAD" else 0
+    artifact_path = g.get("artifact_path")
+    inflight = g.pop("inflight", None)
+
+    def record():
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+        REQUESTS.inc(route=route, status=status)
+        if inflight:
+            INFLIGHT.dec(route=inflight)
+        if artifact_path and sent:
+            ARTIFACT_BYTES.inc(sent, path=artifact_path)
+
+    response.call_on_close(record)
+    if not sampler.keep(is_static, status):
+        return response
+    fields = {
+        "mac": (request.args.get("mac") or "").lower() or None,
+        "remote": request.remote_addr,
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        "bytes": response.content_length,
+    }
+    fields.update(g.get("log_fields", {}))
+
+    def done():
+        log_event(logger, "request", ms=round(
+            (time.perf_counter() - start) * 1000, 2), **fields)
+
+    # Log once the body has been sent, so the duration covers the transfer.
+    response.call_on_close(done)
+    return response
+
+
+@app.teardown_request
+def release_inflight(exc: Optional[BaseException]) -> None:
+    # after_request is skipped when an exception escapes the view.
+    inflight = g.pop("inflight", None)
+    if inflight:
+        INFLIGHT.dec(route=inflight)
 
 
 def ipxe(text: str) -> Response:
@@ -43,36 +218,318 @@ def ipxe(text: str) -> Response:
 # -------- Dynamic endpoints --------
 
 
+def choose_target(mac: str, arch: Optional[str]) -> str:
+    """Policy decision for mac; records the memtest date when memtest is chosen."""
+    with STATE_LOOKUP_SECONDS.time():
+        entry = store.get(mac)
+    last_test_date = entry.get("last_memtest_date")
+    g.log_fields["last_memtest"] = last_test_date
+
+    decision = policy.decide(mac, request.remote_addr, arch, last_test_date)
+    logger.debug(f"MAC {mac} (arch {arch}, last memtest {last_test_date}): "
+                 f"{decision.target} ({decision.reason})")
+    if decision.target == "memtest":
+        entry["last_memtest_date"] = date.today().isoformat()
+        store.put(mac, entry)
+    g.log_fields["target"] = decision.target
+    g.log_fields["rule"] = decision.reason
+    DECISIONS.inc(target=decision.target)
+    return decision.target
+
+
 @app.get("/bootstage")
 def bootstage():
     mac = (request.args.get("mac") or "").lower()
-    logger.info(f"bootstage endpoint hit with MAC: {mac or 'NONE'}")
+    arch = request.args.get("arch") or None
 
     if not mac:
         logger.warning(
             "No MAC address provided, returning default alpine target")
+        g.log_fields["target"] = "alpine"
+        DECISIONS.inc(target="alpine")
         return ipxe("set def_target alpine")
 
-    today = date.today().isoformat()
+    return ipxe(f"set def_target {choose_target(mac, arch)}")
 
-    with shelve.open(str(DB_PATH)) as db:
-        entry = db.get(mac, {})
-        last_test_date = entry.get("last_memtest_date")
 
-        if last_test_date == today:
-            logger.info(
-                f"MAC {mac} already ran memtest today ({today}), returning alpine target")
-            return ipxe("set def_target alpine")
-        else:
-            if last_test_date:
-                logger.info(
-                    f"MAC {mac} last tested on {last_test_date}, running memtest again for today ({today})")
-            else:
-                logger.info(
-                    f"MAC {mac} hasn't run memtest yet, running memtest for today ({today})")
-            entry["last_memtest_date"] = today
-            db[mac] = entry
-            return ipxe("set def_target memtest")
+@app.get("/boot.ipxe")
+def boot_script():
+    """
+    The whole boot menu for one machine in a single request:
+    /boot.ipxe?mac=<mac>&arch=<x86_64|x86>&fw=<uefi|bios>
+    """
+    mac = (request.args.get("mac") or "").lower()
+    arch = request.args.get("arch")
+    fw = request.args.get("fw")
+    if arch not in ("x86_64", "x86") or fw not in ("uefi", "bios"):
+        return Response("#!ipxe\necho pxe_http: arch must be x86_64 or x86, fw uefi or bios\n",
+                        status=400, mimetype="text/plain")
+    if mac:
+        target = choose_target(mac, arch)
+    else:
+        logger.warning("No MAC address provided, rendering the alpine default")
+        g.log_fields["target"] = target = "alpine"
+        DECISIONS.inc(target="alpine")
+
+    server = PUBLIC_URL or request.host_url.rstrip("/")
+    apkovl, delta_opt = overlay_urls(arch, server)
+    script = scripts.render(
+        "boot.ipxe", arch=arch, fw=fw, def_target=target, server=server,
+        apkovl=apkovl, delta_opt=delta_opt,
+        server_ip=urlsplit(server).hostname or "",
+        memtest_label=f"memtest-{fw}",
+        menu_timeout=str(MENU_TIMEOUT_MS),
+        skip_menu="goto ${def_target}" if MENU_TIMEOUT_MS == 0 else "")
+    return Response(script, mimetype="text/plain")
+
+
+def overlay_urls(arch: str, server: str):
+    """
+    (apkovl URL, extra kernel option) for arch. When build_overlays.py published
+    base.apkovl.tar.gz and delta.tar.gz, both go out as /a/<digest>/ URLs: the
+    base stays cacheable for a year, and the delta always matches the base the
+    script was rendered with: after a rebuild, both versions stay readable
+    under their digests for ARTIFACT_GRACE_S. Only hashed versions are
+    rendered; otherwise (also while a rebuilt overlay is still being hashed in
+    the background) the full overlay, as before.
+    """
+    urls = []
+    for name in OVERLAY_SPLIT:
+        rel = f"alpine/boot/{arch}/{name}"
+        try:
+            st = (STATIC_DIR / rel).stat()
+        except FileNotFoundError:
+            break
+        entry = manifest.lookup(rel, st)
+        if entry is None:
+            break
+        urls.append(f"{server}/a/{entry.token}/{rel}")
+    if len(urls) == len(OVERLAY_SPLIT):
+        return urls[0], f"gtpxe_delta={urls[1]}"
+    return f"{server}/alpine/boot/{arch}/localhost.apkovl.tar.gz", ""
+
+
+@app.get("/policy")
+def policy_status():
+    """Loaded policy version; with ?mac= (and ip, arch) the rule and decision for a client."""
+    current = policy.current()
+    out = {
+        "path": str(POLICY_PATH),
+        "version": current.version,
+        "loaded_at": policy.loaded_at,
+        "error": policy.error,
+    }
+    mac = (request.args.get("mac") or "").lower()
+    if mac:
+        ip = request.args.get("ip")
+        arch = request.args.get("arch")
+        rule = current.rule_for(mac, ip, arch)
+        last = store.get(mac).get("last_memtest_date")
+        out["client"] = {
+            "mac": mac, "ip": ip, "arch": arch, "last_memtest_date": last,
+            "rule": {k: rule.get(k) for k in ("target", "memtest_every_days")},
+            "decision": policy.decide(mac, ip, arch, last)._asdict(),
+        }
+    return out
+
+
+def spool_body(limit: int):
+    """
+    Read the request body (identity or gzip) into a temporary file, a chunk
+    at a time; at most limit decoded bytes are accepted. A gzip body must be
+    complete (a truncated stream is a 400).
+    """
+    encoding = (request.headers.get("Content-Encoding") or "identity").lower()
+    if encoding not in ("identity", "gzip"):
+        abort(415)
+    if request.content_length is None:
+        abort(411)
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding == "gzip" else None
+    out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        total = 0
+        while True:
+            chunk = request.stream.read(64 * 1024)
+            if not chunk:
+                break
+            while chunk:
+                if inflate is not None:
+                    # Bounded output per call, so a gzip bomb cannot balloon memory.
+                    try:
+                        data = inflate.decompress(chunk, 256 * 1024)
+                    except zlib.error:
+                        abort(400)
+                    chunk = inflate.unconsumed_tail
+                else:
+                    data, chunk = chunk, b""
+                total += len(data)
+                if total > limit:
+                    abort(413)
+                out.write(data)
+        if inflate is not None and not inflate.eof:
+            abort(400)
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+
+@app.post("/results")
+def upload_results():
+    """Diagnostic results from a client (see client/python/report_upload.py)."""
+    body = spool_body(RESULTS_MAX_BYTES)
+    try:
+        doc = json.loads(body.read())
+    except (ValueError, UnicodeDecodeError):
+        return {"error": "body is not valid JSON"}, 400
+    finally:
+        body.close()
+    try:
+        row = normalize(doc, request.remote_addr)
+        results.add(row)
+    except InvalidResult as e:
+        return {"error": str(e)}, 400
+    except QueueFull:
+        logger.warning("Result queue full, asking the client to retry")
+        return Response(status=503, headers={"Retry-After": "30"})
+    g.log_fields.update(mac=row["mac"], verdict=row["verdict"], disks=len(row["disks"]))
+    RESULTS.inc(verdict=row["verdict"])
+    return {"upload_id": row["upload_id"]}, 202
+
+
+API_PAGE_MAX = 1000
+EXPORT_COLUMNS = ("id", "mac", "day", "received", "finished", "verdict", "reason",
+                  "remote", "disks", "usb_failed_ports")
+
+
+@app.get("/api/results")
+def api_results():
+    """
+    Stored results, newest first. Filters: mac, verdict, reason, serial,
+    health, port, usb_pass, since, until. Pass next_cursor back as cursor.
+    """
+    try:
+        filters = parse_filters(request.args)
+        limit = min(int(request.args.get("limit", "100")), API_PAGE_MAX)
+        cursor = request.args.get("cursor")
+        cursor = int(cursor) if cursor else None
+    except InvalidQuery as e:
+        return {"error": str(e)}, 400
+    except ValueError:
+        return {"error": "limit and cursor must be numbers"}, 400
+    items, next_cursor = results.query(filters, cursor, max(limit, 1))
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@app.get("/api/results/<int:result_id>")
+def api_result(result_id: int):
+    item = results.get(result_id)
+    if item is None:
+        abort(404)
+    return item
+
+
+@app.get("/api/results/export")
+def api_results_export():
+    """Every matching result as NDJSON (default) or CSV, streamed page by page."""
+    try:
+        filters = parse_filters(request.args)
+    except InvalidQuery as e:
+        return {"error": str(e)}, 400
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return {"error": "format must be ndjson or csv"}, 400
+    rows = results.iter_results(filters)
+
+    def ndjson():
+        for item in rows:
+            yield json.dumps(item, separators=(",", ":")) + "\n"
+
+    def csv_rows():
+        buf = io.StringIO()
+        out = csv.writer(buf)
+        out.writerow(EXPORT_COLUMNS)
+        for item in rows:
+            out.writerow([item[c] for c in EXPORT_COLUMNS[:-2]] + [
+                " ".join(f"{d['serial'] or d['device']}:{d['health']}" for d in item["disks"]),
+                " ".join(str(p["port"]) for p in item["usb_ports"] if not p["pass"]),
+            ])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    if fmt == "csv":
+        return Response(coalesce(csv_rows()), mimetype="text/csv", headers={
+            "Content-Disposition": "attachment; filename=results.csv"})
+    return Response(coalesce(ndjson()), mimetype="application/x-ndjson")
+
+
+def coalesce(lines, size: int = 64 * 1024):
+    """Join small text chunks into ~size byte writes (one send() per chunk)."""
+    buf, n = [], 0
+    for line in lines:
+        buf.append(line)
+        n += len(line)
+        if n >= size:
+            yield "".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+SMART_SERIALS_MAX = 64
+SMART_HISTORY_MAX = 1000
+
+
+@app.get("/api/smart_history")
+def api_smart_history():
+    """
+    SMART counter snapshots per disk serial, newest first: serial=A&serial=B
+    (or serial=A,B), limit per serial (default 1: the latest). "now" is this
+    server's clock, which stamped the snapshots; disk_health.py measures
+    growth against it instead of the client's clock.
+    """
+    serials = [s.strip() for arg in request.args.getlist("serial") for s in arg.split(",")]
+    serials = list(dict.fromkeys(s for s in serials if s))
+    if not serials:
+        return {"error": "serial is required"}, 400
+    if len(serials) > SMART_SERIALS_MAX:
+        return {"error": f"at most {SMART_SERIALS_MAX} serials"}, 400
+    try:
+        limit = min(max(int(request.args.get("limit", "1")), 1), SMART_HISTORY_MAX)
+    except ValueError:
+        return {"error": "limit must be a number"}, 400
+    return {"history": results.smart_history(serials, limit), "now": round(time.time(), 3)}
+
+
+@app.get("/replication/changes")
+def replication_changes():
+    """Change log of the per-MAC state for peers: ?since=<seq>&limit=<n>&exclude=<node>."""
+    if REPLICATION_TOKEN and not hmac.compare_digest(
+            request.headers.get("X-Replication-Token", ""), REPLICATION_TOKEN):
+        abort(403)
+    try:
+        since = int(request.args.get("since", "0"))
+        limit = min(max(int(request.args.get("limit", "1000")), 1), 5000)
+    except ValueError:
+        abort(400)
+    return store.changes(since, limit, request.args.get("exclude"))
+
+
+@app.get("/replication/status")
+def replication_status():
+    return replicator.status()
+
+
+@app.get("/timeline")
+def timeline_status():
+    """Per-phase boot durations of the sessions in the current log; ?open=N lists N open ones."""
+    try:
+        recent = min(max(int(request.args.get("open", "0")), 0), 1000)
+    except ValueError:
+        abort(400)
+    return timeline.snapshot(recent)
 
 # Health check
 
@@ -82,6 +539,208 @@ def health():
     return "ok", 200
 
 
+@app.get("/metrics")
+def metrics_endpoint():
+    CACHE_BYTES.set(cache.stats()["bytes"])
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# -------- Static boot artifacts --------
+
+
+class FileResponse(Response):
+    """Response whose close callbacks run when the server closes the file it sent."""
+
+    def __init__(self, *args, tracked: artifacts.TrackedFile, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracked = tracked
+
+    def call_on_close(self, func):
+        self.tracked.on_close.append(func)
+        return func
+
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+@app.get("/manifest.json")
+def manifest_json():
+    """Current digest, size and immutable URL of every hashed file."""
+    files = {}
+    for rel, entry in sorted(manifest.snapshot().items()):
+        files[rel] = {
+            "sha256": entry.sha256,
+            "size": entry.sig[2],
+            "url": f"/a/{entry.token}/{rel}",
+        }
+    return {"files": files}
+
+
+@app.route("/a/<token>/<path:relpath>", methods=["GET", "HEAD"])
+def immutable_artifact(token: str, relpath: str):
+    """Content-addressed URL: only ever serves the version whose digest matches."""
+    return serve_file(relpath, token=token)
+
+
+@app.route("/<path:relpath>", methods=["GET", "HEAD"])
+def artifact(relpath: str):
+    return serve_file(relpath)
+
+
+def serve_file(relpath: str, token: Optional[str] = None) -> Response:
+    path = artifacts.resolve(STATIC_DIR, relpath)
+    if path is None:
+        abort(404)
+    st = path.stat()
+    rel = path.relative_to(STATIC_DIR.resolve()).as_posix()
+    g.artifact_path = rel
+    g.log_fields["cached"] = cache.lookup(rel, st)
+
+    entry = manifest.lookup(rel, st)
+    body_path = path
+    if token is not None and (entry is None or entry.token != token):
+        kept = manifest.retained(rel, token)
+        if kept is not None:
+            # An earlier version (split overlay replaced by a rebuild).
+            body_path, entry = kept
+            try:
+                st = body_path.stat()
+            except FileNotFoundError:
+                abort(404)  # collected after its grace period meanwhile
+        elif entry is None:
+            # Not hashed yet (queued): the digest cannot be checked without
+            # hashing on the request path, so send the client to the plain URL.
+            return Response(status=307, headers={"Location": f"/{rel}", "Cache-Control": "no-store"})
+        else:
+            abort(404)
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Last-Modified": http_date(st.st_mtime),
+        "Content-Type": artifacts.content_type(path),
+    }
+    size = st.st_size
+    encoding = None
+    if entry is not None:
+        if entry.variants:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = artifacts.pick_encoding(
+                request.headers.get("Accept-Encoding"), entry.variants)
+        if encoding:
+            identity_path = body_path
+            body_path = manifest.variant_path(entry, encoding)
+            size = entry.variants[encoding]
+            headers["Content-Encoding"] = encoding
+        headers["ETag"] = entry.etag(encoding)
+    if token is not None:
+        headers["Cache-Control"] = IMMUTABLE_CACHE
+
+    # If-None-Match wins over If-Modified-Since when both are sent.
+    inm = request.headers.get("If-None-Match")
+    if inm is not None:
+        if "ETag" in headers and (inm.strip() == "*" or headers["ETag"] in
+                                  [t.strip() for t in inm.split(",")]):
+            return Response(status=304, headers=headers)
+    else:
+        since = parse_date(request.headers.get("If-Modified-Since"))
+        if since is not None and int(st.st_mtime) <= since.timestamp():
+            return Response(status=304, headers=headers)
+
+    try:
+        rng = artifacts.parse_range(request.headers.get("Range"), size)
+    except artifacts.RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    # A resumed download must not mix bytes of two versions of the file.
+    if_range = request.headers.get("If-Range")
+    if rng and if_range and if_range not in (headers.get("ETag"), headers["Last-Modified"]):
+        rng = None
+
+    status = 200
+    start, length = 0, size
+    if rng:
+        status = 206
+        start, length = rng[0], rng[1] - rng[0] + 1
+        headers["Content-Range"] = f"bytes {rng[0]}-{rng[1]}/{size}"
+    headers["Content-Length"] = str(length)
+
+    if request.method == "HEAD":
+        return Response(status=status, headers=headers)
+
+    slot = None
+    if scheduler.enabled and length >= LARGE_TRANSFER_BYTES:
+        slot, deferred = admit(rel)
+        if deferred is not None:
+            return deferred
+
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    try:
+        try:
+            f, body = artifacts.open_body(body_path, start, length, size, wrapper)
+        except FileNotFoundError:
+            if not encoding:
+                raise
+            # The variant was collected by a concurrent redeploy: send the
+            # whole identity body instead (a range of the variant means nothing here).
+            del headers["Content-Encoding"]
+            headers.pop("Content-Range", None)
+            headers["ETag"] = entry.etag()
+            status, size = 200, st.st_size
+            headers["Content-Length"] = str(size)
+            f, body = artifacts.open_body(identity_path, 0, size, size, wrapper)
+    except FileNotFoundError:
+        if slot is not None:
+            release_slot(slot)
+        abort(404)  # removed by a concurrent redeploy
+    if slot is not None:
+        f.on_close.append(lambda: release_slot(slot))
+    return FileResponse(body, status=status, headers=headers,
+                        direct_passthrough=True, tracked=f)
+
+
+def admit(rel: str):
+    """
+    Transfer slot for a large download: (slot, None), or (None, response)
+    when an iPXE client is told to come back later. Other clients (busybox
+    wget in the initramfs cannot retry) wait for a slot instead, and after
+    ADMISSION_WAIT are served anyway: a boot is never failed here. Only
+    ADMISSION_WAITERS of them wait per worker; the rest are served at once,
+    so waiting downloads never take all the threads /bootstage needs.
+    """
+    late = admission.is_late_stage(rel)
+    slot = scheduler.try_acquire(late)
+    if slot is None and "ipxe" in request.user_agent.string.lower():
+        # iPXE retries by itself after a 503 with Retry-After.
+        ADMISSIONS.inc(result="deferred")
+        g.log_fields["deferred"] = True
+        return None, Response(status=503, headers={
+            "Retry-After": str(admission.retry_after(RETRY_AFTER))})
+    if slot is None and scheduler.waiting() >= scheduler.max_waiters:
+        ADMISSIONS.inc(result="overflow")
+        g.log_fields["overflow"] = True
+    elif slot is None:
+        TRANSFER_QUEUE.inc()
+        t0 = time.perf_counter()
+        try:
+            slot = scheduler.acquire(late, ADMISSION_WAIT)
+        finally:
+            TRANSFER_QUEUE.dec()
+        waited = time.perf_counter() - t0
+        ADMISSION_WAIT_SECONDS.observe(waited)
+        g.log_fields["queued_ms"] = round(waited * 1000, 1)
+        ADMISSIONS.inc(result="queued" if slot is not None else "overcommit")
+    else:
+        ADMISSIONS.inc(result="admitted")
+    if slot is not None:
+        TRANSFER_SLOTS.inc()
+        g.log_fields["slot"] = slot.index
+    return slot, None
+
+
+def release_slot(slot: admission.Slot) -> None:
+    slot.release()
+    TRANSFER_SLOTS.dec()
+
+
 if __name__ == "__main__":
     # Dev only; prod uses gunicorn (see systemd unit below)
     app.run(host="0.0.0.0", port=8080)
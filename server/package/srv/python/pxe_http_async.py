@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+pxe_http_async.py — asyncio deployment mode for pxe_http (PXE_HTTP_MODE=async).
+
+Notes:
+- One process, one event loop: every client connection (including hundreds of
+  slow downloads) is a coroutine, not a thread or a worker.
+- Requests are handed to the unchanged Flask app (pxe_http.app) on a small
+  thread pool, so /bootstage, headers, ETags, logging and metrics behave
+  exactly as under gunicorn, and state lookups never run on the loop.
+- When the app answers with a file (wsgi.file_wrapper) the loop sends it
+  itself with loop.sendfile(): zero-copy, and no thread is held while a slow
+  client drains a 30 MB initramfs.
+- Plain HTTP/1.1 with keep-alive; request bodies need a Content-Length.
+"""
+
+import os
+import sys
+import signal
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from urllib.parse import unquote
+
+import metrics
+import pxe_http
+
+logger = logging.getLogger("pxe_http.async")
+
+HOST, _, PORT = os.environ.get("PXE_HTTP_BIND", "0.0.0.0:80").rpartition(":")
+THREADS = int(os.environ.get("PXE_ASYNC_THREADS", "16"))
+MAX_BODY = int(os.environ.get("PXE_ASYNC_MAX_BODY", str(64 * 1024 * 1024)))
+HEADER_LIMIT = 64 * 1024
+FIRST_REQUEST_TIMEOUT = 30.0
+KEEPALIVE_TIMEOUT = 5.0
+# Non-file bodies are pulled from the app in pieces of about this size.
+CHUNK_TARGET = 64 * 1024
+BODY_SPOOL = 1024 * 1024
+
+REASONS = {400: "Bad Request", 408: "Request Timeout", 411: "Length Required",
+           413: "Payload Too Large", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error"}
+
+
+class FileWrapper:
+    """wsgi.file_wrapper: marks a body the event loop should sendfile() itself."""
+
+    def __init__(self, filelike, blksize: int = 8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        # Only used if something iterates the body instead of the server.
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                return
+            yield data
+
+    def close(self) -> None:
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+
+class BadRequest(Exception):
+    def __init__(self, status: int):
+        self.status = status
+
+
+class Server:
+    def __init__(self, app, threads: int = THREADS):
+        self.app = app
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pxe-app")
+        self.port = PORT
+
+    # ----------------------- connections ------------------------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername") or ("", 0)
+        timeout = FIRST_REQUEST_TIMEOUT
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._error(writer, 431)
+                    return
+                try:
+                    environ = self._environ(head, peer)
+                    await self._read_body(reader, environ)
+                except BadRequest as e:
+                    await self._error(writer, e.status)
+                    return
+                keep_alive = await self._respond(writer, environ)
+                if not keep_alive:
+                    return
+                timeout = KEEPALIVE_TIMEOUT
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            logger.exception("Connection handler failed")
+        finally:
+            writer.close()
+
+    def _environ(self, head: bytes, peer) -> Dict:
+        try:
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise BadRequest(400)
+        if not version.startswith("HTTP/1."):
+            raise BadRequest(400)
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, encoding="latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": HOST or "0.0.0.0",
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise BadRequest(400)
+            key = name.strip().upper().replace("-", "_")
+            value = value.strip()
+            if key == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif key == "CONTENT_LENGTH":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                key = "HTTP_" + key
+                environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    async def _read_body(self, reader: asyncio.StreamReader, environ: Dict) -> None:
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            raise BadRequest(411)
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise BadRequest(400)
+        if length < 0:
+            raise BadRequest(400)
+        if length > MAX_BODY:
+            raise BadRequest(413)
+        # Small bodies stay in memory, large uploads spill to a temp file.
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL)
+        remaining = length
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, 256 * 1024))
+            if not chunk:
+                raise BadRequest(400)
+            body.write(chunk)
+            remaining -= len(chunk)
+        body.seek(0)
+        environ["wsgi.input"] = body
+
+    # ------------------------- responses ------------------------
+
+    def _call_app(self, environ: Dict):
+        """Run the WSGI app (in a pool thread) up to the first body chunk(s)."""
+        started: Dict = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+            return lambda data: started.setdefault("early", []).append(data)
+
+        result = self.app(environ, start_response)
+        if isinstance(result, FileWrapper):
+            return started, result, [], None
+        iterator = iter(result)
+        chunks, more = self._pull(iterator)
+        chunks = started.pop("early", []) + chunks
+        return started, result, chunks, iterator if more else None
+
+    @staticmethod
+    def _pull(iterator) -> Tuple[List[bytes], bool]:
+        chunks, size = [], 0
+        for chunk in iterator:
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+            if size >= CHUNK_TARGET:
+                return chunks, True
+        return chunks, False
+
+    async def _respond(self, writer: asyncio.StreamWriter, environ: Dict) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            started, result, chunks, iterator = await loop.run_in_executor(
+                self.pool, self._call_app, environ)
+        except Exception:
+            logger.exception(f"App failed for {environ['PATH_INFO']}")
+            await self._error(writer, 500)
+            return False
+
+        version = environ["SERVER_PROTOCOL"]
+        conn_hdr = environ.get("HTTP_CONNECTION", "").lower()
+        keep_alive = ("close" not in conn_hdr) if version == "HTTP/1.1" else ("keep-alive" in conn_hdr)
+        headers = list(started["headers"])
+        names = {k.lower() for k, _ in headers}
+        head_only = environ["REQUEST_METHOD"] == "HEAD"
+        chunked = False
+        if "content-length" not in names and not head_only:
+            if version == "HTTP/1.1":
+                chunked = True
+                headers.append(("Transfer-Encoding", "chunked"))
+            else:
+                keep_alive = False
+        headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+
+        out = [f"{version} {started['status']}\r\n"]
+        out += [f"{k}: {v}\r\n" for k, v in headers]
+        out.append("\r\n")
+        try:
+            writer.write("".join(out).encode("latin-1"))
+            if head_only:
+                await writer.drain()
+            elif isinstance(result, FileWrapper):
+                f = result.filelike
+                length = int(dict((k.lower(), v) for k, v in headers)["content-length"])
+                await writer.drain()
+                await loop.sendfile(writer.transport, f, f.tell(), length)
+            else:
+                while True:
+                    for chunk in chunks:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain()
+                    if iterator is None:
+                        break
+                    chunks, more = await loop.run_in_executor(self.pool, self._pull, iterator)
+                    if not more:
+                        iterator = None
+                if chunked:
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+        finally:
+            # Runs the close callbacks (request log, metrics) off the loop.
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self.pool, result.close)
+        return keep_alive
+
+    async def _error(self, writer: asyncio.StreamWriter, status: int) -> None:
+        reason = REASONS.get(status, "Error")
+        body = f"{status} {reason}\n".encode()
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    # --------------------------- main ---------------------------
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host or None, port,
+                                            limit=HEADER_LIMIT, backlog=1024,
+                                            reuse_address=True)
+        self.port = port
+        logger.warning(f"pxe_http async mode listening on {host or '*'}:{port} "
+                       f"({THREADS} app threads)")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        async with server:
+            await stop.wait()
+        self.pool.shutdown(wait=True)
+
+
+def main() -> int:
+    metrics.reset_dir(pxe_http.METRICS_DIR)
+    asyncio.run(Server(pxe_http.app).serve(HOST, int(PORT)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
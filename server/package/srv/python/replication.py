@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+replication.py — share the per-MAC boot state between pxe_http servers.
+
+Notes:
+- Pull based: every server polls GET /replication/changes on each peer for
+  the rows committed since the last poll (a compact, paged change log keyed by
+  the peer's own seq) and merges them into its state store with last writer
+  wins (StateStore.merge). Servers may be offline for days; they catch up
+  from their cursor.
+- One worker per server polls (non-blocking flock on a lock file next to the
+  state file); if it dies, another worker takes over at the next interval.
+  Requests never wait on a peer: merged rows reach every worker through the
+  normal state store sync.
+- Cursors and the last error per peer are kept in the state file's meta table,
+  so restarts resume where they stopped and any worker can report them.
+- Rows a peer got from us are not sent back (exclude=<our node id>), and a
+  row only replaces a strictly newer one, so changes do not bounce around.
+"""
+
+import os
+import json
+import time
+import fcntl
+import random
+import logging
+import sqlite3
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional
+
+from state_store import StateStore, connect
+
+logger = logging.getLogger("pxe_http.replication")
+
+# Guards the per-process (re)initialisation after a gunicorn fork.
+_start_lock = threading.Lock()
+
+PAGE = 1000  # rows per request
+
+
+class Replicator:
+    def __init__(self, store: StateStore, peers: List[str], interval: float = 5.0,
+                 token: str = "", timeout: float = 5.0):
+        self.store = store
+        self.peers = [p.rstrip("/") for p in peers if p.strip()]
+        self.interval = interval
+        self.token = token
+        self.timeout = timeout
+        self._pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.peers)
+
+    def start(self) -> None:
+        """Start the poller in this process (no-op without peers or if running)."""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock_fd: Optional[int] = None
+            threading.Thread(target=self._loop, name="replication", daemon=True).start()
+            self._pid = os.getpid()
+
+    # ------------------------- status -------------------------
+
+    def status(self) -> Dict:
+        """Cursor, last success and last error of every peer (readable from any worker)."""
+        conn = connect(self.store.path)
+        try:
+            peers = {p: _load_peer(conn, p) for p in self.peers}
+        finally:
+            conn.close()
+        self.store._ensure_started()
+        return {"node": self.store.node_id, "interval": self.interval, "peers": peers}
+
+    # ------------------------- polling -------------------------
+
+    def _is_leader(self) -> bool:
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.store.path + ".replication.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd  # held until the process exits
+        logger.info(f"Replicating boot state from {', '.join(self.peers)}")
+        return True
+
+    def _loop(self) -> None:
+        conn: Optional[sqlite3.Connection] = None
+        while True:
+            # Jitter, so servers started together do not poll each other in lockstep.
+            time.sleep(self.interval * random.uniform(0.8, 1.2))
+            if not self._is_leader():
+                continue
+            if conn is None:
+                conn = connect(self.store.path)
+            for peer in self.peers:
+                try:
+                    self._pull(conn, peer)
+                except Exception as e:
+                    logger.exception(f"Replication from {peer} failed unexpectedly: {e}")
+
+    def _pull(self, conn: sqlite3.Connection, peer: str) -> None:
+        state = _load_peer(conn, peer)
+        applied = 0
+        while True:
+            query = urllib.parse.urlencode({"since": state["seq"], "limit": PAGE,
+                                            "exclude": self.store.node_id})
+            req = urllib.request.Request(f"{peer}/replication/changes?{query}")
+            if self.token:
+                req.add_header("X-Replication-Token", self.token)
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    page = json.load(resp)
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                if state.get("error") is None:
+                    logger.warning(f"Replication from {peer} failed: {e}")
+                state["error"] = str(e)
+                _save_peer(conn, peer, state)
+                return
+
+            if page["node"] != state["node"] or page["head"] < state["seq"]:
+                if state["seq"]:
+                    # New node id or a shorter log: the peer was reset, read it all again.
+                    logger.warning(f"Peer {peer} was reset, reading its whole state again")
+                    state.update(node=page["node"], seq=0)
+                    continue
+                state["node"] = page["node"]
+            if page["changes"]:
+                applied += self.store.merge(conn, page["changes"])
+            state["seq"] = page["next"]
+            if not page["more"]:
+                break
+        if state.get("error") is not None:
+            logger.info(f"Replication from {peer} works again")
+        state.update(error=None, ok=time.time())
+        _save_peer(conn, peer, state)
+        if applied:
+            logger.info(f"Merged {applied} state entries from {peer}")
+
+
+def _load_peer(conn: sqlite3.Connection, peer: str) -> Dict:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", ("peer:" + peer,)).fetchone()
+    state = {"seq": 0, "node": None, "ok": None, "error": None}
+    if row:
+        state.update(json.loads(row[0]))
+    return state
+
+
+def _save_peer(conn: sqlite3.Connection, peer: str, state: Dict) -> None:
+    conn.execute("INSERT INTO meta(key, value) VALUES (?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                 ("peer:" + peer, json.dumps(state)))
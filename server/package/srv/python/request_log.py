@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+request_log.py — non-blocking JSON-lines logging for pxe_http.
+
+Notes:
+- Request threads only put the LogRecord on a queue; formatting and writing
+  happen on a QueueListener thread, so an SD-card stall never holds a request.
+- One JSON object per line. Request records carry mac/path/status/bytes/ms,
+  plain log calls carry msg.
+- The log file is shared by all gunicorn workers: rotation is done under a
+  flock and the other workers reopen the file when they see the inode change.
+"""
+
+import os
+import json
+import time
+import queue
+import fcntl
+import atexit
+import random
+import logging
+import logging.handlers
+from typing import Optional
+
+
+class JsonLineFormatter(logging.Formatter):
+    """Render a record as one compact JSON line. Structured fields come from extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+            + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            out.update(fields)
+        else:
+            out["msg"] = record.getMessage()
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, separators=(",", ":"), default=str)
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that several processes can append to at once."""
+
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super().__init__(filename, mode="a", maxBytes=maxBytes, backupCount=backupCount,
+                         encoding="utf-8", delay=True)
+        self._lock_path = self.baseFilename + ".lock"
+        self._ino = None
+
+    def _reopen_if_rotated(self) -> None:
+        try:
+            ino = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            ino = None
+        if self.stream is not None and ino != self._ino:
+            self.stream.close()
+            self.stream = None
+        if self.stream is None:
+            self.stream = self._open()
+            self._ino = os.fstat(self.stream.fileno()).st_ino
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._reopen_if_rotated()
+            if self.shouldRollover(record):
+                with open(self._lock_path, "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    # Another worker may have rotated while we waited for the lock.
+                    self._reopen_if_rotated()
+                    if self.shouldRollover(record):
+                        self.doRollover()
+                        self._reopen_if_rotated()
+            logging.FileHandler.emit(self, record)
+        except Exception:
+            self.handleError(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The default prepare() formats the message on the calling thread. The
+    # listener lives in the same process, so the record can go as-is.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(logger: logging.Logger, log_file, max_bytes: int = 10 * 1024 * 1024,
+                  backups: int = 5, level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Route logger through a queue to a rotating JSON-lines file. Warnings and
+    errors are also echoed to stderr (journald) by the same background thread.
+    """
+    file_handler = SharedRotatingFileHandler(str(log_file), maxBytes=max_bytes,
+                                             backupCount=backups)
+    file_handler.setFormatter(JsonLineFormatter())
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    console.setFormatter(logging.Formatter(
+        '%(asctime)s [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+
+    q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(q))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(q, file_handler, console,
+                                              respect_handler_level=True)
+    listener.start()
+    # Drain whatever is still queued when the worker exits.
+    atexit.register(listener.stop)
+    return listener
+
+
+class RequestSampler:
+    """Decide which request records to keep. Errors and dynamic endpoints are always kept."""
+
+    def __init__(self, static_rate: float = 1.0):
+        self.static_rate = max(0.0, min(1.0, static_rate))
+
+    def keep(self, is_static: bool, status: int) -> bool:
+        if not is_static or status >= 400 or self.static_rate >= 1.0:
+            return True
+        return random.random() < self.static_rate
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO,
+              **fields: Optional[object]) -> None:
+    """Log a structured record: {"event": event, **fields}."""
+    logger.log(level, event, extra={"fields": {"event": event, **fields}})
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+"""
+results_store.py — diagnostic results uploaded by the clients (POST /results).
+
+Notes:
+- A separate SQLite file from the boot state: a burst of uploads never holds
+  the write lock that /bootstage writes need.
+- Requests only validate and enqueue; a background thread inserts queued
+  results in batches (one transaction per batch, WAL mode).
+- Indexed by MAC, day, verdict, fail reason, disk serial/health and USB
+  port. Uploads carry an upload_id, so a retried upload is stored once.
+- smart_history keeps a few SMART counters per disk serial from every upload
+  that carries disk_health device records (append-only, indexed by serial and
+  time); clients fetch the latest snapshots of their drives to see how fast the
+  counters grow (smart_history()). Snapshots are stamped with the time the
+  server received them: client clocks are often wrong (dead CMOS batteries).
+- Queries page by id (keyset cursor, newest first): a page costs the same at
+  row 10 as at row 10 million, and an export walks the table page by page in
+  constant memory without holding a read transaction open.
+- The queue is bounded: when it is full, add() refuses and the client retries
+  later instead of the server buffering without limit.
+"""
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import atexit
+from datetime import date, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from state_store import connect
+
+logger = logging.getLogger("pxe_http.results")
+
+# Guards the per-process (re)initialisation after a gunicorn fork.
+_start_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id        INTEGER PRIMARY KEY,
+    upload_id TEXT NOT NULL UNIQUE,
+    mac       TEXT NOT NULL,
+    day       TEXT NOT NULL,
+    received  REAL NOT NULL,
+    finished  REAL,
+    verdict   TEXT NOT NULL,
+    reason    TEXT NOT NULL DEFAULT '',
+    remote    TEXT,
+    report    TEXT,
+    usb       TEXT,
+    meta      TEXT
+);
+CREATE INDEX IF NOT EXISTS results_mac ON results(mac, received);
+CREATE INDEX IF NOT EXISTS results_day ON results(day);
+CREATE INDEX IF NOT EXISTS results_verdict ON results(verdict, id);
+CREATE TABLE IF NOT EXISTS result_disks (
+    result_id INTEGER NOT NULL REFERENCES results(id) ON DELETE CASCADE,
+    serial    TEXT NOT NULL,
+    device    TEXT,
+    model     TEXT,
+    size      TEXT,
+    bus       TEXT,
+    health    TEXT,
+    why       TEXT
+);
+CREATE INDEX IF NOT EXISTS result_disks_serial ON result_disks(serial, result_id);
+CREATE INDEX IF NOT EXISTS result_disks_result ON result_disks(result_id);
+CREATE INDEX IF NOT EXISTS result_disks_health ON result_disks(health, result_id);
+CREATE TABLE IF NOT EXISTS result_usb (
+    result_id    INTEGER NOT NULL REFERENCES results(id) ON DELETE CASCADE,
+    port         INTEGER NOT NULL,
+    pass         INTEGER NOT NULL,
+    fail_reasons TEXT
+);
+CREATE INDEX IF NOT EXISTS result_usb_port ON result_usb(port, result_id);
+CREATE INDEX IF NOT EXISTS result_usb_result ON result_usb(result_id);
+CREATE TABLE IF NOT EXISTS result_reasons (
+    result_id INTEGER NOT NULL REFERENCES results(id) ON DELETE CASCADE,
+    reason    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_reasons_reason ON result_reasons(reason, result_id);
+CREATE TABLE IF NOT EXISTS smart_history (
+    serial          TEXT NOT NULL,
+    ts              REAL NOT NULL,
+    poh             INTEGER,
+    ralloc          INTEGER,
+    pend            INTEGER,
+    offunc          INTEGER,
+    crc             INTEGER,
+    media_errors    INTEGER,
+    percentage_used INTEGER
+);
+CREATE INDEX IF NOT EXISTS smart_history_serial ON smart_history(serial, ts);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+VERDICTS = ("pass", "fail", "aborted")
+
+# SMART counters kept per serial (keys of the disk_health.py device record "extras")
+SMART_COUNTERS = ("ralloc", "pend", "offunc", "crc", "media_errors", "percentage_used")
+SMART_COLUMNS = ("ts", "poh") + SMART_COUNTERS
+
+
+class InvalidResult(ValueError):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def _split_reasons(reason: str) -> List[str]:
+    return sorted({r.strip() for r in reason.split(",") if r.strip()})
+
+
+def _opt_int(value: Any) -> Optional[int]:
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def _smart_snapshot(rec: Any, ts: float) -> Optional[Tuple[Any, ...]]:
+    """smart_history row of one disk_health device record at ts, or None (no serial, no SMART data)."""
+    if not isinstance(rec, dict) or rec.get("type") != "device":
+        return None
+    serial = str(rec.get("serial") or "").strip()
+    extras = rec.get("extras")
+    if not serial or len(serial) > 64 or not isinstance(extras, dict):
+        return None
+    poh = _opt_int(rec.get("power_on_hours"))
+    values = tuple(_opt_int(extras.get(k)) for k in SMART_COUNTERS)
+    if poh is None and all(v is None for v in values):
+        return None
+    return (serial, ts, poh) + values
+
+
+def normalize(doc: Dict[str, Any], remote: Optional[str] = None) -> Dict[str, Any]:
+    """Validate an uploaded document and return the row values to insert."""
+    if not isinstance(doc, dict):
+        raise InvalidResult("body must be a JSON object")
+    upload_id = str(doc.get("upload_id") or "").strip()
+    mac = str(doc.get("mac") or "").strip().lower()
+    verdict = str(doc.get("verdict") or "").strip().lower()
+    if not upload_id or len(upload_id) > 64:
+        raise InvalidResult("missing or invalid upload_id")
+    if not mac:
+        raise InvalidResult("missing mac")
+    if verdict not in VERDICTS:
+        raise InvalidResult(f"verdict must be one of {', '.join(VERDICTS)}")
+    received = time.time()
+    try:
+        finished = float(doc["finished"]) if doc.get("finished") is not None else None
+    except (TypeError, ValueError):
+        raise InvalidResult("finished must be a unix timestamp")
+    reason = doc.get("reason") or ""
+    if isinstance(reason, list):
+        reason = ",".join(str(r) for r in reason)
+
+    disks = []
+    for d in doc.get("disks") or []:
+        if not isinstance(d, dict):
+            continue
+        disks.append({k: (str(d[k]) if d.get(k) is not None else None)
+                      for k in ("serial", "device", "model", "size", "bus", "health", "why")})
+        disks[-1]["serial"] = disks[-1]["serial"] or ""
+
+    usb = doc.get("usb_report")
+    ports = []
+    if isinstance(usb, dict):
+        for p in usb.get("per_port") or []:
+            if isinstance(p, dict) and isinstance(p.get("port"), int):
+                ports.append((p["port"], 1 if p.get("pass") else 0,
+                              json.dumps(p.get("fail_reasons") or [])))
+
+    records = doc.get("disk_report")
+    smart = [snap for snap in (_smart_snapshot(rec, received)
+                               for rec in (records if isinstance(records, list) else ()))
+             if snap is not None]
+
+    meta = {k: v for k, v in doc.items()
+            if k not in ("upload_id", "mac", "verdict", "reason", "finished",
+                         "disks", "usb_report", "report")}
+    return {
+        "upload_id": upload_id,
+        "mac": mac,
+        "day": time.strftime("%Y-%m-%d", time.localtime(finished or received)),
+        "received": received,
+        "finished": finished,
+        "verdict": verdict,
+        "reason": str(reason),
+        "reasons": _split_reasons(str(reason)),
+        "remote": remote,
+        "report": doc.get("report") if isinstance(doc.get("report"), str) else None,
+        "usb": json.dumps(usb, separators=(",", ":")) if usb is not None else None,
+        "meta": json.dumps(meta, separators=(",", ":")) if meta else None,
+        "disks": disks,
+        "ports": ports,
+        "smart": smart,
+    }
+
+
+class ResultStore:
+    """Append-only store of client results with batched background inserts."""
+
+    def __init__(self, path: str, max_pending: int = 256, flush_interval: float = 0.2):
+        self.path = str(path)
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pid = None
+
+    # ------------------------- lifecycle -------------------------
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(self.max_pending)
+            self._local = threading.local()
+            conn = connect(self.path)
+            conn.executescript(SCHEMA)
+            _backfill_reasons(conn)
+            conn.close()
+            self._writer = threading.Thread(target=self._write_loop, name="results-writer",
+                                            daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+            self._pid = os.getpid()
+
+    def close(self) -> None:
+        """Insert pending results and stop the writer thread."""
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+
+    # --------------------------- writes --------------------------
+
+    def add(self, row: Dict[str, Any]) -> None:
+        """Queue a normalized result. Raises QueueFull instead of blocking."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            raise QueueFull()
+
+    def pending(self) -> int:
+        self._ensure_started()
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Block until everything queued so far has been inserted."""
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put({"__flush__": done})
+        done.wait(timeout)
+
+    def _write_loop(self) -> None:
+        conn = connect(self.path)
+        conn.execute("PRAGMA foreign_keys=ON")
+        while True:
+            item = self._queue.get()
+            batch: List[Any] = [item]
+            stop = item is None
+            deadline = time.monotonic() + self.flush_interval
+            while not stop:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                else:
+                    batch.append(nxt)
+
+            rows = [b for b in batch if b and "__flush__" not in b]
+            if rows:
+                try:
+                    self._commit(conn, rows)
+                except sqlite3.Error as e:
+                    logger.error(f"Inserting {len(rows)} results failed: {e}")
+            for b in batch:
+                if b and "__flush__" in b:
+                    b["__flush__"].set()
+            if stop:
+                conn.close()
+                return
+
+    def _commit(self, conn: sqlite3.Connection, rows: List[Dict[str, Any]]) -> None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for r in rows:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO results(upload_id, mac, day, received, finished, "
+                    "verdict, reason, remote, report, usb, meta) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (r["upload_id"], r["mac"], r["day"], r["received"], r["finished"],
+                     r["verdict"], r["reason"], r["remote"], r["report"], r["usb"], r["meta"]))
+                if not cur.rowcount:
+                    continue  # retried upload, already stored
+                rid = cur.lastrowid
+                conn.executemany(
+                    "INSERT INTO result_disks(result_id, serial, device, model, size, bus, "
+                    "health, why) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(rid, d["serial"], d["device"], d["model"], d["size"], d["bus"],
+                      d["health"], d["why"]) for d in r["disks"]])
+                conn.executemany(
+                    "INSERT INTO result_usb(result_id, port, pass, fail_reasons) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(rid,) + p for p in r["ports"]])
+                conn.executemany(
+                    "INSERT INTO result_reasons(result_id, reason) VALUES (?, ?)",
+                    [(rid, reason) for reason in r["reasons"]])
+                conn.executemany(
+                    f"INSERT INTO smart_history(serial, {', '.join(SMART_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * (len(SMART_COLUMNS) + 1))})",
+                    r.get("smart", ()))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # -------------------------- queries --------------------------
+
+    def _reader(self) -> sqlite3.Connection:
+        # One read connection per request thread; WAL readers never block the writer.
+        self._ensure_started()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def query(self, filters: Dict[str, Any], cursor: Optional[int] = None,
+              limit: int = 100) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        One page of results matching filters, newest first.
+        Returns (items, next_cursor); next_cursor is None on the last page.
+        """
+        where, params = _where(filters)
+        if cursor is not None:
+            where.append("r.id < ?")
+            params.append(cursor)
+        sql = ("SELECT r.id, r.mac, r.day, r.received, r.finished, r.verdict, r.reason, "
+               "r.remote FROM results r")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY r.id DESC LIMIT ?"
+        conn = self._reader()
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        items = [dict(row) for row in rows[:limit]]
+        self._attach_details(conn, items)
+        return items, (items[-1]["id"] if more else None)
+
+    def iter_results(self, filters: Dict[str, Any], page: int = 500) -> Iterator[Dict[str, Any]]:
+        """Every result matching filters, newest first, fetched one page at a time."""
+        cursor = None
+        while True:
+            items, cursor = self.query(filters, cursor, page)
+            yield from items
+            if cursor is None:
+                return
+
+    def get(self, result_id: int) -> Optional[Dict[str, Any]]:
+        """Full stored result, including the report text and USB report."""
+        conn = self._reader()
+        row = conn.execute("SELECT * FROM results WHERE id = ?", (result_id,)).fetchone()
+        if row is None:
+            return None
+        item = dict(row)
+        for key in ("usb", "meta"):
+            item[key] = json.loads(item[key]) if item[key] else None
+        self._attach_details(conn, [item])
+        return item
+
+    def smart_history(self, serials: List[str], limit: int = 1) -> Dict[str, List[Dict[str, Any]]]:
+        """The newest `limit` SMART snapshots of every serial, newest first (one index range each)."""
+        conn = self._reader()
+        sql = (f"SELECT {', '.join(SMART_COLUMNS)} FROM smart_history "
+               "WHERE serial = ? ORDER BY ts DESC LIMIT ?")
+        return {serial: [dict(row) for row in conn.execute(sql, (serial, limit))]
+                for serial in serials}
+
+    def _attach_details(self, conn: sqlite3.Connection, items: List[Dict[str, Any]]) -> None:
+        """Add disks and usb_ports to a page of results with one query per table."""
+        if not items:
+            return
+        by_id = {item["id"]: item for item in items}
+        marks = ",".join("?" * len(by_id))
+        for item in items:
+            item["disks"], item["usb_ports"] = [], []
+        for row in conn.execute(
+                "SELECT result_id, serial, device, model, size, bus, health, why "
+                f"FROM result_disks WHERE result_id IN ({marks})", list(by_id)):
+            disk = dict(row)
+            by_id[disk.pop("result_id")]["disks"].append(disk)
+        for row in conn.execute(
+                "SELECT result_id, port, pass, fail_reasons "
+                f"FROM result_usb WHERE result_id IN ({marks}) ORDER BY port", list(by_id)):
+            by_id[row["result_id"]]["usb_ports"].append({
+                "port": row["port"], "pass": bool(row["pass"]),
+                "fail_reasons": json.loads(row["fail_reasons"] or "[]")})
+
+
+FILTERS = ("mac", "verdict", "reason", "serial", "health", "port", "usb_pass", "since", "until")
+
+
+def parse_filters(args) -> Dict[str, Any]:
+    """
+    Query-string filters to typed values. since/until take YYYY-MM-DD or
+    a relative age like 30d. Raises InvalidQuery.
+    """
+    filters: Dict[str, Any] = {}
+    for key in FILTERS:
+        value = (args.get(key) or "").strip()
+        if not value:
+            continue
+        if key == "mac":
+            filters[key] = value.lower()
+        elif key == "verdict":
+            if value.lower() not in VERDICTS:
+                raise InvalidQuery(f"verdict must be one of {', '.join(VERDICTS)}")
+            filters[key] = value.lower()
+        elif key == "health":
+            filters[key] = value.upper()
+        elif key == "port":
+            if not value.isdigit():
+                raise InvalidQuery("port must be a number")
+            filters[key] = int(value)
+        elif key == "usb_pass":
+            if value not in ("0", "1"):
+                raise InvalidQuery("usb_pass must be 0 or 1")
+            filters[key] = int(value)
+        elif key in ("since", "until"):
+            filters[key] = _parse_day(key, value)
+        else:
+            filters[key] = value
+    return filters
+
+
+def _parse_day(key: str, value: str) -> str:
+    if value[-1:] == "d" and value[:-1].isdigit():
+        return (date.today() - timedelta(days=int(value[:-1]))).isoformat()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise InvalidQuery(f"{key} must be YYYY-MM-DD or <days>d")
+
+
+def _where(filters: Dict[str, Any]) -> Tuple[List[str], List[Any]]:
+    # Child-table filters are IN (...) subqueries so each one is answered from
+    # its own (column, result_id) index.
+    where: List[str] = []
+    params: List[Any] = []
+    if "mac" in filters:
+        where.append("r.mac = ?")
+        params.append(filters["mac"])
+    if "verdict" in filters:
+        where.append("r.verdict = ?")
+        params.append(filters["verdict"])
+    if "since" in filters:
+        where.append("r.day >= ?")
+        params.append(filters["since"])
+    if "until" in filters:
+        where.append("r.day <= ?")
+        params.append(filters["until"])
+    if "reason" in filters:
+        where.append("r.id IN (SELECT result_id FROM result_reasons WHERE reason = ?)")
+        params.append(filters["reason"])
+    disk = [(c, filters[c]) for c in ("serial", "health") if c in filters]
+    if disk:
+        where.append("r.id IN (SELECT result_id FROM result_disks WHERE "
+                     + " AND ".join(f"{c} = ?" for c, _ in disk) + ")")
+        params += [v for _, v in disk]
+    usb = [(c, filters[c]) for c in ("port", "usb_pass") if c in filters]
+    if usb:
+        where.append("r.id IN (SELECT result_id FROM result_usb WHERE "
+                     + " AND ".join(f"{'pass' if c == 'usb_pass' else c} = ?" for c, _ in usb)
+                     + ")")
+        params += [v for _, v in usb]
+    return where, params
+
+
+def _backfill_reasons(conn: sqlite3.Connection) -> None:
+    """
+    Index the reasons of results stored before result_reasons existed, once
+    per file: done is recorded in meta, since result_reasons stays empty
+    where no result has a reason.
+    """
+    done = "SELECT 1 FROM meta WHERE key = 'reasons_backfilled'"
+    if conn.execute(done).fetchone():
+        return
+    # Every worker gets here on first start; the write lock lets one do it.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not conn.execute(done).fetchone():
+            if not conn.execute("SELECT 1 FROM result_reasons LIMIT 1").fetchone():
+                rows = conn.execute("SELECT id, reason FROM results WHERE reason != ''").fetchall()
+                conn.executemany("INSERT INTO result_reasons(result_id, reason) VALUES (?, ?)",
+                                 [(rid, r) for rid, reason in rows for r in _split_reasons(reason)])
+            conn.execute("INSERT INTO meta(key, value) VALUES ('reasons_backfilled', ?)",
+                         (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
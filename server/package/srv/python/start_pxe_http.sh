@@ -0,0 +1,18 @@
+#!/bin/sh
+# Entry point of the pxe-http unit. PXE_HTTP_MODE picks the server:
+#   wsgi  : gunicorn with threaded workers (gunicorn.conf.py), the default
+#   async : one asyncio process (pxe_http_async.py) serving the same app
+cd /srv/python
+
+case "${PXE_HTTP_MODE:-wsgi}" in
+    async)
+        exec /srv/python/.venv/bin/python /srv/python/pxe_http_async.py
+    ;;
+    wsgi)
+        exec /srv/python/.venv/bin/gunicorn -c /srv/python/gunicorn.conf.py pxe_http:app
+    ;;
+    *)
+        echo "Unknown PXE_HTTP_MODE '$PXE_HTTP_MODE' (expected wsgi or async)" >&2
+        exit 1
+    ;;
+esac
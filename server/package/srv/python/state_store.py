@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+state_store.py — per-MAC boot state shared by all pxe_http workers.
+
+Notes:
+- SQLite in WAL mode: readers never block the writer and the other way around,
+  so the gunicorn workers can share one file safely.
+- Every worker keeps the whole table in a dict. `PRAGMA data_version` tells us
+  (without touching the disk) when another connection committed, and only rows
+  with a newer `seq` are re-read. `seq` comes from a counter in `meta`, bumped
+  in the writing transaction, so it never goes back when purge() deletes the
+  newest row.
+- Writes go to the cache immediately and are committed in batches by a
+  background thread, so a request never waits on fsync.
+- Entries not written for `ttl_days` are treated as missing and purged.
+- Every row records the node that wrote it (`origin`). changes() and merge()
+  are the change log used by replication.py: a row only replaces another one
+  when its (updated, origin) is greater (last writer wins, ties broken by
+  node id), so every server ends up with the same row.
+- A local write comes after the rows this server already has: when a row
+  replicated from a node whose clock is ahead looks newer, the write is
+  stamped just after it instead of being dropped. Between the workers of
+  one server (same clock) the later write wins; the earlier one is logged.
+"""
+
+import os
+import uuid
+import json
+import time
+import queue
+import shelve
+import sqlite3
+import logging
+import threading
+import atexit
+import dbm
+from datetime import date, datetime
+from typing import Dict, Optional, Tuple, List, Any
+
+logger = logging.getLogger("pxe_http.state")
+
+# Guards the per-process (re)initialisation after a gunicorn fork.
+_start_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bootstage (
+    mac     TEXT PRIMARY KEY,
+    data    TEXT NOT NULL,
+    updated REAL NOT NULL,
+    seq     INTEGER NOT NULL,
+    origin  TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS bootstage_seq ON bootstage(seq);
+CREATE INDEX IF NOT EXISTS bootstage_updated ON bootstage(updated);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a connection with the pragmas every user of the state file needs."""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                           isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+class StateStore:
+    """
+    Cached, batched key/value store for per-MAC state (dicts of JSON values).
+
+    get() is a dict lookup after a cheap coherence check; put() never touches
+    the disk on the calling thread.
+    """
+
+    def __init__(self, path: str, ttl_days: int = 180, flush_interval: float = 0.05,
+                 purge_interval: float = 3600.0):
+        self.path = str(path)
+        self.ttl = ttl_days * 86400.0
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._pid = None
+
+    # ------------------------- lifecycle -------------------------
+
+    def _ensure_started(self) -> None:
+        # gunicorn forks workers; every process needs its own connections,
+        # cache and writer thread.
+        if self._pid == os.getpid():
+            return
+        with _start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._cache: Dict[str, Tuple[dict, float]] = {}
+            self._seq = 0
+            self._data_version = None
+            self._queue: "queue.Queue[Optional[Tuple[str, dict, float]]]" = queue.Queue()
+
+            conn = connect(self.path)
+            conn.executescript(SCHEMA)
+            self.node_id = _node_id(conn)
+            conn.close()
+
+            self._reader = connect(self.path)
+            self._writer = threading.Thread(target=self._write_loop, name="state-writer",
+                                            daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+            self._pid = os.getpid()
+
+    def close(self) -> None:
+        """Flush pending writes and stop the writer thread."""
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+
+    # --------------------------- reads ---------------------------
+
+    def _sync(self) -> None:
+        """Pull rows committed by other workers since the last call. Caller holds the lock."""
+        version = self._reader.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+        rows = self._reader.execute(
+            "SELECT mac, data, updated, seq FROM bootstage WHERE seq > ?", (self._seq,))
+        for mac, data, updated, seq in rows:
+            cached = self._cache.get(mac)
+            # A local write still waiting in the queue wins over an older row.
+            if cached is None or updated >= cached[1]:
+                self._cache[mac] = (json.loads(data), updated)
+            if seq > self._seq:
+                self._seq = seq
+
+    def get(self, key: str) -> dict:
+        """Return a copy of the entry for key, or {} if missing or expired."""
+        self._ensure_started()
+        with self._lock:
+            self._sync()
+            cached = self._cache.get(key)
+        if cached is None:
+            return {}
+        entry, updated = cached
+        if updated < time.time() - self.ttl:
+            return {}
+        return dict(entry)
+
+    def items(self) -> List[Tuple[str, dict, float]]:
+        """Snapshot of all live entries as (key, entry, updated)."""
+        self._ensure_started()
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._sync()
+            return [(k, dict(e), u) for k, (e, u) in self._cache.items() if u >= cutoff]
+
+    # --------------------------- writes --------------------------
+
+    def put(self, key: str, entry: dict, updated: Optional[float] = None) -> None:
+        """Store entry for key. Visible to this worker at once, to others after the next flush."""
+        self._ensure_started()
+        updated = time.time() if updated is None else updated
+        entry = dict(entry)
+        with self._lock:
+            self._cache[key] = (entry, updated)
+        self._queue.put((key, entry, updated))
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Block until everything queued so far has been committed."""
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put(("", {"__flush__": done}, 0.0))
+        done.wait(timeout)
+
+    def _write_loop(self) -> None:
+        conn = connect(self.path)
+        next_purge = time.time() + 60
+        while True:
+            try:
+                item = self._queue.get(timeout=self.purge_interval)
+            except queue.Empty:
+                item = ()
+            batch: List[Any] = [item] if item else []
+            stop = item is None
+            # Collect whatever arrives within flush_interval into one transaction.
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                else:
+                    batch.append(nxt)
+
+            rows = [b for b in batch if b and "__flush__" not in b[1]]
+            events = [b[1]["__flush__"] for b in batch if b and "__flush__" in b[1]]
+            if rows:
+                try:
+                    self._commit(conn, rows)
+                except sqlite3.Error as e:
+                    logger.error(f"State store write of {len(rows)} entries failed: {e}")
+            for ev in events:
+                ev.set()
+
+            if time.time() >= next_purge:
+                next_purge = time.time() + self.purge_interval
+                self.purge(conn)
+            if stop:
+                conn.close()
+                return
+
+    # ------------------------ replication ------------------------
+
+    def changes(self, since: int, limit: int = 1000, exclude: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Rows committed after local seq `since`, oldest first, as compact
+        [mac, entry, updated, origin, seq] lists. Rows written by node `exclude`
+        (the asking peer) are left out; it has them already.
+        """
+        self._ensure_started()
+        with self._lock:
+            # head first: a row committed in between is left for the next call.
+            head = _last_seq(self._reader)
+            rows = self._reader.execute(
+                "SELECT mac, data, updated, origin, seq FROM bootstage "
+                "WHERE seq > ? AND seq <= ? AND origin != ? ORDER BY seq LIMIT ?",
+                (since, head, exclude or "", limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "node": self.node_id,
+            "head": head,
+            # Where the next page starts; rows skipped by `exclude` are not sent again.
+            "next": rows[-1][4] if more else head,
+            "more": more,
+            "changes": [[mac, json.loads(data), updated, origin, seq]
+                        for mac, data, updated, origin, seq in rows],
+        }
+
+    def merge(self, conn: sqlite3.Connection, changes: List[List[Any]]) -> int:
+        """
+        Apply rows from a peer (last writer wins on (updated, origin)).
+        Returns the number of rows that replaced or added an entry.
+        """
+        self._ensure_started()
+        applied = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = _last_seq(conn)
+            for mac, entry, updated, origin, _ in changes:
+                seq += 1
+                cur = conn.execute(
+                    "INSERT INTO bootstage(mac, data, updated, seq, origin) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(mac) DO UPDATE SET data=excluded.data, updated=excluded.updated, "
+                    "seq=excluded.seq, origin=excluded.origin "
+                    "WHERE excluded.updated > bootstage.updated OR (excluded.updated = "
+                    "bootstage.updated AND excluded.origin > bootstage.origin)",
+                    (str(mac).lower(), json.dumps(entry, separators=(",", ":")), float(updated),
+                     seq, str(origin)))
+                applied += cur.rowcount
+            _store_seq(conn, seq)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return applied
+
+    def _commit(self, conn: sqlite3.Connection, rows: List[Tuple[str, dict, float]]) -> None:
+        # Last write per key inside the batch wins.
+        latest: Dict[str, Tuple[dict, float]] = {}
+        for key, entry, updated in rows:
+            latest[key] = (entry, updated)
+        dropped: Dict[str, Tuple[dict, float]] = {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = _last_seq(conn)
+            for key, (entry, updated) in latest.items():
+                row = conn.execute("SELECT updated, origin FROM bootstage WHERE mac = ?",
+                                   (key,)).fetchone()
+                if row and row[1] != self.node_id and row[0] >= updated:
+                    logger.info(f"State for {key} from {row[1]} is {row[0] - updated:.3f} s ahead "
+                                f"of this write; stamping it after that row")
+                    updated = row[0] + 0.001
+                seq += 1
+                cur = conn.execute(
+                    "INSERT INTO bootstage(mac, data, updated, seq, origin) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(mac) DO UPDATE SET data=excluded.data, "
+                    "updated=excluded.updated, seq=excluded.seq, origin=excluded.origin "
+                    "WHERE excluded.updated >= bootstage.updated",
+                    (key, json.dumps(entry, separators=(",", ":")), updated, seq, self.node_id))
+                if not cur.rowcount:
+                    logger.warning(f"State write for {key} dropped: another worker stored a newer one")
+                    data, stored = conn.execute("SELECT data, updated FROM bootstage WHERE mac = ?",
+                                                (key,)).fetchone()
+                    dropped[key] = (json.loads(data), stored)
+            _store_seq(conn, seq)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # _sync() may have read the newer row before our put(); show it again.
+        with self._lock:
+            for key, (entry, stored) in dropped.items():
+                if self._cache.get(key, (None, stored))[1] < stored:
+                    self._cache[key] = (entry, stored)
+
+    def purge(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        """Delete entries older than the TTL. Returns the number of rows removed."""
+        own = conn is None
+        conn = conn or connect(self.path)
+        try:
+            cur = conn.execute("DELETE FROM bootstage WHERE updated < ?",
+                               (time.time() - self.ttl,))
+            if cur.rowcount:
+                logger.info(f"Purged {cur.rowcount} state entries older than the TTL")
+            return cur.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"State store purge failed: {e}")
+            return 0
+        finally:
+            if own:
+                conn.close()
+
+    # -------------------------- migration ------------------------
+
+    def migrate_shelve(self, legacy_path: str) -> int:
+        """
+        One-shot import of the old shelve file (bootstage.db). Safe to call from
+        every worker: the first one to take the write lock does the work.
+        Returns the number of entries imported.
+        """
+        self._ensure_started()
+        if dbm.whichdb(str(legacy_path)) in (None, ""):
+            return 0
+        conn = connect(self.path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            done = conn.execute(
+                "SELECT value FROM meta WHERE key = 'shelve_migrated'").fetchone()
+            if done:
+                conn.execute("ROLLBACK")
+                return 0
+            count = 0
+            seq = _last_seq(conn)
+            with shelve.open(str(legacy_path), flag="r") as old:
+                for mac in old.keys():
+                    entry = dict(old[mac])
+                    seq += 1
+                    conn.execute(
+                        "INSERT OR IGNORE INTO bootstage(mac, data, updated, seq, origin) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (mac.lower(), json.dumps(entry, separators=(",", ":")),
+                         _entry_timestamp(entry), seq, self.node_id))
+                    count += 1
+            _store_seq(conn, seq)
+            conn.execute("INSERT INTO meta(key, value) VALUES ('shelve_migrated', ?)",
+                         (datetime.now().isoformat(timespec="seconds"),))
+            conn.execute("COMMIT")
+            logger.info(f"Migrated {count} entries from {legacy_path}")
+            return count
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.error(f"Migration from {legacy_path} failed: {e}")
+            return 0
+        finally:
+            conn.close()
+
+
+def _node_id(conn: sqlite3.Connection) -> str:
+    """This server's replication id: PXE_NODE_ID, else generated once and kept in meta."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(bootstage)")]
+    if "origin" not in cols:
+        try:
+            conn.execute("ALTER TABLE bootstage ADD COLUMN origin TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError:
+            pass  # another worker added it first
+    node = os.environ.get("PXE_NODE_ID")
+    if node:
+        return node
+    conn.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('node_id', ?)",
+                 (uuid.uuid4().hex[:12],))
+    return conn.execute("SELECT value FROM meta WHERE key = 'node_id'").fetchone()[0]
+
+
+def _last_seq(conn: sqlite3.Connection) -> int:
+    """Highest seq ever handed out (MAX(seq) of a file from before the counter)."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+    if row:
+        return int(row[0])
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM bootstage").fetchone()[0]
+
+
+def _store_seq(conn: sqlite3.Connection, seq: int) -> None:
+    """Record seq as handed out; call inside the transaction that used it."""
+    conn.execute("INSERT INTO meta(key, value) VALUES ('seq', ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (str(seq),))
+
+
+def _entry_timestamp(entry: dict) -> float:
+    # Old entries carry no write time; the memtest date is the best guess.
+    try:
+        d = date.fromisoformat(entry.get("last_memtest_date", ""))
+        return datetime(d.year, d.month, d.day).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
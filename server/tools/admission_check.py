@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+admission_check.py — check that /bootstage is answered while all transfer slots are taken.
+
+Notes:
+- Starts pxe_http in-process in its async mode (few app threads) on a free
+  local port, with a scratch PXE_ROOT holding one large modloop.
+- Holds every transfer slot itself, then lets --downloads busybox-wget-like
+  clients ask for the modloop: they find no slot and must neither fail nor
+  tie up the app threads. Meanwhile it asks /bootstage --probes times.
+- Exits non-zero when a /bootstage answer is not a 200 within --max-ms, or a
+  download did not complete.
+- Standard library only (plus the server's own dependencies).
+
+Example:
+  python3 admission_check.py --threads 4 --downloads 16
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(HERE, "..", "package", "srv", "python")
+MODLOOP = "alpine/boot/x86_64/modloop-lts"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, root: str) -> int:
+    """pxe_http_async.Server on a background event loop; returns its port."""
+    os.environ.update({
+        "PXE_HTTP_MODE": "async",
+        "PXE_ROOT": root,
+        "PXE_SLOTS_DIR": os.path.join(root, "slots"),
+        "PXE_METRICS_DIR": os.path.join(root, "metrics"),
+        "PXE_MAX_TRANSFERS": "2",
+        "PXE_LATE_RESERVED": "0",
+        "PXE_LARGE_TRANSFER_MB": "1",
+        "PXE_ADMISSION_WAIT": str(args.wait),
+        "PXE_ASYNC_THREADS": str(args.threads),
+        "PXE_CACHE_BUDGET_MB": "0",
+    })
+    sys.path.insert(0, SERVER_DIR)
+    import pxe_http_async
+
+    port = free_port()
+    server = pxe_http_async.Server(pxe_http_async.pxe_http.app, args.threads)
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(asyncio.start_server(server.handle, "127.0.0.1", port))
+        server.port = port
+        loop.run_forever()
+    threading.Thread(target=serve, name="pxe-http", daemon=True).start()
+    return port
+
+
+def get(port: int, path: str, agent: str, timeout: float):
+    """(status, body bytes, seconds) of one GET on a fresh connection."""
+    t0 = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as s:
+        s.sendall(f"GET /{path} HTTP/1.1\r\nHost: 127.0.0.1\r\nUser-Agent: {agent}\r\n"
+                  f"Connection: close\r\n\r\n".encode())
+        data = b""
+        while True:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), body, time.perf_counter() - t0
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="/bootstage latency while all transfer slots are full")
+    ap.add_argument("--threads", type=int, default=4, help="app threads of the async server")
+    ap.add_argument("--downloads", type=int, default=16, help="wget downloads waiting for a slot")
+    ap.add_argument("--probes", type=int, default=10, help="/bootstage requests")
+    ap.add_argument("--max-ms", type=float, default=1000.0, help="slowest acceptable /bootstage")
+    ap.add_argument("--wait", type=float, default=5.0, help="PXE_ADMISSION_WAIT of the server (s)")
+    args = ap.parse_args()
+
+    root = tempfile.mkdtemp(prefix="admission_check.")
+    path = os.path.join(root, "http", MODLOOP)
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(os.urandom(4 * 1024 * 1024))
+    port = start_server(args, root)
+
+    import pxe_http
+    held = [pxe_http.scheduler.try_acquire(late=True) for _ in range(pxe_http.scheduler.slots)]
+    downloads = []
+
+    def download():
+        try:
+            status, body, secs = get(port, MODLOOP, "Wget", args.wait + 30)
+            downloads.append({"status": status, "bytes": len(body), "s": round(secs, 3)})
+        except OSError as e:
+            downloads.append({"error": str(e)})
+
+    workers = [threading.Thread(target=download) for _ in range(args.downloads)]
+    for t in workers:
+        t.start()
+    time.sleep(0.5)  # let the downloads reach admission first
+
+    probes = []
+    for i in range(args.probes):
+        try:
+            status, _, secs = get(port, f"bootstage?mac=02:00:00:00:00:{i:02x}", "iPXE/1.21.1",
+                                  args.max_ms / 1000 + 5)
+            probes.append({"status": status, "ms": round(secs * 1000, 1)})
+        except OSError as e:
+            probes.append({"error": str(e)})
+    for slot in held:
+        if slot is not None:
+            slot.release()
+    for t in workers:
+        t.join()
+
+    size = os.path.getsize(path)
+    slow = [p for p in probes if p.get("status") != 200 or p["ms"] > args.max_ms]
+    broken = [d for d in downloads if d.get("status") != 200 or d["bytes"] != size]
+    report = {"threads": args.threads, "downloads": len(downloads), "failed_downloads": len(broken),
+              "bootstage_ms": [p.get("ms", p.get("error")) for p in probes], "slow_bootstage": len(slow),
+              "max_download_s": max((d.get("s", 0) for d in downloads), default=0)}
+    print(json.dumps(report, indent=2))
+    return 1 if slow or broken else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
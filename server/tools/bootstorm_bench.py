@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+bootstorm_bench.py — simulate a rack of iPXE clients powering on against pxe_http.
+
+Notes:
+- Each simulated client has its own MAC (locally administered 02:... range, so
+  real machines' boot state is never touched) and does what boot.ipxe and the
+  Alpine initramfs do: GET /bootstage?mac=..., then vmlinuz, initramfs, the
+  apkovl and (optionally) the modloop of its arch, one connection per request.
+  A 503 with Retry-After is retried after that delay, as iPXE does.
+- Client downloads are paced to --link-mbps, so slow links hold connections
+  open the way real 100 Mbit NICs do.
+- Clients start spread over --ramp seconds; at most --concurrency run at once.
+- Prints a JSON report (per-endpoint p50/p95/p99 of time to first byte and
+  total time, throughput, errors). With --baseline it also compares against an
+  earlier report and exits non-zero when a p95 got worse than --tolerance.
+- Standard library only; one asyncio process drives thousands of clients.
+
+Example:
+  python3 bootstorm_bench.py --server http://192.168.200.1 --clients 200 \
+      --concurrency 200 --ramp 5 --link-mbps 100 --out storm.json
+"""
+
+import sys
+import math
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+CHUNK = 64 * 1024
+
+ARTIFACTS = {
+    "vmlinuz": "alpine/boot/{arch}/vmlinuz-lts",
+    "initramfs": "alpine/boot/{arch}/initramfs-lts",
+    "apkovl": "alpine/boot/{arch}/localhost.apkovl.tar.gz",
+    "modloop": "alpine/boot/{arch}/modloop-lts",
+    "memtest": "mt86plus.efi",
+}
+
+
+class Sample:
+    __slots__ = ("endpoint", "status", "ttfb", "total", "nbytes", "error", "retries",
+                 "retry_after")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.status = 0
+        self.ttfb = 0.0
+        self.total = 0.0
+        self.nbytes = 0
+        self.error: Optional[str] = None
+        self.retries = 0
+        self.retry_after: Optional[float] = None
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def client_mac(seed: int, i: int) -> str:
+    n = (seed * 1_000_003 + i) & 0xFFFFFFFF
+    return "02:00:" + ":".join(f"{(n >> s) & 0xFF:02x}" for s in (24, 16, 8, 0))
+
+# --------------------------- HTTP -----------------------------
+
+
+async def fetch(host: str, port: int, path: str, endpoint: str, link_bps: float,
+                timeout: float, agent: str = "iPXE/1.21.1") -> Tuple[Sample, bytes]:
+    """GET path on a fresh connection. Keeps the body only for small responses."""
+    s = Sample(endpoint)
+    t0 = time.perf_counter()
+    writer = None
+    body = b""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.write(f"GET /{path.lstrip('/')} HTTP/1.1\r\nHost: {host}\r\n"
+                     f"User-Agent: {agent} (bootstorm_bench)\r\n"
+                     f"Connection: close\r\n\r\n".encode())
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        s.ttfb = time.perf_counter() - t0
+        lines = head.decode("latin-1").split("\r\n")
+        s.status = int(lines[0].split(" ", 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            k, _, v = line.partition(":")
+            headers[k.strip().lower()] = v.strip()
+        length = int(headers["content-length"]) if "content-length" in headers else None
+        if s.status == 503 and headers.get("retry-after", "").isdigit():
+            s.retry_after = float(headers["retry-after"])
+        keep = length is not None and length <= CHUNK
+
+        t_body = time.perf_counter()
+        while length is None or s.nbytes < length:
+            want = CHUNK if length is None else min(CHUNK, length - s.nbytes)
+            chunk = await asyncio.wait_for(reader.read(want), timeout)
+            if not chunk:
+                break
+            s.nbytes += len(chunk)
+            if keep:
+                body += chunk
+            if link_bps:
+                # Pace the download to the simulated link speed.
+                ahead = t_body + s.nbytes * 8 / link_bps - time.perf_counter()
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        if length is not None and s.nbytes < length:
+            s.error = "short_body"
+        elif s.status >= 400:
+            s.error = f"http_{s.status}"
+    except asyncio.TimeoutError:
+        s.error = "timeout"
+    except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+        s.error = type(e).__name__
+    finally:
+        s.total = time.perf_counter() - t0
+        if writer is not None:
+            writer.close()
+    return s, body
+
+async def fetch_with_retry(host: str, port: int, path: str, endpoint: str, link_bps: float,
+                           args) -> Sample:
+    """Like iPXE: on 503 with Retry-After, wait and ask again (times include the waits)."""
+    t0 = time.perf_counter()
+    retries = 0
+    # The apkovl and modloop are fetched by busybox wget in the Alpine initramfs.
+    agent = "Wget" if endpoint in ("apkovl", "modloop") else "iPXE/1.21.1"
+    while True:
+        s, _ = await fetch(host, port, path, endpoint, link_bps, args.timeout, agent)
+        if s.retry_after is None or retries >= args.max_retries:
+            break
+        retries += 1
+        await asyncio.sleep(s.retry_after)
+    s.retries = retries
+    if retries:
+        elapsed = time.perf_counter() - t0
+        s.ttfb += elapsed - s.total
+        s.total = elapsed
+    return s
+
+# --------------------------- client ---------------------------
+
+
+async def boot_client(args, i: int, samples: List[Sample], sem: asyncio.Semaphore,
+                      start_at: float) -> None:
+    u = urlsplit(args.server)
+    host, port = u.hostname, u.port or 80
+    mac = client_mac(args.seed, i)
+    arch = random.choice(("x86_64", "x86")) if args.arch == "mixed" else args.arch
+    link_bps = args.link_mbps * 1e6
+
+    delay = start_at - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    async with sem:
+        s, body = await fetch(host, port, f"bootstage?mac={mac}", "bootstage", 0, args.timeout)
+        samples.append(s)
+        target = "alpine"
+        if b"def_target memtest" in body:
+            target = "memtest"
+        if args.path != "auto":
+            target = args.path
+
+        if target == "memtest":
+            names = ["memtest"]
+        else:
+            names = ["vmlinuz", "initramfs", "apkovl"] + (["modloop"] if args.modloop else [])
+        for name in names:
+            s = await fetch_with_retry(host, port, ARTIFACTS[name].format(arch=arch), name,
+                                       link_bps, args)
+            samples.append(s)
+            if s.error and args.stop_on_error:
+                return
+
+
+async def run(args) -> Tuple[List[Sample], float]:
+    random.seed(args.seed)
+    samples: List[Sample] = []
+    sem = asyncio.Semaphore(args.concurrency)
+    t0 = time.perf_counter()
+    tasks = [boot_client(args, i, samples, sem, t0 + random.uniform(0, args.ramp))
+             for i in range(args.clients)]
+    await asyncio.gather(*tasks)
+    return samples, time.perf_counter() - t0
+
+# --------------------------- report ---------------------------
+
+
+def summarize(args, samples: List[Sample], wall: float) -> Dict:
+    endpoints: Dict[str, Dict] = {}
+    errors: Dict[str, int] = {}
+    for name in ["bootstage"] + list(ARTIFACTS):
+        group = [s for s in samples if s.endpoint == name]
+        if not group:
+            continue
+        ok = [s for s in group if not s.error]
+        ttfb = sorted(s.ttfb * 1000 for s in ok)
+        total = sorted(s.total * 1000 for s in ok)
+        nbytes = sum(s.nbytes for s in group)
+        endpoints[name] = {
+            "requests": len(group),
+            "errors": len(group) - len(ok),
+            "bytes": nbytes,
+            "retries": sum(s.retries for s in group),
+            "ttfb_ms": {f"p{p}": round(percentile(ttfb, p), 2) for p in (50, 95, 99)},
+            "total_ms": {f"p{p}": round(percentile(total, p), 2) for p in (50, 95, 99)},
+        }
+        endpoints[name]["ttfb_ms"]["max"] = round(ttfb[-1], 2) if ttfb else 0.0
+        endpoints[name]["total_ms"]["max"] = round(total[-1], 2) if total else 0.0
+        for s in group:
+            if s.error:
+                key = f"{name}:{s.error}"
+                errors[key] = errors.get(key, 0) + 1
+    total_bytes = sum(s.nbytes for s in samples)
+    return {
+        "config": {k: getattr(args, k) for k in ("server", "clients", "concurrency", "ramp",
+                                                  "link_mbps", "arch", "path", "modloop", "seed")},
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wall_s": round(wall, 3),
+        "requests": len(samples),
+        "errors": errors,
+        "bytes": total_bytes,
+        "throughput_MBps": round(total_bytes / wall / 1e6, 3) if wall else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Lines describing p95 changes; entries starting with 'REGRESSION' fail the run."""
+    out = []
+    for name, cur in report["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        for metric in ("ttfb_ms", "total_ms"):
+            b, c = base[metric]["p95"], cur[metric]["p95"]
+            if not b:
+                continue
+            change = (c - b) / b
+            tag = "REGRESSION" if change > tolerance else "ok"
+            out.append(f"{tag:10} {name:10} {metric:8} p95 {b:9.2f} -> {c:9.2f} ms "
+                       f"({change * 100:+.1f}%)")
+    return out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Boot-storm load generator for pxe_http")
+    ap.add_argument("--server", default="http://127.0.0.1", help="base URL of pxe_http")
+    ap.add_argument("--clients", type=int, default=100, help="simulated machines")
+    ap.add_argument("--concurrency", type=int, default=100, help="machines booting at once")
+    ap.add_argument("--ramp", type=float, default=5.0, help="spread client starts over N s")
+    ap.add_argument("--link-mbps", type=float, default=100.0, help="client link speed, 0 = unlimited")
+    ap.add_argument("--arch", choices=("x86_64", "x86", "mixed"), default="x86_64")
+    ap.add_argument("--path", choices=("alpine", "memtest", "auto"), default="alpine",
+                    help="what to fetch after /bootstage; auto follows its answer")
+    ap.add_argument("--modloop", action="store_true", help="also fetch the modloop")
+    ap.add_argument("--timeout", type=float, default=120.0, help="per read timeout (s)")
+    ap.add_argument("--max-retries", type=int, default=20,
+                    help="503 + Retry-After retries per download (iPXE behaviour)")
+    ap.add_argument("--seed", type=int, default=1, help="MAC and arrival seed")
+    ap.add_argument("--stop-on-error", action="store_true",
+                    help="a client stops after its first failed download")
+    ap.add_argument("--out", help="write the JSON report here (default: stdout)")
+    ap.add_argument("--baseline", help="earlier JSON report to compare p95 against")
+    ap.add_argument("--tolerance", type=float, default=0.2,
+                    help="allowed p95 increase against the baseline (0.2 = 20%%)")
+    args = ap.parse_args()
+
+    samples, wall = asyncio.run(run(args))
+    report = summarize(args, samples, wall)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for name, ep in report["endpoints"].items():
+        print(f"{name:10} n={ep['requests']:5} err={ep['errors']:4} "
+              f"ttfb p50/p95/p99 {ep['ttfb_ms']['p50']}/{ep['ttfb_ms']['p95']}/"
+              f"{ep['ttfb_ms']['p99']} ms  total p95 {ep['total_ms']['p95']} ms",
+              file=sys.stderr)
+    print(f"{report['requests']} requests in {report['wall_s']} s, "
+          f"{report['throughput_MBps']} MB/s, {sum(report['errors'].values())} errors",
+          file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines = compare(report, json.load(f), args.tolerance)
+        for line in lines:
+            print(line, file=sys.stderr)
+        if any(line.startswith("REGRESSION") for line in lines):
+            return 2
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())